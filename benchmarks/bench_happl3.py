@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""Happl3 benchmark suite.
+
+Generates synthetic plans and measures the plan/index load path, index
+persistence, running steps, shell round-trips and TUI drawing, for every plan
+size and number of output lines per step. Results are written as JSON so runs
+can be compared across versions:
+
+    python benchmarks/bench_happl3.py --output bench.json
+    python benchmarks/bench_happl3.py --sizes 1000 10000 --roundtrips 200
+"""
+
+import argparse
+import curses
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from happl3.happl3_app import Happl3  # noqa: E402
+from happl3.happl3_shell import Happl3Shell  # noqa: E402
+from happl3.happl3_screen import Happl3Screen  # noqa: E402
+from happl3.happl3_session import Happl3SessionManager  # noqa: E402
+
+
+def generate_plan(path, lines, block_size=50, output_lines=1):
+    """Write a bash plan of `lines` rows with a comment row every block_size rows."""
+    with open(path, 'w') as f:
+        for i in range(lines):
+            if block_size and i % block_size == 0:
+                f.write(f"#--- block {i // block_size}\n")
+            elif output_lines > 1:
+                f.write(f"seq 1 {output_lines}\n")
+            else:
+                f.write(f"echo step {i}\n")
+
+
+def timed(fn, repeat=1):
+    """Run fn repeat times and return per-run wall times in seconds."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def summarize(times):
+    ordered = sorted(times)
+    return {
+        "runs": len(times),
+        "min": ordered[0],
+        "mean": statistics.mean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+        "max": ordered[-1],
+    }
+
+
+class FakeWindow:
+    """Headless stand-in for a curses window or pad that counts what would be sent to it."""
+
+    def __init__(self, rows=50, cols=160):
+        self.rows = rows
+        self.cols = cols
+        self.calls = 0
+        self.chars = 0
+
+    def getmaxyx(self):
+        return self.rows, self.cols
+
+    def addstr(self, *args):
+        self.calls += 1
+        text = args[2] if len(args) > 2 and not isinstance(args[0], (str, bytes)) else args[0]
+        self.chars += len(text)
+
+    def _count(self, *args):
+        self.calls += 1
+
+    addch = insch = vline = hline = move = clrtoeol = bkgd = erase = clear = noutrefresh = refresh = _count
+
+
+@contextmanager
+def headless_curses(rows=50, cols=160):
+    """Replace the curses functions Happl3 uses with no-ops and yield the fake stdscr."""
+    pads = []
+    stdscr = FakeWindow(rows, cols)
+    saved = {}
+    replacements = {
+        "newpad": lambda height, width: pads.append(FakeWindow(height, width)) or pads[-1],
+        "color_pair": lambda n: n << 8,
+        "doupdate": lambda: None,
+    }
+    for name in ("ACS_VLINE", "ACS_HLINE", "ACS_ULCORNER", "ACS_URCORNER", "ACS_LLCORNER", "ACS_LRCORNER"):
+        replacements[name] = ord('+')
+    for name, value in replacements.items():
+        saved[name] = getattr(curses, name, None)
+        setattr(curses, name, value)
+    try:
+        stdscr.pads = pads
+        yield stdscr
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                delattr(curses, name)
+            else:
+                setattr(curses, name, value)
+
+
+def bench_load(workdir, size, block_size, repeat, output_lines=1):
+    plan = os.path.join(workdir, f"plan_{size}_{output_lines}.sh")
+    generate_plan(plan, size, block_size, output_lines)
+    log = f"{plan}.log"
+    cold = timed(lambda: Happl3(plan, log), 1)
+    app = Happl3(plan, log)
+    app.select_all()
+    save = timed(app.save_index, repeat)
+    warm = timed(lambda: Happl3(plan, log), repeat)
+
+    def load_parsed():
+        # Without the snapshot the plan and JSON index are parsed again
+        if os.path.exists(app.snapshot_file):
+            os.remove(app.snapshot_file)
+        Happl3(plan, log)
+    parsed = timed(load_parsed, repeat)
+
+    app = Happl3(plan, log)
+    journal = timed(lambda: app.record_index(len(app.commands) // 2), 200)
+    app.save_index()
+
+    result = {
+        "lines": size,
+        "block_size": block_size,
+        "output_lines": output_lines,
+        "load_cold": summarize(cold),
+        "load_warm": summarize(warm),
+        "load_parsed": summarize(parsed),
+        "save_index": summarize(save),
+        "record_index": summarize(journal),
+        "index_bytes": os.path.getsize(app.index_file),
+    }
+    return app, result
+
+
+def bench_run(app, steps):
+    """Run the first steps commands of the plan, which writes their output to the log and their status to the index."""
+    rows = list(islice((i for i in range(len(app.commands)) if not app.store.is_comment(i)), steps))
+    app.shell_session = Happl3SessionManager("bash")
+    try:
+        app.shell_session.run_command("true")  # Warm up
+        queue = iter(rows)
+        times = timed(lambda: app.run_step(next(queue)), len(rows))
+    finally:
+        app.shell_session.close_session()
+        app.shell_session = None
+    result = summarize(times)
+    result.update({"steps_per_second": len(rows) / sum(times), "log_bytes": os.path.getsize(app.log_file)})
+    return result
+
+
+def bench_draw(app, repeat):
+    with headless_curses() as stdscr:
+        app.stdscr = stdscr
+        app.screen = Happl3Screen(stdscr, "Happl3 - The Happy Command Applier")
+        first = timed(app.draw, 1)
+        app.highlight = len(app.commands) // 2
+
+        def move():
+            app.highlight = (app.highlight + 1) % len(app.commands)
+            app.draw()
+
+        calls_before = stdscr.calls + sum(p.calls for p in stdscr.pads)
+        chars_before = sum(p.chars for p in stdscr.pads)
+        keypress = timed(move, repeat)
+        calls = stdscr.calls + sum(p.calls for p in stdscr.pads) - calls_before
+        chars = sum(p.chars for p in stdscr.pads) - chars_before
+    return {
+        "first_frame": summarize(first),
+        "keypress_frame": summarize(keypress),
+        "curses_calls_per_keypress": calls / repeat,
+        "chars_per_keypress": chars / repeat,
+    }
+
+
+def bench_shell(count, output_lines):
+    shell = Happl3Shell("bash")
+    command = f"seq 1 {output_lines}" if output_lines > 1 else "true"
+    try:
+        shell.run_command("true")  # Warm up
+        times = timed(lambda: shell.run_command(command, on_output=lambda stream, text: None), count)
+    finally:
+        shell.close_session()
+    result = summarize(times)
+    result.update({"command": command, "steps_per_second": count / sum(times)})
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Happl3 benchmark suite")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help="Plan sizes in lines")
+    parser.add_argument("--block-size", type=int, default=50, help="Rows per block (a comment row starts each block)")
+    parser.add_argument("--output-lines", type=int, nargs='+', default=[1, 100, 10000],
+                        help="Lines printed per command of the generated plans and the shell round-trip benchmark")
+    parser.add_argument("--roundtrips", type=int, default=500, help="Commands per shell round-trip benchmark")
+    parser.add_argument("--run-steps", type=int, default=200, help="Plan steps run per plan (fewer for large outputs)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions for load and save benchmarks")
+    parser.add_argument("--draw-repeat", type=int, default=200, help="Key presses for the draw benchmark")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = {
+        "timestamp": datetime.now().isoformat(),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "plans": [],
+        "shell": [],
+    }
+    with tempfile.TemporaryDirectory(prefix="happl3-bench-") as workdir:
+        for size in args.sizes:
+            for output_lines in args.output_lines:
+                print(f"plan {size} lines, {output_lines} output lines", file=sys.stderr)
+                app, result = bench_load(workdir, size, args.block_size, args.repeat, output_lines)
+                if os.name == "posix":
+                    result["run"] = bench_run(app, max(10, args.run_steps // max(1, output_lines // 100)))
+                # After the run, so the log pane shows its output
+                result["draw"] = bench_draw(app, args.draw_repeat)
+                results["plans"].append(result)
+    if os.name == "posix":
+        for output_lines in args.output_lines:
+            print(f"shell round-trip, {output_lines} output lines", file=sys.stderr)
+            count = max(10, args.roundtrips // max(1, output_lines // 100))
+            results["shell"].append(bench_shell(count, output_lines))
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
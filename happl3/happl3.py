@@ -1,32 +1,216 @@
 #!/usr/bin/env python3
 
+import os
 import argparse
-import curses
-from happl3.happl3_app import Happl3
-from happl3.happl3_shell import Happl3Shell
+from happl3.happl3_defaults import LOG_MAX_BYTES, LOG_KEEP_SEGMENTS, CACHE_MAX_BYTES, FANOUT_LIMIT
+
+# The other modules are imported where they are needed, so printing the help and
+# starting a batch run do not pay for the user interface, cProfile and pstats
 
 def main():
     parser = argparse.ArgumentParser(description="Happl3 - The happy script applier")
     parser.add_argument("PlanFile", nargs='?', help="The file containing the migration plan")
     parser.add_argument("LogFile", nargs='?', help="The file containing the log output (default to ${PlanFile}.log)")
+    batch = parser.add_argument_group("batch mode")
+    batch.add_argument("--batch", action="store_true", help="Run the selected commands without the TUI and exit")
+    batch.add_argument("--pending", action="store_true", help="Select pending commands (the default selection)")
+    batch.add_argument("--failed", action="store_true", help="Select failed commands")
+    batch.add_argument("--range", action="append", default=[], metavar="FIRST[-LAST]",
+                       help="Select rows FIRST to LAST (1-based, inclusive; LAST may be omitted for end of plan)")
+    batch.add_argument("--block", action="append", default=[], type=int, metavar="ROW",
+                       help="Select the pending commands of the block containing ROW")
+    batch.add_argument("--selected", action="store_true", help="Use the selection saved by the last interactive session")
+    batch.add_argument("--continue", dest="fail_fast", action="store_false",
+                       help="Keep running after a failed command (default: stop at the first failure)")
+    batch.add_argument("--summary", metavar="FILE", help="Write the JSON run summary to FILE instead of stdout")
+    batch.add_argument("--quiet", action="store_true", help="Do not print progress to stderr")
+    daemon = parser.add_argument_group("daemon mode")
+    daemon.add_argument("--daemon", action="store_true",
+                        help="Run the plan in a background process that clients attach to over <PlanFile>.sock")
+    daemon.add_argument("--attach", action="store_true", help="Open the user interface on the plan's daemon")
+    daemon.add_argument("--send", choices=("run", "pause", "cancel", "status", "follow", "stop"), metavar="COMMAND",
+                        help="Send COMMAND to the plan's daemon: run (the batch selection), pause, cancel, status, "
+                             "follow (print the output until the run ends) or stop")
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                        help="Kill a command that runs longer than SECONDS and restart the shell session")
+    parser.add_argument("--pipeline", type=int, default=1, metavar="N",
+                        help="Send up to N selected commands to the shell at once instead of waiting for each one")
+    parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                        help="Run independent blocks (see #@after:) in parallel on N shell sessions")
+    parser.add_argument("--log-max-bytes", type=int, default=LOG_MAX_BYTES, metavar="BYTES",
+                        help=f"Rotate the log into a compressed segment at this size, 0 to disable (default {LOG_MAX_BYTES})")
+    parser.add_argument("--log-keep", type=int, default=LOG_KEEP_SEGMENTS, metavar="N",
+                        help=f"Number of compressed log segments to keep (default {LOG_KEEP_SEGMENTS})")
+    parser.add_argument("--search-index", action="store_true",
+                        help="Keep a trigram index of the log in LogFile.tidx, so that / skips what cannot match")
+    parser.add_argument("--targets", metavar="FILE",
+                        help="Run every step on each target listed in FILE as \"name = command that starts a shell\"")
+    parser.add_argument("--fanout", type=int, default=FANOUT_LIMIT, metavar="N",
+                        help=f"Run a step on at most N targets at the same time (default {FANOUT_LIMIT})")
+    parser.add_argument("--cache-max-bytes", type=int, default=CACHE_MAX_BYTES, metavar="BYTES",
+                        help="Total output size of the cached results of #@inputs: steps, 0 disables the cache "
+                             f"(default {CACHE_MAX_BYTES})")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Profile the run with cProfile; writes FILE (pstats) and a text report to FILE.txt")
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.fanout < 1:
+        parser.error("--fanout must be at least 1")
+    if args.targets and (args.jobs > 1 or args.pipeline > 1):
+        parser.error("--targets runs one step at a time and cannot be combined with --jobs or --pipeline")
+    if sum(1 for mode in (args.batch, args.daemon, args.attach, args.send) if mode) > 1:
+        parser.error("--batch, --daemon, --attach and --send cannot be combined")
 
     if not args.PlanFile:
-        Happl3().display_help()
+        from happl3.happl3_help import HELP_MESSAGE
+        print(HELP_MESSAGE)
+        raise SystemExit(1)
+
+    if not args.profile:
+        run(parser, args)
         return
+    import cProfile
+    from happl3.happl3_stats import profile_threads, write_profile
+    profile_threads()  # The executor, the --jobs workers and the --targets threads get profilers of their own
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        run(parser, args)
+    finally:
+        profiler.disable()
+        write_profile(profiler, args.profile)
+
+def run(parser, args):
+    from happl3.happl3_shell import plan_shell_type
+    from happl3.happl3_session import Happl3SessionManager
 
     log_file = args.LogFile if args.LogFile else f"{args.PlanFile}.log"
-    app = Happl3(args.PlanFile, log_file)
-    
-    # Initialize Happl3Shell instance
-    shell_type = "pwsh" if args.PlanFile.endswith('.ps1') else "bash"
-    app.shell_session = Happl3Shell(shell_type)
-    
+
+    if args.attach or args.send:
+        attach(parser, args, log_file)
+        return
+    ready = None
+    if args.daemon:
+        from happl3.happl3_daemon import daemonize
+        ready = daemonize()  # Before any thread is started
+
+    # The shell warms up in the background while the plan and index load
+    session = Happl3SessionManager(plan_shell_type(args.PlanFile), timeout=args.timeout)
+
+    if args.batch:
+        from happl3.happl3_batch import Happl3Batch, parse_row_range
+        try:
+            ranges = [parse_row_range(r) for r in args.range]
+        except ValueError as e:
+            parser.error(str(e))
+        app = start_app(parser, args, log_file, session)
+        if any(row < 1 or row > len(app.commands) for row in args.block):
+            parser.error(f"--block rows must be between 1 and {len(app.commands)}")
+        runner = Happl3Batch(app, fail_fast=args.fail_fast, quiet=args.quiet)
+        runner.select(pending=args.pending, failed=args.failed, ranges=ranges,
+                      blocks=[row - 1 for row in args.block], keep_selection=args.selected)
+        try:
+            summary = runner.run()
+        finally:
+            app.close_sessions()
+            app.save_index()
+            app.prune_artifacts()
+        runner.write_summary(summary, args.summary)
+        raise SystemExit(summary["exit_code"])
+
+    app = start_app(parser, args, log_file, session)
+
+    if args.daemon:
+        from happl3.happl3_daemon import Happl3Daemon, daemon_socket
+        daemon = Happl3Daemon(app, daemon_socket(args.PlanFile))
+        try:
+            try:
+                daemon.listen()
+            except OSError as e:
+                parser.error(f"cannot serve {args.PlanFile}: {e}")
+            daemon.serve(ready)
+        finally:
+            app.close_sessions()
+            app.save_index()
+            app.prune_artifacts()
+        return
+
+    import curses
+    try:
+        curses.wrapper(app.run)
+    finally:
+        # Close the shell sessions and compact the index journal when app quits
+        app.close_sessions()
+        app.save_index()
+        app.prune_artifacts()
+
+def attach(parser, args, log_file):
+    from happl3.happl3_daemon import Happl3Client, daemon_socket
+    try:
+        # Connect before loading the plan, so no step that finishes in between is missed
+        client = Happl3Client(daemon_socket(args.PlanFile))
+    except OSError as e:
+        parser.error(f"no daemon serves {args.PlanFile}: {e}")
     try:
+        if args.send in ("status", "follow", "pause", "cancel", "stop"):
+            from happl3.happl3_daemon import send_command
+            raise SystemExit(send_command(client, args.send))
+
+        from happl3.happl3_app import Happl3
+        from happl3.happl3_daemon import Happl3RemoteExecutor
+        app = Happl3(args.PlanFile, log_file, args.log_max_bytes, args.log_keep, attached=True)
+        if args.send == "run":
+            from happl3.happl3_batch import Happl3Batch, parse_row_range
+            from happl3.happl3_daemon import send_command
+            try:
+                ranges = [parse_row_range(r) for r in args.range]
+            except ValueError as e:
+                parser.error(str(e))
+            if any(row < 1 or row > len(app.commands) for row in args.block):
+                parser.error(f"--block rows must be between 1 and {len(app.commands)}")
+            Happl3Batch(app).select(pending=args.pending, failed=args.failed, ranges=ranges,
+                                    blocks=[row - 1 for row in args.block], keep_selection=args.selected)
+            raise SystemExit(send_command(client, "run", app.store.selected_ranges(), app.plan_key["hash"]))
+
+        app.executor = Happl3RemoteExecutor(app, client)
+        # The daemon streams the log lines after those the view has indexed
+        client.send("follow", inode=app.log_view.inode, offset=app.log_view.scanned_size)
+        from happl3.happl3_search import Happl3SearchIndex, SEARCH_INDEX_SUFFIX
+        # The daemon updates the index if it was started with --search-index
+        if args.search_index or os.path.exists(f"{app.log_file}{SEARCH_INDEX_SUFFIX}"):
+            app.search_index = Happl3SearchIndex(app.log_file, read_only=True)
+        import curses
         curses.wrapper(app.run)
     finally:
-        # Close Happl3Shell session when app quits
-        app.shell_session.close_session()
+        client.close()
+
+def start_app(parser, args, log_file, session):
+    from happl3.happl3_app import Happl3
+    from happl3.happl3_scheduler import plan_nodes
+    app = Happl3(args.PlanFile, log_file, args.log_max_bytes, args.log_keep)
+    app.pipeline = args.pipeline
+    app.jobs = args.jobs
+    app.step_cache.max_bytes = args.cache_max_bytes
+    if args.search_index:
+        from happl3.happl3_search import Happl3SearchIndex
+        app.search_index = Happl3SearchIndex(app.log_file)
+    app.shell_session = session
+    session.add_setup(app.setup_commands())
+    if args.jobs > 1:
+        try:
+            plan_nodes(app.store)
+        except ValueError as e:
+            parser.error(str(e))
+        app.session_pool()  # Warm up the other sessions too
+    if args.targets:
+        from happl3.happl3_fanout import Happl3FanOut, load_targets
+        try:
+            targets = load_targets(args.targets)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        app.fanout = Happl3FanOut(app, targets, args.fanout, args.timeout)  # Starts the target sessions
+    return app
 
 if __name__ == "__main__":
     main()
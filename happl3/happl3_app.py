@@ -1,16 +1,49 @@
+import bisect
 import curses
 import os
 import json
 import sys
 import locale
 import select
+import shutil
+import threading
+import time
 from datetime import datetime
-import subprocess
-from .happl3_utils import hash_command
-from .happl3_shell import Happl3Shell
+from .happl3_shell import Happl3ShellError, plan_shell_type
+from .happl3_session import Happl3SessionManager, SETUP_ANNOTATION, SETUP_ANNOTATION_PATTERN, SETUP_PATTERNS
+from .happl3_logview import Happl3LogView, Happl3StreamedLogView
+from .happl3_segments import Happl3LogSegments, LOG_MAX_BYTES, LOG_KEEP_SEGMENTS
+from .happl3_help import HELP_MESSAGE
+from .happl3_artifacts import Happl3Artifacts, ARTIFACT_INDEX_SUFFIX
+from .happl3_journal import Happl3Journal
+from .happl3_cache import Happl3StepCache, INPUTS_ANNOTATION, step_fingerprint
+from .happl3_snapshot import save_snapshot, load_snapshot, file_signature, plan_key
+from .happl3_remap import remap_positions, changed_rows
+from .happl3_store import Happl3Store, IS_PENDING, IS_FAILED, IS_COMMAND, USAGE_METRICS
+from .happl3_screen import Happl3Screen
+from .happl3_stats import stats_lines, usage_summary, format_seconds
+from .happl3_executor import Happl3Executor
+from .happl3_watch import Happl3PlanWatcher
+from .happl3_search import Happl3LogSearch, compile_query, ERROR_LINE_PATTERN, SECTION_PATTERN, LOG_FILTERS
+
+# Journal records written before the index is compacted into a new snapshot
+INDEX_COMPACT_INTERVAL = 1000
+# Seconds between screen refreshes while a run is in progress
+OUTPUT_REDRAW_INTERVAL = 0.1
+# Seconds between checks for edits of the plan file while idle
+PLAN_CHECK_INTERVAL = 0.5
+# Marks of the row statuses in the command pane and the targets view
+STATUS_MARKS = {
+    "success": "✔",  # Checkmark
+    "failed": "✖",   # Cross
+    "pending": "⌛"   # Hourglass
+}
+# Largest total command text sent to the shell as one pipelined window
+PIPELINE_MAX_BYTES = 32 * 1024
 
 class Happl3:
-    def __init__(self, plan_file=None, log_file=None):
+    def __init__(self, plan_file=None, log_file=None, log_max_bytes=LOG_MAX_BYTES, log_keep=LOG_KEEP_SEGMENTS,
+                 attached=False):
         if plan_file is None:
             self.display_help()
             sys.exit(1)
@@ -18,82 +51,557 @@ class Happl3:
         self.plan_file = plan_file
         self.log_file = log_file if log_file else f"{plan_file}.log"
         self.index_file = f"{plan_file}.index"
-        self.commands = []
-        self.index_data = {}
+        self.snapshot_file = f"{plan_file}.snap"
+        self.log_max_bytes = log_max_bytes
+        self.log_keep = log_keep
+        self.attached = attached  # Viewing a plan that a daemon runs; the daemon writes the index and the log
+        self.record_lock = threading.Lock()  # Serializes log and index writes of parallel steps
+        self.pipeline = 1  # Commands sent to the shell per window, 1 runs them one at a time
+        self.jobs = 1  # Shell sessions running blocks in parallel, 1 runs the rows in plan order
+        self.journal = Happl3Journal(f"{self.index_file}.journal", read_only=attached)
+        self.store = Happl3Store()
         self.highlight = 0
         self.scroll_offset = 0
         self.log_scroll_offset = 0
         self.focus = "preview"
-        self.load_plan()
-        self.load_index()
+        self.output_mode = "log"  # "log", "stats", "output" (of output_row) or "targets" (of the highlighted row)
+        self.stats = None  # Rendered stats view, rebuilt after each step
+        self.plan_key = None  # Stat signature and hash of the plan text the store was built from
+        if not self.load_snapshot():
+            self.load_plan()
+            self.load_index()
+        # Attached, the daemon streams the lines appended to the log
+        self.log_view = Happl3StreamedLogView(self.log_file) if attached else Happl3LogView(self.log_file)
+        self.log_segments = Happl3LogSegments(self.log_file)  # Writer side of the log rotation
+        self.artifacts = Happl3Artifacts(f"{plan_file}.artifacts")
+        self.step_cache = Happl3StepCache(f"{plan_file}.cache")
+        self.output_view = None  # Happl3LogView over the output of output_row
+        self.output_row = None
+        self.output_target = None  # Target whose output of output_row is shown, None for a local run
         self.shell_session = None  # Initialize shell_session attribute
+        self.extra_sessions = []  # The other sessions of the pool when jobs > 1
+        self.fanout = None  # Happl3FanOut when the plan is applied to the targets of --targets
+        self.target_row = 0  # Target chosen in the targets view
+        self.executor = Happl3Executor(self)
+        self.run_message = ""  # State of the current or last run, shown in the output pane status bar
+        self.watcher = None  # Happl3PlanWatcher, started by run()
+        self.plan_changed = False  # The plan file changed during a run and is reloaded after it
+        self.setup_rows = None  # Rows of setup commands, for step fingerprints; reset when the plan changes
+        self.search_index = None  # Happl3SearchIndex of the log, with --search-index
+        self.search_text = None  # Query of the last / search
+        self.search_pane = None  # Pane searched last, "commands" or "log"; n/N move through its matches
+        self.command_matches = []  # Rows matching the search, ascending
+        self.log_search = None  # Happl3LogSearch of the log or output shown when the search started
+        self.search_line = None  # Match of log_search moved to last
+        self.search_jump = False  # Move to the first match log_search finds
+        self.log_filter = None  # None, "errors" or "failed"
+        self.filter_search = None  # Happl3LogSearch with the lines of the log the filter keeps
 
-    def display_help(self):
-        help_message = """
-        Usage:
-            happl3 <PlanFile> [LogFile]
+    @staticmethod
+    def display_help():
+        print(HELP_MESSAGE)
 
-        Parameters:
-            PlanFile: The file containing the migration plan (required)
-            LogFile: The file containing the log output (default to <PlanFile>.log)
+    @property
+    def commands(self):
+        """The plan commands, as a read-only sequence of strings backed by the store."""
+        return self.store
 
-        Description:
-            Happl3 is a tool to apply a series of powershell or bash/zsh shell commands from a plan file.
-            The plan is a text file containing a list of commands to be executed in sequence. The tool will
-            execute the commands in the plan in a user-controlled manner and log the output to a file. The
-            tool will also track the status of each command in the plan and allow the user to re-run failed commands.
-        """
-        print(help_message)
+    def read_plan(self):
+        """Return the stripped, non-empty lines of the plan file."""
+        with open(self.plan_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        self.plan_key = plan_key(st, data)
+        lines = [line.strip() for line in data.split(b'\n')]
+        return [line for line in lines if line]
 
     def load_plan(self):
-        with open(self.plan_file, 'r') as f:
-            self.commands = [line.strip() for line in f.readlines() if line.strip()]
-        with open(self.log_file, 'a') as log:
-            log.write(f"[{datetime.now()}] Loaded {len(self.commands)} commands from {self.plan_file}\n")
+        self.store = Happl3Store(self.read_plan())
+        self.log_message(f"Loaded {len(self.commands)} commands from {self.plan_file}")
+
+    def load_snapshot(self):
+        """Restore the store from the snapshot written by save_index(), if the plan and index are unchanged since.
+
+        This skips parsing and hashing the plan and the JSON index; only the
+        journal written after the snapshot is replayed. Returns False if
+        there is no usable snapshot.
+        """
+        snapshot = load_snapshot(self.snapshot_file, self.plan_file, self.index_file)
+        if snapshot is None:
+            return False
+        self.store, self.plan_key = snapshot
+        records = {}
+        self.journal.replay(records)
+        for key, entry in records.items():
+            i = int(key)
+            if i < len(self.store) and entry.get("hash") == self.store.digest(i).hex():
+                self.store.load_entry(i, entry)
+        self.log_message(f"Loaded {len(self.commands)} commands from {self.plan_file} (snapshot)")
+        self.highlight = self.find_next_pending(0)
+        return True
 
     def load_index(self):
         if os.path.exists(self.index_file):
             with open(self.index_file, 'r') as f:
-                self.index_data = json.load(f)
+                index_data = json.load(f)
         else:
-            self.index_data = {}
-        
-        # Ensure all commands have an entry in the index data
-        for i, cmd in enumerate(self.commands):
-            if str(i) not in self.index_data:
-                self.index_data[str(i)] = {
-                    "hash": hash_command(cmd),
-                    "selected": False,
-                    "status": "pending",
-                    "update_timestamp": None
-                }
-            else:
-                # Ensure the status is correctly set
-                self.index_data[str(i)]["hash"] = hash_command(cmd)
-                if "status" not in self.index_data[str(i)]:
-                    self.index_data[str(i)]["status"] = "pending"
-                if "selected" not in self.index_data[str(i)]:
-                    self.index_data[str(i)]["selected"] = False
-                if "update_timestamp" not in self.index_data[str(i)]:
-                    self.index_data[str(i)]["update_timestamp"] = None
+            index_data = {}
+        replayed = self.journal.replay(index_data)
+
+        # Entries are saved by position together with their command hash. If the plan
+        # was edited since, move each status to wherever its command is now.
+        hashes = self.store.digest_list()
+        old_entries = [index_data[key] for key in sorted(index_data, key=int)]
+        old_hashes = [bytes.fromhex(entry["hash"]) if "hash" in entry else hashes[i] if i < len(hashes) else None
+                      for i, entry in enumerate(old_entries)]
+        remapped = bool(old_entries) and old_hashes != hashes
+        mapping = range(len(hashes)) if old_hashes == hashes else remap_positions(old_hashes, hashes)
+
+        kept = 0
+        for i, old in enumerate(mapping):
+            if old is not None:
+                self.store.load_entry(i, old_entries[old])
+                kept += 1
+
+        if remapped:
+            self.log_message(f"Plan changed since the index was saved: kept status of {kept} commands, "
+                             f"{len(hashes) - kept} new or edited")
+
+        # Fold replayed journal records and remapped positions into a fresh snapshot
+        if replayed or remapped:
+            self.save_index()
 
         # Move highlight to the first pending row
         self.highlight = self.find_next_pending(0)
 
+    def reload_plan(self):
+        """Apply edits of the plan file while running, without touching the shell session.
+
+        Only the rows between the unchanged start and end of the plan are
+        rebuilt. Statuses within them are remapped like in load_index(), so
+        moved commands keep theirs. Returns False if the plan is unchanged.
+        """
+        try:
+            lines = self.read_plan()
+        except OSError:
+            return False  # Saved by renaming, the new file shows up with the next event
+        buffer = b"\n".join(lines)
+        if buffer == self.store.buffer:
+            return False
+        start, old_end, new_end = changed_rows(self.store.buffer, self.store.offsets, buffer, len(lines))
+        old_entries = [self.store.entry(i) for i in range(start, old_end)]
+        old_hashes = [self.store.digest(i) for i in range(start, old_end)]
+        self.store.splice(start, old_end, lines[start:new_end])
+        self.setup_rows = None
+        mapping = remap_positions(old_hashes, [self.store.digest(i) for i in range(start, new_end)])
+        kept = 0
+        for i, old in enumerate(mapping):
+            if old is not None:
+                self.store.load_entry(start + i, old_entries[old])
+                kept += 1
+        # Positions after the edit moved, so the journal is replaced by a new snapshot
+        self.save_index()
+
+        shift = new_end - old_end
+        if self.highlight >= old_end:
+            self.highlight += shift
+        self.highlight = max(0, min(self.highlight, len(self.store) - 1))
+        if self.output_row is not None and self.output_row >= start:
+            self.output_row = self.output_row + shift if self.output_row >= old_end else None
+            if self.output_row is None and self.output_mode == "output":
+                self.output_mode = "log"
+        self.stats = None
+        if self.search_pane == "commands":
+            self.command_matches = self.store.match_rows(compile_query(self.search_text)[0])
+        message = (f"Plan changed: rows {start + 1}-{old_end} replaced by {new_end - start} rows, "
+                   f"kept status of {kept}")
+        self.log_message(message)
+        self.run_message = message
+        return True
+
+    def check_plan(self):
+        """Reload the plan if it was edited, once no run is in progress. Returns True if it was reloaded."""
+        if self.watcher is not None and self.watcher.changed():
+            self.plan_changed = True
+        if self.plan_changed and not self.executor.running():
+            self.plan_changed = False
+            return self.reload_plan()
+        return False
+
     def save_index(self):
-        with open(self.index_file, 'w') as f:
-            json.dump(self.index_data, f, indent=2)
+        """Write a full snapshot of the index and truncate the journal."""
+        if self.attached:
+            return  # The daemon keeps the index
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            # json.dumps() runs entirely in the C encoder, json.dump() does not
+            f.write(json.dumps({str(i): self.store.entry(i) for i in range(len(self.store))}, separators=(",", ":")))
+        os.replace(tmp_file, self.index_file)
+        if self.plan_key is not None:
+            save_snapshot(self.snapshot_file, self.store, self.plan_key, file_signature(self.index_file))
+        self.journal.truncate()
+
+    def record_index(self, index, sync=True):
+        """Persist the entry for one row by appending it to the journal. With sync=False, call journal.sync() later
+        to make it survive a system crash."""
+        self.journal.append(str(index), self.store.entry(index), sync)
+        if self.journal.records >= INDEX_COMPACT_INTERVAL:
+            self.save_index()
 
     def is_pending(self, index):
         """Check if the row at index has 'pending' status."""
-        return self.index_data[str(index)]["status"] == "pending"
+        return self.store.status_name(index) == "pending"
 
     def find_next_pending(self, start_index):
         """Find the next row with 'pending' status starting from start_index."""
-        for i in range(start_index, len(self.commands)):
-            if self.is_pending(i) and not self.commands[i].startswith('#'):
-                return i
-        return len(self.commands) - 1  # Return last row if no pending found
+        i = self.store.find_status("pending", start_index)
+        return i if i >= 0 else len(self.store) - 1  # Return last row if no pending found
+
+    def select_all(self):
+        self.store.select_where(IS_COMMAND)
+
+    def select_none(self):
+        self.store.clear_selection()
+
+    def select_pending(self):
+        self.store.select_where(IS_PENDING)
+
+    def select_failed(self):
+        self.store.select_where(IS_FAILED)
+
+    def select_block(self, start_index):
+        """Select the pending rows from start_index up to the next comment row."""
+        end = self.store.find_comment(start_index)
+        self.store.select_where(IS_PENDING, start_index, end if end >= 0 else None, union=True)
+
+    def select_range(self, start_index, end_index):
+        """Select every command row in [start_index, end_index)."""
+        self.store.select_where(IS_COMMAND, start_index, end_index, union=True)
+
+    def shell_type(self):
+        return plan_shell_type(self.plan_file)
+
+    def is_declared_setup(self, index):
+        """True if the row above index is a #@setup annotation."""
+        return index > 0 and self.store.is_comment(index - 1) and self.commands[index - 1].strip() == SETUP_ANNOTATION
+
+    def is_setup(self, index):
+        """True if the command at index sets up the shell session, by its text or a #@setup annotation."""
+        command = self.commands[index].encode('utf-8', errors='replace')
+        return self.is_declared_setup(index) or SETUP_PATTERNS[self.shell_type()].match(command) is not None
+
+    def step_inputs(self, index):
+        """Inputs listed by an #@inputs: annotation in the comment rows right above index, or None."""
+        row = index - 1
+        while row >= 0 and self.store.is_comment(row):
+            text = self.commands[row].strip()
+            if text.startswith(INPUTS_ANNOTATION):
+                return text[len(INPUTS_ANNOTATION):].split()
+            row -= 1
+        return None
+
+    def lookup_step(self, index, session):
+        """Return (fingerprint, cache entry) for the step at index, or (None, None) if it is not memoized.
+
+        The setup commands above the step are part of its fingerprint, as they
+        shape the session it runs in. Setup commands themselves are never
+        taken from the cache, the session needs their effect. Input paths are
+        relative to the working directory of session, the one the step runs in.
+        """
+        inputs = self.step_inputs(index)
+        if inputs is None or not self.step_cache.max_bytes or self.is_setup(index):
+            return None, None
+        with self.record_lock:
+            if self.setup_rows is None:
+                rows = set(self.store.match_rows(SETUP_PATTERNS[self.shell_type()]))
+                rows.update(i + 1 for i in self.store.match_rows(SETUP_ANNOTATION_PATTERN) if i + 1 < len(self.store))
+                self.setup_rows = sorted(rows)
+            setup = [self.commands[i] for i in self.setup_rows[:bisect.bisect_left(self.setup_rows, index)]]
+        cwd = session.working_directory()
+        if cwd is None:
+            return None, None
+        fingerprint = step_fingerprint(self.store.digest(index), self.shell_type(), setup, inputs, cwd)
+        cached = self.step_cache.lookup(fingerprint)
+        if cached is not None and not self.artifacts.exists(cached["output"]):
+            cached = None
+        return fingerprint, cached
+
+    def remember_step(self, index, fingerprint):
+        """Store the successful run of the step at index in the step cache."""
+        output = self.store.output(index)
+        if output is None:
+            return
+        entry = self.store.entry(index)
+        self.step_cache.store(fingerprint, self.commands[index], output, entry.get("output_bytes", 0),
+                              entry.get("duration", 0.0))
+
+    def setup_commands(self):
+        """Commands that set up the shell session and already succeeded, in plan order, for replay."""
+        rows = set(self.store.match_rows(SETUP_PATTERNS[self.shell_type()]))
+        rows.update(i + 1 for i in self.store.match_rows(SETUP_ANNOTATION_PATTERN) if i + 1 < len(self.store))
+        return [self.commands[i] for i in sorted(rows) if self.store.status_name(i) == "success"]
+
+    def session_pool(self):
+        """The shell sessions that run blocks in parallel, shell_session first."""
+        if self.shell_session is None:
+            self.shell_session = Happl3SessionManager(self.shell_type())
+        while len(self.extra_sessions) < self.jobs - 1:
+            self.extra_sessions.append(self.shell_session.sibling())
+        return [self.shell_session] + self.extra_sessions[:self.jobs - 1]
+
+    def sessions(self):
+        """The shell sessions started so far."""
+        sessions = ([self.shell_session] if self.shell_session is not None else []) + self.extra_sessions
+        if self.fanout is not None:
+            sessions += list(self.fanout.sessions.values())
+        return sessions
+
+    def close_sessions(self):
+        for session in self.sessions():
+            session.close_session()
+
+    def run_step(self, index, on_output=None, session=None):
+        """Execute the command at index, log its output and record its new status.
+
+        Output is streamed to the log and, if given, to on_output(stream, text).
+        Returns the new status, "success" or "failed".
+
+        With session, the step runs in that session of the pool. Steps in
+        other sessions run at the same time, so the output is collected and
+        the log section is written in one piece when the step finished.
+        """
+        if self.fanout is not None:
+            return self.fanout.run_step(index, on_output)
+        if session is not None:
+            return self._run_pooled_step(index, on_output, session)
+        if self.shell_session is None:
+            self.shell_session = Happl3SessionManager(self.shell_type())
+        fingerprint, cached = self.lookup_step(index, self.shell_session)
+        if cached is not None:
+            return self._run_cached_step(index, on_output, cached)
+        self.rotate_log()
+        with open(self.log_file, 'a') as log:
+            log.write(f"\n[{datetime.now()}] > {self.commands[index]}\n")
+            log.flush()
+            output = self.artifacts.writer()
+
+            def write(stream, text):
+                log.write(text)
+                log.flush()
+                output.write(text)
+                if on_output:
+                    on_output(stream, text)
+
+            started = time.monotonic()
+            try:
+                if self.shell_session is None:
+                    self.shell_session = Happl3SessionManager(self.shell_type())
+                result = self.shell_session.run_command(self.commands[index], on_output=write,
+                                                        setup=True if self.is_declared_setup(index) else None)
+            except Exception as e:
+                return self.record_result(index, log, error=e, started=started, output=output)
+            status = self.record_result(index, log, result=result, output=output)
+        if fingerprint is not None and status == "success":
+            self.remember_step(index, fingerprint)
+        return status
+
+    def _run_pooled_step(self, index, on_output, session):
+        fingerprint, cached = self.lookup_step(index, session)
+        if cached is not None:
+            return self._run_cached_step(index, on_output, cached)
+        output = self.artifacts.writer()
+        header = f"\n[{datetime.now()}] > {self.commands[index]}\n"
+        started = time.monotonic()
+        result = error = None
+        try:
+            result = session.run_command(self.commands[index], on_output=lambda stream, text: output.write(text),
+                                         setup=True if self.is_declared_setup(index) else None)
+        except Exception as e:
+            error = e
+        with self.record_lock:
+            self.rotate_log()
+            with open(self.log_file, 'a') as log:
+                log.write(header)
+                output.copy_to(log)
+                status = self.record_result(index, log, result=result, error=error, started=started, output=output)
+        if fingerprint is not None and status == "success":
+            self.remember_step(index, fingerprint)
+        if on_output:
+            on_output("stdout", "")
+        return status
+
+    def _run_cached_step(self, index, on_output, cached):
+        """Satisfy the step at index from the step cache: log the cached output and record it as a success."""
+        started = time.monotonic()
+        with self.record_lock:
+            self.rotate_log()
+            with open(self.log_file, 'a') as log:
+                log.write(f"\n[{datetime.now()}] > {self.commands[index]}\n")
+                with open(self.artifacts.view_path(cached["output"]), 'r', encoding='utf-8', errors='replace') as f:
+                    shutil.copyfileobj(f, log)
+                status = self.record_result(index, log, started=started, cached=cached)
+        if on_output:
+            on_output("stdout", "")
+        return status
+
+    def log_message(self, text):
+        """Append a line from Happl3 itself to the log."""
+        if self.attached:
+            return
+        with self.record_lock:
+            with open(self.log_file, 'a') as log:
+                log.write(f"[{datetime.now()}] {text}\n")
+
+    def run_window(self, indices, on_output=None, on_status=None, stop_on_failure=True):
+        """Execute rows as one pipelined window, logging and recording each like run_step().
+
+        The log keeps one section per row: output of rows that are still
+        waiting for an earlier one only goes to their artifact until that
+        row finished, and is copied from there.
+        on_status(row, None) is called when a row starts and on_status(row,
+        status) when it finished. Rows skipped after a failure keep their
+        status. Returns the statuses of the rows that ran.
+        """
+        on_status = on_status if on_status else lambda row, status: None
+        if self.pipeline <= 1 or len(indices) == 1:
+            statuses = []
+            for index in indices:
+                on_status(index, None)
+                statuses.append(self.run_step(index, on_output))
+                on_status(index, statuses[-1])
+                if stop_on_failure and statuses[-1] == "failed":
+                    break
+            return statuses
+
+        self.rotate_log()
+        statuses = []
+        outputs = [self.artifacts.writer() for _ in indices]
+        step_started = [time.monotonic()]
+        with open(self.log_file, 'a') as log:
+
+            def begin(position):
+                step_started[0] = time.monotonic()
+                log.write(f"\n[{datetime.now()}] > {self.commands[indices[position]]}\n")
+                outputs[position].copy_to(log)
+                log.flush()
+                on_status(indices[position], None)
+
+            def write(position, stream, text):
+                outputs[position].write(text)
+                if position != len(statuses):
+                    return
+                log.write(text)
+                log.flush()
+                if on_output:
+                    on_output(stream, text)
+
+            def finished(position, result):
+                if result.skipped:
+                    return
+                # One fsync of the journal per window instead of per row
+                status = self.record_result(indices[position], log, result=result, sync=False,
+                                            output=outputs[position])
+                statuses.append(status)
+                on_status(indices[position], status)
+                if position + 1 < len(indices) and not (stop_on_failure and status == "failed"):
+                    begin(position + 1)
+
+            begin(0)
+            try:
+                if self.shell_session is None:
+                    self.shell_session = Happl3SessionManager(self.shell_type())
+                self.shell_session.run_window([self.commands[i] for i in indices], on_output=write,
+                                              on_result=finished, stop_on_failure=stop_on_failure,
+                                              setup=[True if self.is_declared_setup(i) else None for i in indices])
+            except Exception as e:
+                if len(statuses) < len(indices):
+                    index = indices[len(statuses)]
+                    statuses.append(self.record_result(index, log, error=e, started=step_started[0], sync=False,
+                                                       output=outputs[len(statuses)]))
+                    on_status(index, statuses[-1])
+            finally:
+                for output in outputs[len(statuses):]:
+                    output.discard()
+                self.journal.sync()
+        return statuses
+
+    def next_window(self, start):
+        """The selected rows from start on that the next call to run_window() should run."""
+        rows = []
+        size = 0
+        row = self.store.find_selected(start)
+        while row >= 0 and len(rows) < self.pipeline:
+            size += self.store.offsets[row + 1] - self.store.offsets[row]
+            # Memoized rows run in a window of their own, through run_step() and its cache lookup
+            memoized = self.step_inputs(row) is not None
+            if rows and (size > PIPELINE_MAX_BYTES or memoized):
+                break
+            rows.append(row)
+            if memoized:
+                break
+            row = self.store.find_selected(row + 1)
+        return rows
+
+    def record_result(self, index, log, result=None, error=None, started=None, sync=True, output=None, cached=None):
+        """Log how the step at index ended, from its result or the exception it raised, and store its new status.
+
+        output is the step's Happl3ArtifactWriter, which is closed and referenced from the index entry.
+        cached is the step cache entry the step was satisfied from instead of running it.
+        """
+        fields = self.store.extra.get(index, {})
+        fields.pop("cached", None)
+        if cached is not None:
+            new_status = "success"
+            log.write(f"✔ CACHED: inputs unchanged since the run at {cached['created']} "
+                      f"(took {cached['duration']:.3f}s)\n")
+            ended = time.monotonic()
+            self.store.set_metrics(index, started=started, ended=ended, duration=ended - started,
+                                   output_bytes=cached["output_bytes"], marker_latency=None, overhead=None)
+            self.store.set_output(index, cached["output"])
+            fields["cached"] = cached["created"]
+        elif result is not None:
+            new_status = "success" if result.succeeded else "failed"
+            if result.succeeded:
+                log.write("✔ SUCCESS\n")
+            else:
+                log.write(f"✖ FAILED: exit code {result.exit_code}\n")
+            self.store.set_metrics(index, started=result.started, ended=result.ended,
+                                   duration=result.duration, output_bytes=result.output_bytes,
+                                   marker_latency=result.marker_latency, overhead=result.overhead)
+        else:
+            if isinstance(error, Happl3ShellError):
+                log.write(f"✖ ERROR: {str(error)}\n")
+            else:
+                log.write(f"✖ ERROR: EXCEPTION: {str(error)}\n")
+            new_status = "failed"
+            ended = time.monotonic()
+            self.store.set_metrics(index, started=started, ended=ended, duration=ended - started,
+                                   output_bytes=None, marker_latency=None, overhead=None)
+        usage = result.usage if result is not None and cached is None else {}
+        self.store.set_metrics(index, **{name: usage.get(name) for name in USAGE_METRICS})
+        if fields:
+            self.store.extra[index] = fields
+        else:
+            self.store.extra.pop(index, None)
+        log.flush()
+        if output is not None:
+            try:
+                self.store.set_output(index, output.close())
+            except OSError:
+                self.store.set_output(index, None)
+        self.stats = None
+        self.store.set_status(index, new_status)
+        self.store.set_timestamp(index, time.time())
+        if new_status == "success":
+            self.store.set_selected(index, False)
+        self.record_index(index, sync)
+        return new_status
+
+    def rotate_log(self):
+        if self.log_max_bytes and self.log_segments.rotate(self.log_keep, self.log_max_bytes):
+            segment = self.log_segments.segments[-1]
+            with open(self.log_file, 'a') as log:
+                log.write(f"[{datetime.now()}] Rotated {segment['lines']} log lines into {segment['file']}\n")
 
     def run(self, stdscr):
         locale.setlocale(locale.LC_ALL, '')  # Ensure UTF-8 is used
@@ -109,20 +617,84 @@ class Happl3:
         curses.init_pair(6, curses.COLOR_BLUE, curses.COLOR_BLACK)   # Border
         curses.init_pair(7, curses.COLOR_WHITE, curses.COLOR_BLACK)  # Title
         curses.init_pair(8, curses.COLOR_RED, curses.COLOR_BLACK)    # Error
+        if hasattr(curses, "set_escdelay"):
+            curses.set_escdelay(25)  # Esc clears the search without the default second of delay
         self.stdscr.bkgd(' ', curses.color_pair(1))
 
-        self.max_y, self.max_x = stdscr.getmaxyx()
-        with open(self.log_file, 'a') as log:
-            log.write(f"Terminal size: {self.max_y} rows × {self.max_x} cols\n")
+        self.screen = Happl3Screen(stdscr, "Happl3 - The Happy Command Applier")
+        if not self.attached:
+            with open(self.log_file, 'a') as log:
+                log.write(f"Terminal size: {self.screen.max_y} rows × {self.screen.max_x} cols\n")
+            # Attached, the daemon watches the plan and tells when it reloaded it
+            self.watcher = Happl3PlanWatcher(self.plan_file)
 
         while True:
+            self.handle_events()
+            self.check_plan()
+            self.follow_searches()
             self.draw()
+            # Poll while a run is in progress so its output and status show up without a key press
+            stdscr.timeout(int((OUTPUT_REDRAW_INTERVAL if self.executor.running() else PLAN_CHECK_INTERVAL) * 1000))
             key = stdscr.getch()
-            if key == ord('q'):
+            if key == -1:
+                continue
+            elif key == ord('q'):
+                # Attached, quitting only detaches and the daemon carries on with the run
+                if self.executor.running() and not self.attached:
+                    self.executor.cancel()
+                    self.executor.wait()
+                    self.handle_events()
+                if self.watcher is not None:
+                    self.watcher.close()
                 break
+            elif key == curses.KEY_RESIZE:
+                curses.update_lines_cols()
+                self.screen.layout()
+                self.log_scroll_offset = min(self.log_scroll_offset, self.max_log_scroll())
+            elif key == ord('/'):
+                text = self.read_query()
+                if text:
+                    self.start_search(text)
+            elif key == 27:  # Esc
+                self.clear_search()
+            elif key in (ord('n'), ord('N')) and self.search_pane == ("commands" if self.focus == "preview" else "log"):
+                self.next_match(down=key == ord('n'))
+            elif key == ord('F') and self.output_mode == "log":
+                self.clear_search()
+                self.set_filter(LOG_FILTERS[(LOG_FILTERS.index(self.log_filter) + 1) % len(LOG_FILTERS)])
             elif key == 9:  # Tab key
                 self.focus = "log" if self.focus == "preview" else "preview"
+            elif key == ord('c'):
+                if self.executor.running():
+                    self.executor.cancel()
+            elif key == ord('w'):
+                if self.executor.running():
+                    self.executor.pause()
+            elif key == ord('s'):
+                self.output_mode = "stats" if self.output_mode != "stats" else "log"
+                self.stats = None
+                self.log_scroll_offset = 0
+            elif key == ord('o'):
+                if self.output_mode == "output":
+                    self.output_mode = "targets" if self.output_target is not None else "log"
+                    self.log_scroll_offset = 0
+                elif self.output_mode == "targets":
+                    self.open_target_output(self.highlight, self.target_row)
+                else:
+                    self.open_output(self.highlight)
+            elif key == ord('t') and self.fanout is not None:
+                self.output_mode = "targets" if self.output_mode != "targets" else "log"
+                self.log_scroll_offset = 0
+            elif self.focus == "log" and self.output_mode == "targets":
+                if key == curses.KEY_UP and self.target_row > 0:
+                    self.target_row -= 1
+                elif key == curses.KEY_DOWN and self.target_row < len(self.fanout.targets) - 1:
+                    self.target_row += 1
+                # Keep the chosen target on screen
+                height = self.screen.height("log")
+                self.log_scroll_offset = max(min(self.log_scroll_offset, self.target_row), self.target_row - height + 1)
             elif self.focus == "preview":
+                self.stats = None  # Selection changes move the ETA
                 if key == curses.KEY_UP and self.highlight > 0:
                     self.highlight -= 1
                 elif key == curses.KEY_DOWN and self.highlight < len(self.commands) - 1:
@@ -132,38 +704,28 @@ class Happl3:
                 elif key == curses.KEY_END or key == ord('E'):
                     self.highlight = len(self.commands) - 1
                 elif key == ord(' '):
-                    if not self.commands[self.highlight].startswith('#'):
-                        self.index_data[str(self.highlight)]["selected"] = not self.index_data[str(self.highlight)]["selected"]
+                    self.store.set_selected(self.highlight, not self.store.is_selected(self.highlight))
                     if self.highlight < len(self.commands) - 1:
                         self.highlight += 1
                 elif key == ord('a'):
-                    for i in range(len(self.commands)):
-                        if not self.commands[i].startswith('#'):
-                            self.index_data[str(i)]["selected"] = True
+                    self.select_all()
                 elif key == ord('n'):
-                    for i in range(len(self.commands)):
-                        self.index_data[str(i)]["selected"] = False
+                    self.select_none()
                 elif key == ord('p'):
-                    for i in range(len(self.commands)):
-                        self.index_data[str(i)]["selected"] = self.is_pending(i)
+                    self.select_pending()
                 elif key == ord('f'):
-                    for i in range(len(self.commands)):
-                        self.index_data[str(i)]["selected"] = self.index_data[str(i)]["status"] == "failed"
+                    self.select_failed()
                 elif key == ord('b'):
-                    for i in range(self.highlight, len(self.commands)):
-                        if self.commands[i].startswith('#'):
-                            break
-                        if self.is_pending(i):
-                            self.index_data[str(i)]["selected"] = True
-                elif key == ord('r'):
+                    self.select_block(self.highlight)
+                elif key == ord('r') and not self.executor.running() and not self.attached:
                     self.reset_files()
                 elif key == curses.KEY_ENTER or key == 10 or key == 13:
                     self.execute_selected()
             elif self.focus == "log":
-                if os.path.exists(self.log_file):
-                    with open(self.log_file, 'r') as f:
-                        lines = f.readlines()
-                    max_scroll = max(0, len(lines) - (self.max_y - (self.max_y - 1) // 2 - 2))
+                view = self.output_view if self.output_mode == "output" else self.log_view
+                view.refresh()
+                if view.line_count() or self.output_mode != "log":
+                    max_scroll = self.max_log_scroll()
                     if key == curses.KEY_UP and self.log_scroll_offset > 0:
                         self.log_scroll_offset -= 1
                     elif key == curses.KEY_DOWN and self.log_scroll_offset < max_scroll:
@@ -174,179 +736,369 @@ class Happl3:
                         self.log_scroll_offset = max_scroll
 
     def draw(self):
-        self.stdscr.clear()
-
-        # Calculate pane heights
-        cmd_height = (self.max_y - 3) // 2 - 1  # Adjust for title and borders
-        separator_row = cmd_height + 2
-        out_height = self.max_y - cmd_height - 4
-
-        # Check if the terminal window is large enough
-        if self.max_y < 10 or self.max_x < 40:
-            self.stdscr.addstr(0, 0, "Terminal window is too small. Please resize.", curses.color_pair(8))
-            self.stdscr.refresh()
+        screen = self.screen
+        if screen.too_small():
+            screen.refresh()
             return
 
-        # Draw application title
-        title = "Happl3 - The Happy Command Applier"
-        self.stdscr.addstr(0, 0, title, curses.color_pair(7) | curses.A_BOLD)
-
-        # Draw command pane
-        visible_lines = cmd_height - 1  # Adjust for navigation status bar
-        self.scroll_offset = max(0, min(self.highlight - visible_lines // 2, 
+        # Draw command pane. Only the visible rows are formatted, and the screen
+        # skips rows whose text and colour did not change since the last frame.
+        visible_lines = screen.height("commands")
+        self.scroll_offset = max(0, min(self.highlight - visible_lines // 2,
                                       len(self.commands) - visible_lines))
+        for row in range(visible_lines):
+            i = self.scroll_offset + row
+            if not self.commands and row == 0:
+                screen.put("commands", row, "No commands loaded", curses.color_pair(1))
+            elif i < len(self.commands):
+                screen.put("commands", row, *self.command_row(i, screen.width))
+            else:
+                screen.put("commands", row, "", curses.color_pair(1))
 
-        if not self.commands:
-            self.stdscr.addstr(2, 1, "No commands loaded", curses.color_pair(1))
+        # Draw navigation status bar with the row counter and plan file name in the lower right corner
+        help_text = "↑↓:navigate Space:select Enter:run c:cancel w:pause a:all n:none p:pending b:block f:failed r:reset s:stats o:output /:search F:filter Tab:switch H/E:top/bottom  q:quit"
+        if self.fanout is not None:
+            help_text = help_text.replace(" Tab:", " t:targets Tab:")
+        search_counter = ""
+        if self.search_pane == "commands":
+            search_counter = f"/{self.search_text} {len(self.command_matches)} | "
+        preview_row_counter = search_counter + f"{self.plan_file}{' (daemon)' if self.attached else ''} | Row {self.highlight + 1}/{len(self.commands)}"
+        screen.put_right("command_status", 0, help_text, preview_row_counter + " ",
+                         curses.color_pair(3), curses.color_pair(3))
+
+        # Draw output pane (reverse order, scrollable, no highlight).
+        # Only the lines that fit on screen are read from the log.
+        view = None
+        if self.output_mode == "stats":
+            stats = self.stats_view()
+            lines = stats[self.log_scroll_offset:self.log_scroll_offset + screen.height("log")]
+            output_name, output_count = "Stats", len(stats)
+        elif self.output_mode == "targets":
+            targets = self.targets_view(self.highlight)
+            lines = targets[self.log_scroll_offset:self.log_scroll_offset + screen.height("log")]
+            output_name, output_count = f"Targets of row {self.highlight + 1}", len(targets)
+        elif self.output_mode == "output":
+            view = self.output_view
+            view.refresh()
+            lines = self.output_view.tail_lines(self.log_scroll_offset, screen.height("log"))
+            output_name = f"Output of row {self.output_row + 1}"
+            if self.output_target is not None:
+                output_name += f" on {self.output_target}"
+            output_count = self.output_view.line_count()
         else:
-            for i in range(self.scroll_offset, 
-                         min(self.scroll_offset + visible_lines, len(self.commands))):
-                cmd = self.commands[i]
-                index = str(i)
-                status = self.index_data[index]["status"] if not cmd.startswith('#') else ""
-                selected = self.index_data[index]["selected"]
-                select_display = '[x]' if selected else '[ ]' if not cmd.startswith('#') else '   '
-                status_emoji = {
-                    "success": "✔",  # Checkmark
-                    "failed": "✖",   # Cross
-                    "pending": "⌛"   # Hourglass
-                }.get(status, "")
-                line = f"{i + 1:3} {select_display} {status_emoji:<2} {cmd[:self.max_x-25]}".ljust(self.max_x - 2)
-                row = i - self.scroll_offset + 2
-                if 0 <= row < cmd_height + 1:
-                    try:
-                        if i == self.highlight and self.focus == "preview":
-                            attr = curses.color_pair(2)
-                        elif cmd.startswith('#'):
-                            attr = curses.color_pair(5)  # Green for comments
-                        else:
-                            attr = curses.color_pair(1)
-                        self.stdscr.addstr(row, 1, line.encode('utf-8'), attr)
-                    except curses.error:
-                        break
-
-        # Draw navigation status bar
-        help_text = "↑↓:navigate Space:select Enter:run a:all n:none p:pending b:block f:failed r:reset Tab:switch H/E:top/bottom  q:quit"
-        self.stdscr.addstr(cmd_height + 1, 1, help_text[:self.max_x-2], curses.color_pair(3))
-
-        # Draw row counter and plan file name in the lower right corner of the preview pane
-        preview_row_counter = f"{self.plan_file} | Row {self.highlight + 1}/{len(self.commands)}"
-        self.stdscr.addstr(cmd_height + 1, self.max_x - len(preview_row_counter) - 2, preview_row_counter, curses.color_pair(3))
-
-        # Draw thick separator
-        separator = "═" * (self.max_x - 2)
-        self.stdscr.addstr(separator_row, 1, separator, curses.color_pair(4))
-
-        # Draw output pane (reverse order, scrollable, no highlight)
-        if os.path.exists(self.log_file):
-            with open(self.log_file, 'r') as f:
-                lines = f.readlines()
-                reversed_lines = lines[::-1]
-                start = self.log_scroll_offset
-                end = min(start + out_height, len(reversed_lines))
-                for i, line in enumerate(reversed_lines[start:end]):
-                    row = separator_row + 1 + i
-                    if row < self.max_y - 2:
-                        try:
-                            attr = curses.color_pair(8) if "ERROR:" in line or "EXCEPTION:" in line else curses.color_pair(1)
-                            self.stdscr.addstr(row, 1, line.encode('utf-8').rstrip(), attr)
-                        except curses.error:
-                            break
+            self.log_view.refresh()
+            if self.search_index is not None:
+                self.search_index.catch_up(self.log_view)
+            if self.filter_search is not None:
+                lines = self.filtered_lines(self.log_scroll_offset, screen.height("log"))
+                searching = "" if self.filter_search.done else ", searching..."
+                output_name = f"{self.log_file} [{self.log_filter}{searching}]"
+                output_count = self.filter_search.count()
+            else:
+                view = self.log_view
+                lines = view.tail_lines(self.log_scroll_offset, screen.height("log"))
+                output_name, output_count = self.log_file, view.line_count()
+        search = self.log_search if self.log_search is not None and self.log_search.view is view else None
+        for row in range(screen.height("log")):
+            line = lines[row].rstrip() if row < len(lines) else ""
+            attr = curses.color_pair(8) if "ERROR:" in line or "EXCEPTION:" in line or line.startswith("✖") else curses.color_pair(1)
+            if self.output_mode == "targets" and row == self.target_row - self.log_scroll_offset and self.focus == "log":
+                attr = curses.color_pair(2)
+            elif search is not None and row < len(lines):
+                number = output_count - 1 - self.log_scroll_offset - row
+                if number == self.search_line:
+                    attr = curses.color_pair(2)
+                elif search.contains(number):
+                    attr = curses.color_pair(4)
+            screen.put("log", row, line, attr)
 
         # Draw row number counter and log file name in the lower right corner of the log pane
-        log_row_counter = f"{self.log_file} | Row {self.log_scroll_offset + 1}/{len(lines)}"
-        self.stdscr.addstr(self.max_y - 2, self.max_x - len(log_row_counter) - 2, log_row_counter, curses.color_pair(3))
+        log_row_counter = f"{output_name} | Row {self.log_scroll_offset + 1}/{output_count}"
+        if search is not None:
+            searching = "" if search.done else "..."
+            log_row_counter = f"/{self.search_text} {search.count()}{searching} | {log_row_counter}"
+        screen.put_right("log_status", 0, self.run_status(), log_row_counter + " ",
+                         curses.color_pair(4), curses.color_pair(3))
 
-        # Draw single line blue border around the perimeter of each pane
-        for y in range(1, self.max_y - 1):
-            try:
-                self.stdscr.addch(y, 0, curses.ACS_VLINE, curses.color_pair(6))
-                self.stdscr.addch(y, self.max_x - 1, curses.ACS_VLINE, curses.color_pair(6))
-            except curses.error:
-                pass
-        for x in range(self.max_x):
+        screen.refresh()
+
+    def command_row(self, i, width):
+        """Return the text and attribute of command pane row i."""
+        cmd = self.store[i]
+        is_comment = self.store.is_comment(i)
+        status = self.store.status_name(i) if not is_comment else ""
+        select_display = '[x]' if self.store.is_selected(i) else '[ ]' if not is_comment else '   '
+        status_emoji = STATUS_MARKS.get(status, "")
+        # Resources used by the last run, or the targets by status, right-aligned where the pane is wide enough
+        if self.fanout is not None and not is_comment:
+            counts = self.fanout.summary(i)
+            usage = f"✔ {counts['success']:>3} ✖ {counts['failed']:>3} ⌛ {counts['pending']:>3}" if width >= 60 else ""
+        else:
+            usage = usage_summary(self.store, i) if width >= 100 and not is_comment else ""
+        reserved = len(usage) + 2 if usage else 0
+        line = f"{i + 1:3} {select_display} {status_emoji:<2} {cmd[:width - 23 - reserved]}".ljust(width - len(usage))
+        line += usage
+        if i == self.highlight and self.focus == "preview":
+            attr = curses.color_pair(2)
+        elif self.search_pane == "commands" and self.is_command_match(i):
+            attr = curses.color_pair(4)
+        elif is_comment:
+            attr = curses.color_pair(5)  # Green for comments
+        else:
+            attr = curses.color_pair(1)
+        return line, attr
+
+    def stats_view(self):
+        if self.stats is None or self.stats[0] != self.screen.width:
+            self.stats = (self.screen.width, stats_lines(self.store, self.screen.width))
+        return self.stats[1]
+
+    def targets_view(self, index):
+        """Lines of the targets view: the result of the row at index on every target."""
+        results = self.fanout.results(index)
+        lines = []
+        for target in self.fanout.targets:
+            result = results.get(target.name, {})
+            status = result.get("status", "pending")
+            text = f"{STATUS_MARKS[status]} {target.name:<20} {status:<8}"
+            if "duration" in result:
+                exit_code = result.get("exit_code")
+                text += (f" {format_seconds(result['duration']):>9}  exit {'-' if exit_code is None else exit_code:<4}"
+                         f" {result.get('update_timestamp', '')}")
+            lines.append(text)
+        return lines
+
+    def open_target_output(self, index, target_row):
+        """Show the output of the row at index on the target at target_row of the targets view."""
+        target = self.fanout.targets[target_row]
+        digest = self.fanout.results(index).get(target.name, {}).get("output")
+        if digest is None or not self.artifacts.exists(digest):
+            self.run_message = f"No output recorded for row {index + 1} on {target.name}"
+            return
+        path = self.artifacts.view_path(digest)
+        self.output_view = Happl3LogView(path, f"{path}{ARTIFACT_INDEX_SUFFIX}", read_only=self.attached)
+        self.output_row = index
+        self.output_target = target.name
+        self.output_mode = "output"
+        self.log_scroll_offset = 0
+
+    def max_log_scroll(self):
+        if self.output_mode == "stats":
+            return max(0, len(self.stats_view()) - self.screen.height("log"))
+        if self.output_mode == "targets":
+            return max(0, len(self.fanout.targets) - self.screen.height("log"))
+        if self.output_mode == "output":
+            return max(0, self.output_view.line_count() - self.screen.height("log"))
+        if self.filter_search is not None:
+            return max(0, self.filter_search.count() - self.screen.height("log"))
+        return max(0, self.log_view.line_count() - self.screen.height("log"))
+
+    def open_output(self, index):
+        """Show the latest output of the command at index in the output pane."""
+        digest = self.store.output(index)
+        if digest is None or not self.artifacts.exists(digest):
+            self.run_message = f"No output recorded for row {index + 1}"
+            return
+        path = self.artifacts.view_path(digest)
+        self.output_view = Happl3LogView(path, f"{path}{ARTIFACT_INDEX_SUFFIX}", read_only=self.attached)
+        self.output_row = index
+        self.output_target = None
+        self.output_mode = "output"
+        self.log_scroll_offset = 0
+
+    def read_query(self):
+        """Read a search query in the status bar of the focused pane. Returns None if Esc cancels it."""
+        region = "command_status" if self.focus == "preview" else "log_status"
+        text = ""
+        self.stdscr.timeout(int(OUTPUT_REDRAW_INTERVAL * 1000))
+        while True:
+            self.handle_events()
+            self.draw()
+            self.screen.put_right(region, 0, f"/{text}", "Enter:search Esc:cancel ",
+                                  curses.color_pair(3), curses.color_pair(3))
+            self.screen.refresh()
             try:
-                self.stdscr.addch(1, x, curses.ACS_HLINE, curses.color_pair(6))
-                self.stdscr.addch(self.max_y - 1, x, curses.ACS_HLINE, curses.color_pair(6))
+                key = self.stdscr.get_wch()
             except curses.error:
-                pass
-        try:
-            self.stdscr.addch(1, 0, curses.ACS_ULCORNER, curses.color_pair(6))
-            self.stdscr.addch(1, self.max_x - 1, curses.ACS_URCORNER, curses.color_pair(6))
-            self.stdscr.addch(self.max_y - 1, 0, curses.ACS_LLCORNER, curses.color_pair(6))
-            self.stdscr.addch(self.max_y - 1, self.max_x - 1, curses.ACS_LRCORNER, curses.color_pair(6))
-        except curses.error:
-            pass
+                continue  # No key within the timeout
+            if key in ("\n", "\r") or key == curses.KEY_ENTER:
+                return text
+            elif key == "\x1b":
+                return None
+            elif key in (curses.KEY_BACKSPACE, "\x7f", "\b"):
+                text = text[:-1]
+            elif key == curses.KEY_RESIZE:
+                curses.update_lines_cols()
+                self.screen.layout()
+            elif isinstance(key, str) and key.isprintable():
+                text += key
+
+    def start_search(self, text):
+        """Search the focused pane for text, a regular expression or plain text, and move to the first match."""
+        pattern, literal = compile_query(text)
+        self.clear_search()
+        self.search_text = text
+        if self.focus == "preview":
+            self.search_pane = "commands"
+            self.command_matches = self.store.match_rows(pattern)
+            self.next_match(from_current=True)
+            return
+        if self.output_mode not in ("log", "output"):
+            self.run_message = "Only the log and the output of a row can be searched"
+            self.search_text = None
+            return
+        self.set_filter(None)
+        view = self.output_view if self.output_mode == "output" else self.log_view
+        self.search_pane = "log"
+        self.log_search = Happl3LogSearch(view, pattern, literal, self.search_index if view is self.log_view else None)
+        self.search_jump = True
+
+    def clear_search(self):
+        if self.log_search is not None:
+            self.log_search.cancel()
+        self.search_text = self.search_pane = self.log_search = self.search_line = None
+        self.command_matches = []
+        self.search_jump = False
+
+    def is_command_match(self, i):
+        j = bisect.bisect_left(self.command_matches, i)
+        return j < len(self.command_matches) and self.command_matches[j] == i
 
-        self.stdscr.noutrefresh()
-        curses.doupdate()
+    def next_match(self, down=True, from_current=False):
+        """Move to the next match down the searched pane, or up, wrapping around. Returns False if there is none.
+
+        In the output pane, the newest line is at the top, so down is back in
+        time. from_current moves to the match at the current position, if any.
+        """
+        if self.search_pane == "commands":
+            rows = self.command_matches
+            if not rows:
+                self.run_message = f"Not found: {self.search_text}"
+                return False
+            if down:
+                j = (bisect.bisect_left if from_current else bisect.bisect_right)(rows, self.highlight)
+                self.highlight = rows[j] if j < len(rows) else rows[0]
+            else:
+                self.highlight = rows[bisect.bisect_left(rows, self.highlight) - 1]
+            return True
+        search = self.log_search
+        if search.view is not {"log": self.log_view, "output": self.output_view}.get(self.output_mode):
+            self.run_message = "The search is of another view, / searches this one"
+            return False
+        total = search.view.line_count()
+        height = self.screen.height("log")
+        top = total - 1 - self.log_scroll_offset
+        # From the last match while it is on screen, from the top line otherwise
+        if from_current or self.search_line is None or not top - height < self.search_line <= top:
+            current = top + 1 if down else top - height
+        else:
+            current = self.search_line
+        line = search.older(current) if down else search.newer(current)
+        if line is None and search.done and search.count():
+            line = search.line(0) if down else search.line(search.count() - 1)
+        if line is None:
+            self.run_message = f"Not found: {self.search_text}" if search.done else "Searching..."
+            return False
+        self.search_line = line
+        self.log_scroll_offset = max(0, min(total - 1 - line, self.max_log_scroll()))
+        return True
+
+    def set_filter(self, name):
+        """Show only the lines of the log that the filter keeps: "errors", "failed" or None for all of them."""
+        if self.filter_search is not None:
+            self.filter_search.cancel()
+        self.log_filter = name
+        self.filter_search = None
+        if name == "errors":
+            self.filter_search = Happl3LogSearch(self.log_view, ERROR_LINE_PATTERN)
+        elif name == "failed":
+            self.filter_search = Happl3LogSearch(self.log_view, SECTION_PATTERN, sections=True)
+        self.log_scroll_offset = 0
+
+    def filtered_lines(self, offset, count):
+        """Return up to count of the lines the filter keeps in reverse order, skipping the newest offset lines."""
+        search = self.filter_search
+        numbers = [search.line(i) for i in range(offset, min(offset + count, search.count()))]
+        lines = []
+        i = 0
+        while i < len(numbers):
+            j = i + 1  # Consecutive lines are read at once
+            while j < len(numbers) and numbers[j] == numbers[j - 1] - 1:
+                j += 1
+            lines += self.log_view.get_lines(numbers[j - 1], j - i)[::-1]
+            i = j
+        return lines
+
+    def follow_searches(self):
+        """Search what was appended to the log, and move to the first match of a new search once it is found."""
+        if self.log_search is not None:
+            self.log_search = self.log_search.follow()
+            if self.search_jump and (self.log_search.count() or self.log_search.done):
+                self.search_jump = not self.next_match(from_current=True) and not self.log_search.done
+        if self.filter_search is not None:
+            self.filter_search = self.filter_search.follow()
+
+    def prune_artifacts(self):
+        """Remove the outputs that neither a row of the index, one of its targets nor the step cache refers to."""
+        target_outputs = {result["output"] for fields in self.store.extra.values()
+                          for result in fields.get("targets", {}).values() if "output" in result}
+        self.artifacts.prune(({self.store.output(i) for i in range(len(self.store))} - {None})
+                             | target_outputs | self.step_cache.outputs())
 
     def execute_selected(self):
-        shell = "pwsh" if self.plan_file.endswith('.ps1') else "bash"
-        executed = False
-        selected_count = sum(1 for i in range(len(self.commands)) if self.index_data[str(i)]["selected"])
-
-        # Move highlight to the first selected row
-        for i in range(len(self.commands)):
-            if self.index_data[str(i)]["selected"]:
-                self.highlight = i
-                break
+        """Start running the selected rows in the background, beginning with the first selected row."""
+        if self.store.find_selected(0) >= 0:
+            self.executor.start(0)
 
-        current_index = self.highlight
-        error_occurred = False
-
-        while current_index < len(self.commands):
-            if self.index_data[str(current_index)]["selected"] and not self.commands[current_index].startswith('#'):
-                hash_key = hash_command(self.commands[current_index])
-                with open(self.log_file, 'a') as log:
-                    log.write(f"\n[{datetime.now()}] > {self.commands[current_index]}\n")
-                    try:
-                        if self.shell_session is None:
-                            self.shell_session = Happl3Shell(shell)
-                        result = self.shell_session.run_command(self.commands[current_index])
-                        log.write(result + "\n")
-                        new_status = "success"
-                        status_emoji = "✔" if new_status == "success" else "✖"
-                        log.write(f"{status_emoji} {new_status.upper()}\n")
-                        self.index_data[str(current_index)]["status"] = new_status
-                        self.index_data[str(current_index)]["update_timestamp"] = datetime.now().isoformat()
-                        if new_status == "success":
-                            self.index_data[str(current_index)]["selected"] = False
-                        executed = True
-                        if new_status == "failed":
-                            error_occurred = True
-                            break
-                    except subprocess.CalledProcessError as e:
-                        log.write(f"✖ ERROR: CalledProcessError: {str(e)}\n")
-                        self.index_data[str(current_index)]["status"] = "failed"
-                        self.index_data[str(current_index)]["update_timestamp"] = datetime.now().isoformat()
-                        executed = True
-                        error_occurred = True
-                        break
-                    except Exception as e:
-                        log.write(f"✖ ERROR: EXCEPTION: {str(e)}\n")
-                        self.index_data[str(current_index)]["status"] = "failed"
-                        self.index_data[str(current_index)]["update_timestamp"] = datetime.now().isoformat()
-                        executed = True
-                        error_occurred = True
-                        break
-                self.save_index()
-                self.draw()  # Redraw to update the status emojis
-            current_index += 1
-
-            # Move highlight to the next selected row or next pending row if no more selected rows
-            if not error_occurred:
-                for i in range(current_index, len(self.commands)):
-                    if self.index_data[str(i)]["selected"]:
-                        self.highlight = i
-                        current_index = i  # Adjust current_index to continue from the next row
-                        break
-                else:
-                    # start looking for next pending at the current_index
+    def handle_events(self):
+        """Apply the progress events posted by the executor since the last call and return them."""
+        last_row = self.highlight
+        events = self.executor.take_events()
+        for event in events:
+            if event[0] == "started":
+                self.highlight = event[1]
+            elif event[0] == "finished":
+                last_row = event[1]
+                self.stats = None
+            elif event[0] == "stopped":
+                reason = event[1]
+                if reason == "done":
                     self.highlight = self.find_next_pending(self.highlight)
+                    self.run_message = "Run finished"
+                elif reason == "paused":
+                    next_selected = self.store.find_selected(last_row + 1)
+                    if next_selected >= 0:
+                        self.highlight = next_selected
+                    self.run_message = "Paused, Enter continues"
+                elif reason == "failed":
+                    self.run_message = f"Stopped at failed row {self.executor.failed_row + 1}"
+                elif reason == "cancelled":
+                    self.run_message = "Cancelled"
+                else:
+                    self.run_message = f"Run stopped: {reason}"
+        return events
 
-        if executed:
-            self.draw()
+    def run_status(self):
+        executor = self.executor
+        if not executor.running():
+            return f" {self.run_message}" if self.run_message else ""
+        started, current = executor.step_started, executor.current
+        if started is None or current is None:
+            return " Stopping..."
+        rows = f"row {current + 1}"
+        steps = dict(executor.steps)
+        if len(steps) > 1:  # Blocks running in parallel
+            started = min(steps.values())
+            rows = "rows " + ", ".join(str(row + 1) for row in sorted(steps))
+        elapsed = int(time.monotonic() - started)
+        status = f" Running {rows} for {elapsed // 60}:{elapsed % 60:02}"
+        if self.plan_changed:
+            status += ", plan changed (reloads after the run)"
+        if executor.cancel_requested:
+            return status + ", cancelling..."
+        if executor.pause_requested:
+            return status + ", pausing after this step"
+        return status + "  c:cancel w:pause"
 
     def reset_files(self):
         self.stdscr.clear()
@@ -354,13 +1106,23 @@ class Happl3:
         self.stdscr.refresh()
         key = self.stdscr.getch()
         if key == ord('Y') or key == ord('y'):
-            os.rename(self.log_file, f"{self.log_file}.bak{datetime.now().strftime('%Y%m%d%H%M%S')}")
-            os.rename(self.index_file, f"{self.index_file}.bak{datetime.now().strftime('%Y%m%d%H%M%S')}")
+            backup_suffix = f".bak{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            os.rename(self.log_file, f"{self.log_file}{backup_suffix}")
+            self.log_segments.archive(backup_suffix)
+            self.artifacts.archive(backup_suffix)
+            self.output_mode = "log"
+            self.clear_search()
+            self.set_filter(None)
+            # The snapshot may not exist yet when all changes are still in the journal
+            if os.path.exists(self.index_file):
+                os.rename(self.index_file, f"{self.index_file}{backup_suffix}")
+            self.journal.truncate()
             with open(self.log_file, 'w') as log:
                 log.write(f"[{datetime.now()}] Log file reset\n")
-            self.index_data = {}
+            self.load_plan()
+            self.setup_rows = None
             self.save_index()
             self.load_index()
-            self.draw()
-        else:
-            self.draw()
\ No newline at end of file
+            self.stats = None
+        self.screen.invalidate()
+        self.draw()
\ No newline at end of file
@@ -0,0 +1,220 @@
+import os
+import hashlib
+import shutil
+import tempfile
+import threading
+
+ARTIFACT_INDEX_SUFFIX = ".lidx"
+# Outputs up to this size are kept in memory and appended to the pack, larger ones get their own file
+PACK_MAX_OUTPUT = 64 * 1024
+PACK_INDEX_FILE = "pack.idx"
+
+
+class Happl3ArtifactWriter:
+    """Collects the output of one step while hashing it.
+
+    Output is held in memory until it grows beyond PACK_MAX_OUTPUT, from
+    then on it is streamed to a temporary file, so memory stays bounded.
+    """
+
+    def __init__(self, artifacts):
+        self.artifacts = artifacts
+        self.chunks = []
+        self.file = None
+        self.tmp_file = None
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, text):
+        data = text.encode('utf-8', errors='replace')
+        self.hash.update(data)
+        self.size += len(data)
+        if self.file is not None:
+            self.file.write(data)
+            return
+        self.chunks.append(data)
+        if self.size > PACK_MAX_OUTPUT:
+            os.makedirs(self.artifacts.directory, exist_ok=True)
+            fd, self.tmp_file = tempfile.mkstemp(prefix=".tmp", dir=self.artifacts.directory)
+            self.file = os.fdopen(fd, 'wb')
+            self.file.write(b"".join(self.chunks))
+            self.chunks = None
+
+    def copy_to(self, out):
+        """Write the output so far to the text file out."""
+        if self.file is None:
+            out.write(b"".join(self.chunks).decode('utf-8', errors='replace'))
+            return
+        self.file.flush()
+        with open(self.tmp_file, 'r', encoding='utf-8', errors='replace') as f:
+            shutil.copyfileobj(f, out)
+
+    def close(self):
+        """Store the output under its content address and return its digest."""
+        digest = self.hash.hexdigest()
+        if self.file is None:
+            self.artifacts.add(digest, b"".join(self.chunks))
+        else:
+            self.file.close()
+            self.artifacts.add_file(digest, self.tmp_file)
+        return digest
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.tmp_file)
+
+
+class Happl3Artifacts:
+    """Content-addressed store of the output of each step, in <plan>.artifacts.
+
+    Every output is stored once under its SHA-256 digest. Small outputs are
+    appended to a pack file and found by the offset recorded for them in
+    pack.idx, whose first line names the pack file; outputs larger than
+    PACK_MAX_OUTPUT get their own file <digest[:2]>/<digest[2:]>. The index
+    entry of a row refers to the digest of its latest output, so showing it
+    is a single seek. Outputs no longer referred to are removed by prune().
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pack_index_file = os.path.join(directory, PACK_INDEX_FILE)
+        self.pack_name = None
+        self.packed = None  # Digest -> (offset, length) in the pack, loaded on first use
+        self.pack = None
+        self.pack_index = None
+        self.lock = threading.Lock()
+
+    def path(self, digest):
+        """Path of an output stored in its own file."""
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def writer(self):
+        return Happl3ArtifactWriter(self)
+
+    def _load(self):
+        if self.packed is not None:
+            return
+        self.packed = {}
+        self.pack_name = "pack-1"
+        try:
+            with open(self.pack_index_file, 'r') as f:
+                self.pack_name = f.readline().strip()
+                size = os.path.getsize(os.path.join(self.directory, self.pack_name))
+                for line in f:
+                    fields = line.split()
+                    # Records written just before a crash may point past the end of the pack
+                    if len(fields) == 3 and int(fields[1]) + int(fields[2]) <= size:
+                        self.packed[fields[0]] = (int(fields[1]), int(fields[2]))
+        except (OSError, ValueError):
+            pass
+
+    def _close_pack(self):
+        for f in (self.pack, self.pack_index):
+            if f is not None:
+                f.close()
+        self.pack = self.pack_index = None
+
+    def add(self, digest, data):
+        """Append data to the pack unless an output with this digest is stored already."""
+        with self.lock:
+            self._load()
+            if digest in self.packed or os.path.exists(self.path(digest)):
+                return
+            if self.pack is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.pack = open(os.path.join(self.directory, self.pack_name), 'ab')
+                self.pack_index = open(self.pack_index_file, 'a')
+                if not self.pack_index.tell():
+                    self.pack_index.write(f"{self.pack_name}\n")
+            offset = self.pack.seek(0, os.SEEK_END)
+            self.pack.write(data)
+            self.pack.flush()
+            self.pack_index.write(f"{digest} {offset} {len(data)}\n")
+            self.pack_index.flush()
+            self.packed[digest] = (offset, len(data))
+
+    def add_file(self, digest, tmp_file):
+        """Move tmp_file to the file of digest, or drop it if that output is stored already."""
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(tmp_file)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_file, path)
+
+    def exists(self, digest):
+        with self.lock:
+            self._load()
+            return digest in self.packed or os.path.exists(self.path(digest))
+
+    def view_path(self, digest):
+        """Path of a file holding the output, copying a packed output to its own file first."""
+        path = self.path(digest)
+        with self.lock:
+            self._load()
+            if os.path.exists(path) or digest not in self.packed:
+                return path
+            offset, length = self.packed[digest]
+            with open(os.path.join(self.directory, self.pack_name), 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+        return path
+
+    def prune(self, digests):
+        """Remove the outputs whose digest is not in digests. Returns the number removed.
+
+        The pack is rewritten once less than half of it is still referred to.
+        """
+        removed = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for prefix in names:
+            subdirectory = os.path.join(self.directory, prefix)
+            if not os.path.isdir(subdirectory):
+                continue
+            for name in os.listdir(subdirectory):
+                is_index = name.endswith(ARTIFACT_INDEX_SUFFIX)
+                digest = prefix + (name[:-len(ARTIFACT_INDEX_SUFFIX)] if is_index else name)
+                if digest not in digests:
+                    os.remove(os.path.join(subdirectory, name))
+                    removed += not is_index
+
+        with self.lock:
+            self._load()
+            for name in names:
+                if name.startswith("pack-") and name != self.pack_name:
+                    os.remove(os.path.join(self.directory, name))  # Left over from an interrupted rewrite
+            kept = {digest: place for digest, place in self.packed.items() if digest in digests}
+            if sum(length for _, length in kept.values()) * 2 >= sum(length for _, length in self.packed.values()):
+                return removed
+            self._close_pack()
+            old_file = os.path.join(self.directory, self.pack_name)
+            new_name = f"pack-{int(self.pack_name[5:]) + 1}"
+            with open(old_file, 'rb') as old, open(os.path.join(self.directory, new_name), 'wb') as pack, \
+                    open(f"{self.pack_index_file}.tmp", 'w') as pack_index:
+                pack_index.write(f"{new_name}\n")
+                for digest, (offset, length) in sorted(kept.items(), key=lambda item: item[1][0]):
+                    old.seek(offset)
+                    pack_index.write(f"{digest} {pack.tell()} {length}\n")
+                    pack.write(old.read(length))
+            # Replacing the index switches to the new pack in one step
+            os.replace(f"{self.pack_index_file}.tmp", self.pack_index_file)
+            os.remove(old_file)
+            removed += len(self.packed) - len(kept)
+            self.packed = None
+        return removed
+
+    def archive(self, suffix):
+        """Rename the store with suffix and start an empty one."""
+        with self.lock:
+            self._close_pack()
+            self.packed = None
+            if os.path.exists(self.directory):
+                os.rename(self.directory, f"{self.directory}{suffix}")
@@ -0,0 +1,152 @@
+import sys
+import json
+import time
+from datetime import datetime
+from .happl3_store import IS_PENDING, IS_FAILED, USAGE_METRICS
+from .happl3_scheduler import Happl3Scheduler
+
+# Process exit codes for batch runs
+EXIT_SUCCESS = 0
+EXIT_STEP_FAILED = 1
+
+
+def parse_row_range(text):
+    """Parse a 1-based inclusive row range such as "5", "5-20" or "5-" into a 0-based [start, end) pair."""
+    start, sep, end = text.partition('-')
+    try:
+        first = int(start)
+        last = int(end) if end else None
+    except ValueError:
+        raise ValueError(f"invalid row range: {text}")
+    if first < 1 or (last is not None and last < first):
+        raise ValueError(f"invalid row range: {text}")
+    if not sep:
+        last = first
+    return first - 1, last if last is not None else sys.maxsize
+
+
+class Happl3Batch:
+    """Runs a plan without curses, reusing Happl3's plan, index and shell handling."""
+
+    def __init__(self, app, fail_fast=True, quiet=False):
+        self.app = app
+        self.fail_fast = fail_fast
+        self.quiet = quiet
+
+    def select(self, pending=False, failed=False, ranges=(), blocks=(), keep_selection=False):
+        """Replace the stored selection with the rows matched by the selection flags.
+
+        Without any flag the pending rows are selected. keep_selection uses the
+        selection saved by the last interactive session instead.
+        """
+        if keep_selection:
+            return
+        app = self.app
+        app.select_none()
+        if not (pending or failed or ranges or blocks):
+            pending = True
+        if pending:
+            app.store.select_where(IS_PENDING, union=True)
+        if failed:
+            app.store.select_where(IS_FAILED, union=True)
+        for start, end in ranges:
+            app.select_range(start, end)
+        for row in blocks:
+            app.select_block(self.block_start(row))
+
+    def block_start(self, index):
+        """Return the first row of the block containing index, or of the block a comment row introduces."""
+        store = self.app.store
+        if store.is_comment(index):
+            while index < len(store) - 1 and store.is_comment(index):
+                index += 1
+            return index
+        while index > 0 and not store.is_comment(index - 1):
+            index -= 1
+        return index
+
+    def progress(self, message):
+        if not self.quiet:
+            print(message, file=sys.stderr, flush=True)
+
+    def run(self):
+        """Execute the selected rows and return a summary dict.
+
+        The rows run in order, or block by block in parallel when app.jobs > 1.
+        """
+        app = self.app
+        rows = app.store.selected_rows()
+        started = time.monotonic()
+        steps = []
+        step_started = {}
+
+        def step_status(i, status):
+            if status is None:
+                step_started[i] = time.monotonic()
+                self.progress(f"[{len(steps) + len(step_started)}/{len(rows)}] row {i + 1}: {app.commands[i]}")
+                return
+            entry = app.store.entry(i)
+            steps.append({
+                "row": i + 1,
+                "command": app.commands[i],
+                "status": status,
+                "duration": round(time.monotonic() - step_started.pop(i), 6),
+                "output_bytes": entry.get("output_bytes"),
+                "overhead": entry.get("overhead"),
+                "output": entry.get("output"),
+                "cached": "cached" in entry,
+                **{name: entry.get(name) for name in USAGE_METRICS},
+            })
+            if app.fanout is not None:
+                steps[-1]["targets"] = {target.name: entry.get("targets", {}).get(target.name, {"status": "pending"})
+                                        for target in app.fanout.targets}
+            if status == "failed":
+                failed_targets = [name for name, result in steps[-1].get("targets", {}).items()
+                                  if result["status"] == "failed"]
+                self.progress(f"✖ row {i + 1} failed" + (f" on {', '.join(failed_targets)}" if failed_targets else ""))
+
+        blocks = None
+        if app.jobs > 1:
+            scheduler = Happl3Scheduler(app, app.session_pool(), stop_on_failure=self.fail_fast, on_status=step_status)
+            scheduler.run()
+            blocks = scheduler.summary()
+        else:
+            window = app.next_window(rows[0]) if rows else []
+            while window:
+                statuses = app.run_window(window, on_status=step_status, stop_on_failure=self.fail_fast)
+                if self.fail_fast and "failed" in statuses:
+                    break
+                window = app.next_window(window[-1] + 1)
+        failed = sum(1 for step in steps if step["status"] == "failed")
+
+        ran = {step["row"] - 1 for step in steps}
+        for i in rows:
+            if i not in ran:
+                steps.append({"row": i + 1, "command": app.commands[i], "status": "skipped", "duration": 0})
+
+        summary = {
+            "plan": app.plan_file,
+            "log": app.log_file,
+            "finished": datetime.now().isoformat(),
+            "duration": round(time.monotonic() - started, 6),
+            "selected": len(rows),
+            "succeeded": sum(1 for step in steps if step["status"] == "success"),
+            "failed": failed,
+            "skipped": sum(1 for step in steps if step["status"] == "skipped"),
+            "exit_code": EXIT_STEP_FAILED if failed else EXIT_SUCCESS,
+            "steps": steps,
+        }
+        if blocks is not None:
+            summary["blocks"] = blocks
+        if app.fanout is not None:
+            summary["targets"] = [target.name for target in app.fanout.targets]
+        return summary
+
+    def write_summary(self, summary, summary_file=None):
+        """Write the summary as JSON to summary_file, or to stdout when it is None or "-"."""
+        if summary_file and summary_file != '-':
+            with open(summary_file, 'w') as f:
+                json.dump(summary, f, indent=2)
+        else:
+            json.dump(summary, sys.stdout, indent=2)
+            sys.stdout.write("\n")
@@ -0,0 +1,145 @@
+import os
+import glob
+import json
+import hashlib
+import threading
+from datetime import datetime
+from .happl3_defaults import CACHE_MAX_BYTES
+
+# Comment row above a command that makes its result reusable while the listed inputs are unchanged
+INPUTS_ANNOTATION = "#@inputs:"
+
+
+def _input_files(pattern, cwd):
+    """Files matched by an input path or glob pattern relative to cwd, a directory standing for every file below it."""
+    paths = sorted(glob.glob(os.path.join(glob.escape(cwd), pattern), recursive=True)) or [os.path.join(cwd, pattern)]
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def step_fingerprint(command_digest, shell_type, setup_commands, inputs, cwd):
+    """Fingerprint of a step from its command, the setup commands before it and the state of its inputs.
+
+    An input is a file, directory or glob pattern (relative to cwd, the working directory of the shell session)
+    whose files count with their size and mtime, $NAME for an environment variable of Happl3, or "cwd" for cwd.
+    """
+    fingerprint = hashlib.sha256()
+
+    def add(*parts):
+        for part in parts:
+            fingerprint.update(str(part).encode('utf-8', errors='surrogateescape') + b"\0")
+
+    add(command_digest.hex(), shell_type, len(setup_commands), *setup_commands)
+    for item in inputs:
+        if item == "cwd":
+            add("cwd", cwd)
+        elif item.startswith("$"):
+            value = os.environ.get(item[1:])
+            add("env", item, "unset" if value is None else f"={value}")
+        else:
+            add("path", item)
+            for path in _input_files(item, cwd):
+                try:
+                    st = os.stat(path)
+                    add(path, st.st_size, st.st_mtime_ns)
+                except OSError:
+                    add(path, "missing")
+    return fingerprint.hexdigest()
+
+
+class Happl3StepCache:
+    """Successful results of steps with an #@inputs: annotation, by fingerprint, in <plan>.cache.
+
+    An entry is a small JSON file naming the step's output in the artifact
+    store. Using an entry touches its file, and once the outputs the entries
+    refer to add up to more than max_bytes the least recently used entries
+    are removed. A max_bytes of 0 disables the cache.
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = None  # Fingerprint -> (output digest, output bytes), loaded on first use
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def path(self, fingerprint):
+        return os.path.join(self.directory, fingerprint)
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if name.endswith(".tmp"):
+                continue
+            try:
+                with open(self.path(name), 'r') as f:
+                    entry = json.load(f)
+                self.entries[name] = (entry["output"], entry["output_bytes"])
+            except (OSError, ValueError, KeyError):
+                continue
+        self.total = sum(size for _, size in self.entries.values())
+
+    def lookup(self, fingerprint):
+        """Return the entry stored for fingerprint and mark it as used, or None."""
+        if not self.max_bytes:
+            return None
+        path = self.path(fingerprint)
+        with self.lock:
+            try:
+                with open(path, 'r') as f:
+                    entry = json.load(f)
+                os.utime(path)
+            except (OSError, ValueError):
+                return None
+        return entry
+
+    def store(self, fingerprint, command, output, output_bytes, duration):
+        """Remember a successful run of command with the output digest it produced."""
+        if not self.max_bytes or output_bytes > self.max_bytes:
+            return
+        entry = {"command": command, "output": output, "output_bytes": output_bytes, "duration": duration,
+                 "created": datetime.now().isoformat()}
+        with self.lock:
+            self._load()
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.path(fingerprint)
+            with open(f"{path}.tmp", 'w') as f:
+                f.write(json.dumps(entry))
+            os.replace(f"{path}.tmp", path)
+            self.total += output_bytes - self.entries.get(fingerprint, (None, 0))[1]
+            self.entries[fingerprint] = (output, output_bytes)
+            if self.total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        def last_used(fingerprint):
+            try:
+                return os.stat(self.path(fingerprint)).st_mtime_ns
+            except OSError:
+                return 0
+        for fingerprint in sorted(self.entries, key=last_used):
+            if self.total <= self.max_bytes:
+                break
+            try:
+                os.remove(self.path(fingerprint))
+            except FileNotFoundError:
+                pass
+            self.total -= self.entries.pop(fingerprint)[1]
+
+    def outputs(self):
+        """Digests of the outputs the entries refer to, which the artifact store must keep."""
+        with self.lock:
+            self._load()
+            return {output for output, _ in self.entries.values()}
@@ -0,0 +1,577 @@
+import os
+import sys
+import json
+import time
+import queue
+import errno
+import signal
+import socket
+import selectors
+import threading
+
+# Seconds between checks of the executor and the log while a run is in progress, and of the plan file while idle
+RUN_TICK = 0.1
+IDLE_TICK = 0.5
+# Events queued for a client before it is disconnected, so a stalled viewer never holds up the daemon
+CLIENT_BUFFER_MAX = 8 * 1024 * 1024
+# Most log output read and streamed to the following clients per tick
+OUTPUT_CHUNK_BYTES = 1024 * 1024
+# Seconds a client waits for the daemon to answer
+REPLY_TIMEOUT = 10.0
+# Last line the daemon writes to its starting process once it accepts clients
+READY_LINE = "ready"
+
+
+def daemon_socket(plan_file):
+    return f"{plan_file}.sock"
+
+
+def daemonize():
+    """Continue in a background process of its own session and return a function to call once it serves.
+
+    The starting process waits until that function was called or the daemon
+    exited, prints what the daemon wrote to stderr until then and exits with
+    0 or 1, so errors in the arguments or the plan still reach the terminal.
+    """
+    read_fd, write_fd = os.pipe()
+    if os.fork():
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as startup:
+            lines = startup.read().decode('utf-8', errors='replace').splitlines()
+        if lines and lines[-1] == READY_LINE:
+            print("\n".join(lines[:-1]))
+            raise SystemExit(0)
+        print("\n".join(lines) or "The daemon exited while starting", file=sys.stderr)
+        raise SystemExit(1)
+    os.close(read_fd)
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    os.dup2(write_fd, 2)
+
+    def ready(message):
+        os.write(2, f"{message}\n{READY_LINE}\n".encode())
+        os.dup2(devnull, 2)
+        os.close(write_fd)
+        os.close(devnull)
+    return ready
+
+
+class Happl3Connection:
+    """One client of the daemon: its socket and the bytes read from and waiting to be written to it."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.writing = False  # Registered for EVENT_WRITE because the outbox did not fit into the socket
+        self.follow = False  # Sent the "follow" request, so it gets the output appended to the log
+
+
+class Happl3Daemon:
+    """Runs a plan for clients that attach over the Unix socket <PlanFile>.sock.
+
+    The daemon owns the app with its plan, index, shell sessions and
+    executor, so a run goes on when the terminal that started it is gone.
+    Clients send one JSON request per line and get one JSON event per line:
+    the state of the daemon when they connect, every step that starts or
+    finishes with its new index entry, plan reloads and the end of a run.
+    Clients that send "follow", attached user interfaces and --send follow,
+    also get the complete lines appended to the log with their end offsets;
+    the log is only read while such a client is connected. Events are encoded
+    once and written to the clients without blocking from the daemon's own
+    thread, so viewers add no work to the steps; a client more than
+    CLIENT_BUFFER_MAX bytes behind is disconnected.
+    """
+
+    def __init__(self, app, socket_file):
+        self.app = app
+        self.socket_file = socket_file
+        self.selector = selectors.DefaultSelector()
+        self.listener = None
+        self.clients = []
+        self.stopping = False
+        self.log_inode = None
+        self.log_offset = 0  # End of the lines streamed to the followers so far
+
+    def listen(self):
+        """Create the socket. Raises OSError if another daemon serves the plan or the socket cannot be made."""
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_file)
+            raise OSError(errno.EADDRINUSE, f"a daemon already serves {self.app.plan_file} on {self.socket_file}")
+        except (FileNotFoundError, ConnectionRefusedError):
+            if os.path.exists(self.socket_file):
+                os.remove(self.socket_file)  # Left behind by a daemon that did not shut down
+        finally:
+            probe.close()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)  # Only the owner may run commands through the socket
+        try:
+            self.listener.bind(self.socket_file)
+        finally:
+            os.umask(umask)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+    def serve(self, ready=None):
+        """Serve clients until a "stop" request or SIGTERM, and the run that was in progress ended."""
+        from .happl3_watch import Happl3PlanWatcher
+        app = self.app
+        app.watcher = Happl3PlanWatcher(app.plan_file)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        message = f"Daemon serving {app.plan_file} on {self.socket_file} (pid {os.getpid()})"
+        app.log_message(message)
+        if ready is not None:
+            ready(message)
+        try:
+            while not self.stopping or app.executor.running():
+                timeout = RUN_TICK if app.executor.running() else IDLE_TICK
+                for key, mask in self.selector.select(timeout):
+                    if key.fileobj is self.listener:
+                        self.accept()
+                    elif mask & selectors.EVENT_READ:
+                        self.receive(key.data)
+                    if key.data is not None and mask & selectors.EVENT_WRITE:
+                        self.flush(key.data)
+                self.tick()
+            self.broadcast({"event": "shutdown"})
+        except Exception as e:
+            app.log_message(f"Daemon failed: {e}")  # Its stderr is gone
+            raise
+        finally:
+            for client in list(self.clients):
+                self.drop(client)
+            self.selector.unregister(self.listener)
+            self.listener.close()
+            if os.path.exists(self.socket_file):
+                os.remove(self.socket_file)
+            app.watcher.close()
+            app.log_message("Daemon stopped")
+
+    def stop(self):
+        """Stop serving once the current run ended; called by the "stop" request and SIGTERM."""
+        self.stopping = True
+
+    def tick(self):
+        """Forward the executor's events and the new log output, and reload the plan if it was edited."""
+        app = self.app
+        executor = app.executor
+        if self.stopping and executor.running() and not executor.cancel_requested:
+            executor.cancel()
+        events = app.handle_events()
+        # After the events, so the output of a finished step reaches the clients before its "finished" event
+        self.stream_output()
+        for event in events:
+            if event[0] == "started":
+                self.broadcast({"event": "started", "row": event[1]})
+            elif event[0] == "finished":
+                self.broadcast({"event": "finished", "row": event[1], "status": event[2],
+                                "entry": app.store.entry(event[1])})
+            elif event[0] == "stopped":
+                self.broadcast({"event": "stopped", "reason": event[1], "message": app.run_message,
+                                "failed_row": executor.failed_row})
+                self.catch_up()
+        if app.check_plan():
+            self.broadcast({"event": "plan", "message": app.run_message})
+
+    def stream_output(self):
+        """Send the complete lines appended to the log since the last tick to the clients that follow the run."""
+        followers = [client for client in self.clients if client.follow]
+        if not followers:
+            return
+        app = self.app
+        try:
+            st = os.stat(app.log_file)
+        except FileNotFoundError:
+            return
+        if st.st_ino != self.log_inode or st.st_size < self.log_offset:  # Rotated or reset
+            self.log_inode = st.st_ino
+            self.log_offset = app.log_segments.covered(st.st_ino)
+        if st.st_size == self.log_offset:
+            return
+        with open(app.log_file, 'rb') as log:
+            log.seek(self.log_offset)
+            data = log.read(min(st.st_size - self.log_offset, OUTPUT_CHUNK_BYTES))
+            if b"\n" not in data:
+                data += log.read(st.st_size - self.log_offset - len(data))  # A line longer than a chunk
+        cut = data.rfind(b"\n") + 1
+        if not cut:
+            return  # The last line is not complete yet
+        ends = []
+        newline = data.find(b"\n")
+        while 0 <= newline < cut:
+            ends.append(self.log_offset + newline + 1)
+            newline = data.find(b"\n", newline + 1)
+        self.broadcast({"event": "output", "inode": st.st_ino, "offset": self.log_offset, "ends": ends,
+                        "text": data[:cut].decode('utf-8', errors='replace')}, followers)
+        self.log_offset += cut
+        # The daemon's own view and the search index follow the log while it is read anyway
+        self.catch_up()
+
+    def catch_up(self):
+        """Index the log up to its end for the daemon's view and the search index."""
+        app = self.app
+        app.log_view.refresh()
+        if app.search_index is not None:
+            app.search_index.catch_up(app.log_view)
+
+    def state(self):
+        """The "state" event: whether a run is in progress, its steps and the row counts by status."""
+        app = self.app
+        executor = app.executor
+        now = time.monotonic()
+        store = app.store
+        return {
+            "event": "state",
+            "pid": os.getpid(),
+            "plan": app.plan_file,
+            "plan_hash": app.plan_key["hash"] if app.plan_key else None,
+            "running": executor.running(),
+            "steps": {str(row): round(now - started, 3) for row, started in dict(executor.steps).items()},
+            "current": executor.current,
+            "failed_row": executor.failed_row,
+            "pause_requested": executor.pause_requested,
+            "cancel_requested": executor.cancel_requested,
+            "stopping": self.stopping,
+            "message": app.run_message,
+            "rows": len(store),
+            "pending": store.count_status("pending"),
+            "success": store.count_status("success"),
+            "failed": store.count_status("failed"),
+            "selected": store.count_selected(),
+            "clients": len(self.clients),
+        }
+
+    def handle(self, client, request):
+        app = self.app
+        executor = app.executor
+        op = request.get("op")
+        if op == "state":
+            self.send(client, self.state())
+            return
+        if op == "follow":
+            if not any(other.follow for other in self.clients):
+                # Start where the client's view of the log ends, if it has one, else at the end of the log
+                try:
+                    st = os.stat(app.log_file)
+                except FileNotFoundError:
+                    st = None
+                offset = request.get("offset")
+                self.log_inode = st.st_ino if st else None
+                self.log_offset = st.st_size if st else 0
+                if st and request.get("inode") == st.st_ino and isinstance(offset, int) and offset <= st.st_size:
+                    self.log_offset = offset
+            client.follow = True
+            self.send(client, self.state())
+            return
+        if op == "run":
+            if executor.running():
+                self.send(client, {"event": "error", "message": "A run is already in progress"})
+                return
+            if app.plan_key is None or request.get("plan_hash") != app.plan_key["hash"]:
+                self.send(client, {"event": "error", "message": "The plan changed, attach again"})
+                return
+            app.select_none()
+            for start, end in request.get("ranges", []):
+                app.select_range(max(0, start), min(end, len(app.store)))
+            if app.store.find_selected(0) < 0:
+                self.send(client, {"event": "error", "message": "No rows selected"})
+                return
+            executor.start(0)
+            app.run_message = ""
+        elif op == "pause":
+            executor.pause()
+        elif op == "cancel":
+            executor.cancel()
+        elif op == "stop":
+            self.stop()
+        else:
+            self.send(client, {"event": "error", "message": f"Unknown request: {op}"})
+            return
+        self.broadcast(self.state())
+
+    def accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = Happl3Connection(sock)
+        self.clients.append(client)
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        self.send(client, self.state())
+
+    def receive(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.drop(client)
+            return
+        client.inbox += data
+        while client in self.clients:
+            end = client.inbox.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(client.inbox[:end])
+            del client.inbox[:end + 1]
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.send(client, {"event": "error", "message": "Requests are JSON objects, one per line"})
+                continue
+            self.handle(client, request if isinstance(request, dict) else {})
+
+    def send(self, client, event):
+        self._queue(client, (json.dumps(event) + "\n").encode())
+
+    def broadcast(self, event, clients=None):
+        data = (json.dumps(event) + "\n").encode()
+        for client in list(self.clients if clients is None else clients):
+            self._queue(client, data)
+
+    def _queue(self, client, data):
+        if len(client.outbox) + len(data) > CLIENT_BUFFER_MAX:
+            self.drop(client)
+            return
+        client.outbox += data
+        self.flush(client)
+
+    def flush(self, client):
+        try:
+            sent = client.sock.send(client.outbox)
+            del client.outbox[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop(client)
+            return
+        writing = bool(client.outbox)
+        if writing != client.writing:
+            client.writing = writing
+            self.selector.modify(client.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0), client)
+
+    def drop(self, client):
+        if client not in self.clients:
+            return
+        self.clients.remove(client)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+
+class Happl3Client:
+    """Connection to the daemon of a plan. Requests go out with send(), events come in on a reader thread."""
+
+    def __init__(self, socket_file):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(socket_file)
+        except OSError:
+            self.sock.close()
+            raise
+        self.events = queue.Queue()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        buffer = bytearray()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                start = 0
+                while True:
+                    end = buffer.find(b"\n", start)
+                    if end < 0:
+                        break
+                    self.events.put(json.loads(buffer[start:end]))
+                    start = end + 1
+                del buffer[:start]
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.events.put({"event": "disconnected"})
+
+    def send(self, op, **fields):
+        """Send a request. Raises OSError if the daemon is gone."""
+        self.sock.sendall((json.dumps({"op": op, **fields}) + "\n").encode())
+
+    def next_event(self, timeout=None):
+        """The next event, or None if none arrived within timeout seconds."""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def reply(self):
+        """Wait for the answer to a request, a "state" or "error" event, skipping the others."""
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while True:
+            event = self.next_event(max(0.0, deadline - time.monotonic()))
+            if event is None:
+                return {"event": "error", "message": "The daemon did not answer"}
+            if event["event"] in ("state", "error", "disconnected"):
+                return event
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Happl3RemoteExecutor:
+    """Takes the place of Happl3Executor in a user interface attached to a daemon.
+
+    Runs are started, paused and cancelled in the daemon. take_events()
+    turns the daemon's events into the executor events the interface
+    handles, and applies the new index entries of finished steps and plan
+    reloads to the interface's store.
+    """
+
+    def __init__(self, app, client):
+        self.app = app
+        self.client = client
+        self.active = False
+        self.current = None
+        self.step_started = None
+        self.steps = {}
+        self.failed_row = None
+        self.pause_requested = False
+        self.cancel_requested = False
+
+    def running(self):
+        return self.active
+
+    def start(self, first_row):
+        """Ask the daemon to run the selected rows. Returns False if a run is already in progress."""
+        if self.active:
+            return False
+        store = self.app.store
+        ranges = [[max(start, first_row), end] for start, end in store.selected_ranges() if end > first_row]
+        return self._send("run", ranges=ranges, plan_hash=self.app.plan_key["hash"])
+
+    def pause(self):
+        self._send("pause")
+
+    def cancel(self):
+        self._send("cancel")
+
+    def wait(self, timeout=None):
+        pass
+
+    def _send(self, op, **fields):
+        try:
+            self.client.send(op, **fields)
+            return True
+        except OSError:
+            self.app.run_message = "Disconnected from the daemon"
+            return False
+
+    def take_events(self):
+        """Return the executor events for the daemon's events received since the last call."""
+        app = self.app
+        events = []
+        while True:
+            event = self.client.next_event(0)
+            if event is None:
+                return events
+            name = event["event"]
+            now = time.monotonic()
+            if name == "state":
+                self.active = event["running"]
+                self.steps = {int(row): now - elapsed for row, elapsed in event["steps"].items()}
+                self.current = event["current"]
+                self.step_started = self.steps.get(self.current)
+                self.failed_row = event["failed_row"]
+                self.pause_requested = event["pause_requested"]
+                self.cancel_requested = event["cancel_requested"]
+                if not self.active:
+                    app.run_message = event["message"]
+            elif name == "started":
+                self.active = True
+                self.current = event["row"]
+                self.step_started = self.steps[event["row"]] = now
+                events.append(("started", event["row"]))
+            elif name == "finished":
+                self.steps.pop(event["row"], None)
+                if event["row"] < len(app.store):
+                    app.store.load_entry(event["row"], event["entry"])
+                if event["status"] == "failed" and self.failed_row is None:
+                    self.failed_row = event["row"]
+                events.append(("finished", event["row"], event["status"]))
+            elif name == "stopped":
+                self.active = False
+                self.current = self.step_started = None
+                self.steps.clear()
+                self.failed_row = event["failed_row"]
+                self.pause_requested = self.cancel_requested = False
+                events.append(("stopped", event["reason"]))
+            elif name == "output":
+                app.log_view.receive(event)
+            elif name == "plan":
+                app.reload_plan()
+                app.run_message = event["message"]
+            elif name == "error":
+                app.run_message = event["message"]
+            elif name in ("shutdown", "disconnected"):
+                if self.active:
+                    self.active = False
+                    self.steps.clear()
+                    events.append(("stopped", "error: the daemon stopped"))
+                app.run_message = "Disconnected from the daemon"
+
+
+def send_command(client, command, ranges=None, plan_hash=None, out=sys.stdout):
+    """Carry out a --send command over client and return the exit code.
+
+    "follow" prints the output of the run in progress until it ends and
+    returns 1 if it failed, was cancelled or the daemon went away.
+    """
+    state = client.reply()
+    if state["event"] != "state":
+        print(state.get("message", "Disconnected from the daemon"), file=sys.stderr)
+        return 1
+    if command == "status":
+        json.dump(state, out, indent=2)
+        out.write("\n")
+        return 0
+    if command == "follow":
+        client.send("follow")
+        state = client.reply()
+        if state["event"] != "state":
+            print(state.get("message", "Disconnected from the daemon"), file=sys.stderr)
+            return 1
+        if not state["running"]:
+            print(state["message"] or "No run in progress", file=sys.stderr)
+            return 0
+        while True:
+            event = client.next_event()
+            if event["event"] == "output":
+                out.write(event["text"])
+                out.flush()
+            elif event["event"] == "stopped":
+                print(event["message"], file=sys.stderr)
+                return 0 if event["reason"] in ("done", "paused") else 1
+            elif event["event"] in ("shutdown", "disconnected"):
+                print("Disconnected from the daemon", file=sys.stderr)
+                return 1
+    fields = {"ranges": ranges, "plan_hash": plan_hash} if command == "run" else {}
+    client.send(command, **fields)
+    reply = client.reply()
+    if reply["event"] != "state":
+        print(reply.get("message", "Disconnected from the daemon"), file=sys.stderr)
+        return 1
+    if command == "run":
+        print(f"Running {reply['selected']} selected rows", file=sys.stderr)
+    return 0
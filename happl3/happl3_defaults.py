@@ -0,0 +1,10 @@
+# Defaults of the command line options that belong to other modules. They are
+# kept here, without imports, so that printing the help does not load those modules.
+
+# Log size at which it is rotated into a compressed segment, and the number of segments kept
+LOG_MAX_BYTES = 64 * 1024 * 1024
+LOG_KEEP_SEGMENTS = 20
+# Total size of the outputs the step cache refers to before the least recently used entries are removed
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Targets a step runs on at the same time unless --fanout says otherwise
+FANOUT_LIMIT = 8
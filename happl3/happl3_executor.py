@@ -0,0 +1,139 @@
+import queue
+import threading
+import time
+from .happl3_scheduler import Happl3Scheduler
+from .happl3_stats import profiled
+
+
+class Happl3Executor:
+    """Runs the selected plan rows on a worker thread.
+
+    The worker runs the selected rows in order through Happl3.run_window(),
+    one at a time or in pipelined windows, or block by block on the session
+    pool with Happl3Scheduler when app.jobs > 1. It reports progress to the
+    UI loop through a queue of events:
+
+        ("started", row)           a step started
+        ("output",)                new output was written to the log
+        ("finished", row, status)  a step finished with status "success" or "failed"
+        ("stopped", reason)        the run ended: "done", "failed", "paused", "cancelled" or "error: ..."
+
+    Output events are coalesced: at most one is queued until the UI takes it.
+    The executor counts as running until the UI has taken the "stopped" event.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.events = queue.Queue()
+        self.thread = None
+        self.active = False
+        self.current = None  # Row being run, the latest started one if several are
+        self.step_started = None
+        self.steps = {}  # Row -> start time of every row being run
+        self.failed_row = None  # First row that failed in this run
+        self.pause_requested = False
+        self.cancel_requested = False
+        self.output_queued = False
+
+    def running(self):
+        return self.active
+
+    def start(self, first_row):
+        """Run the selected rows from first_row on. Returns False if a run is already in progress."""
+        if self.running():
+            return False
+        self.active = True
+        self.pause_requested = False
+        self.cancel_requested = False
+        self.failed_row = None
+        self.thread = threading.Thread(target=profiled(self._run), args=(first_row,), daemon=True)
+        self.thread.start()
+        return True
+
+    def pause(self):
+        """Stop after the current step, or the current window when pipelining."""
+        self.pause_requested = True
+
+    def cancel(self):
+        """Stop the current steps and the run."""
+        self.cancel_requested = True
+        for session in self.app.sessions():
+            session.cancel()
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _output(self, stream, text):
+        if not self.output_queued:
+            self.output_queued = True
+            self.events.put(("output",))
+
+    def _status(self, row, status):
+        if status is None:
+            self.current = row
+            self.step_started = time.monotonic()
+            self.steps[row] = self.step_started
+            self.events.put(("started", row))
+        else:
+            self.steps.pop(row, None)
+            if status == "failed" and self.failed_row is None:
+                self.failed_row = row
+            self.events.put(("finished", row, status))
+
+    def _run(self, first_row):
+        app = self.app
+        reason = "done"
+        try:
+            if app.jobs > 1:
+                reason = self._run_blocks()
+                return
+            rows = app.next_window(first_row)
+            while rows:
+                if self.cancel_requested:
+                    reason = "cancelled"
+                    break
+                statuses = app.run_window(rows, on_output=self._output, on_status=self._status)
+                if self.cancel_requested:
+                    reason = "cancelled"
+                    break
+                if "failed" in statuses:
+                    reason = "failed"
+                    break
+                if self.pause_requested:
+                    reason = "paused"
+                    break
+                rows = app.next_window(rows[-1] + 1)
+        except Exception as e:
+            reason = f"error: {e}"
+        finally:
+            self.current = None
+            self.step_started = None
+            self.steps.clear()
+            self.events.put(("stopped", reason))
+
+    def _run_blocks(self):
+        scheduler = Happl3Scheduler(self.app, self.app.session_pool(), on_output=self._output, on_status=self._status,
+                                    should_stop=lambda: self.cancel_requested or self.pause_requested)
+        nodes = scheduler.run()
+        if self.cancel_requested:
+            return "cancelled"
+        if any(node.status == "failed" for node in nodes):
+            return "failed"
+        if self.pause_requested and any(node.status == "skipped" for node in nodes):
+            return "paused"
+        return "done"
+
+    def take_events(self):
+        """Return the events queued since the last call."""
+        events = []
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return events
+            if event[0] == "output":
+                self.output_queued = False
+            elif event[0] == "stopped":
+                self.active = False
+            events.append(event)
@@ -0,0 +1,164 @@
+import re
+import shlex
+import time
+from datetime import datetime
+from .happl3_store import USAGE_METRICS
+from .happl3_stats import profiled
+from .happl3_defaults import FANOUT_LIMIT
+
+TARGET_LINE_PATTERN = re.compile(r'^([A-Za-z0-9_.@:-]+)\s*=\s*(.+)$')
+
+
+class Happl3Target:
+    """A place the plan is applied to: a name and the command line that starts a shell there."""
+
+    def __init__(self, name, launcher):
+        self.name = name
+        self.launcher = launcher  # argv, e.g. ["ssh", "-T", "web1", "bash"]
+
+
+def load_targets(path):
+    """Read a targets file of "name = command" lines; blank lines and # comments are skipped.
+
+    Raises ValueError for malformed lines and duplicate names.
+    """
+    targets = []
+    names = set()
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            match = TARGET_LINE_PATTERN.match(line)
+            if not match:
+                raise ValueError(f"{path}:{number}: expected \"name = command\", got: {line}")
+            name, command = match.groups()
+            if name in names:
+                raise ValueError(f"{path}:{number}: target {name} is listed twice")
+            names.add(name)
+            targets.append(Happl3Target(name, shlex.split(command)))
+    if not targets:
+        raise ValueError(f"{path} lists no targets")
+    return targets
+
+
+def aggregate_status(results, targets):
+    """Row status from the per-target results: failed if any target failed, success once all succeeded."""
+    statuses = [results.get(target.name, {}).get("status", "pending") for target in targets]
+    if "failed" in statuses:
+        return "failed"
+    if all(status == "success" for status in statuses):
+        return "success"
+    return "pending"
+
+
+class Happl3FanOut:
+    """Runs each step on every target, on at most limit targets at the same time.
+
+    Every target has its own shell session, started by the target's command
+    line, that replays the setup commands like the local one. A step runs on
+    the targets where it did not succeed yet, or on all of them if it
+    succeeded everywhere. Each target's output goes to the artifact store
+    and to the log in one piece when it finished. The result of every
+    target is kept in the "targets" field of the row's index entry and the
+    row's status is their aggregate, so a failed step is retried only where
+    it failed.
+    """
+
+    def __init__(self, app, targets, limit=FANOUT_LIMIT, timeout=None):
+        # Imported here, so that load_targets() does not load the shell modules
+        from concurrent.futures import ThreadPoolExecutor
+        from .happl3_session import Happl3SessionManager
+        self.app = app
+        self.targets = targets
+        self.pool = ThreadPoolExecutor(max_workers=max(1, min(limit, len(targets))), thread_name_prefix="happl3-target")
+        setup = app.setup_commands()
+        self.sessions = {target.name: Happl3SessionManager(app.shell_type(), timeout, setup_commands=list(setup),
+                                                           launcher=target.launcher)
+                         for target in targets}
+
+    def results(self, index):
+        """Per-target results of the row at index: name -> {"status", "exit_code", "duration", ...}."""
+        return self.app.store.extra.get(index, {}).get("targets", {})
+
+    def summary(self, index):
+        """Counts of the targets by status for the row at index."""
+        results = self.results(index)
+        counts = {"success": 0, "failed": 0, "pending": 0}
+        for target in self.targets:
+            counts[results.get(target.name, {}).get("status", "pending")] += 1
+        return counts
+
+    def run_step(self, index, on_output=None):
+        """Run the step at index on the targets and record their results. Returns the aggregate status."""
+        previous = self.results(index)
+        targets = [target for target in self.targets
+                   if previous.get(target.name, {}).get("status") != "success"] or self.targets
+        started = time.monotonic()
+        futures = [(target, self.pool.submit(profiled(self._run_target), index, target, on_output)) for target in targets]
+        results = {name: result for name, result in previous.items() if any(t.name == name for t in self.targets)}
+        for target, future in futures:
+            results[target.name] = future.result()
+        ended = time.monotonic()
+
+        app = self.app
+        store = app.store
+        status = aggregate_status(results, self.targets)
+        failed = [target.name for target in targets if results[target.name]["status"] == "failed"]
+        with app.record_lock:
+            with open(app.log_file, 'a') as log:
+                log.write(f"[{datetime.now()}] Row {index + 1} on {len(targets)} targets: "
+                          f"{len(targets) - len(failed)} succeeded, {len(failed)} failed"
+                          + (f" ({', '.join(failed)})" if failed else "") + "\n")
+            fields = store.extra.setdefault(index, {})
+            fields.pop("cached", None)
+            fields["targets"] = results
+            store.set_metrics(index, started=started, ended=ended, duration=ended - started, output_bytes=None,
+                              marker_latency=None, overhead=None)
+            store.set_metrics(index, **{name: None for name in USAGE_METRICS})
+            store.set_output(index, None)
+            store.set_status(index, status)
+            store.set_timestamp(index, time.time())
+            if status == "success":
+                store.set_selected(index, False)
+            app.stats = None
+            app.record_index(index)
+        return status if status != "pending" else "failed"
+
+    def _run_target(self, index, target, on_output):
+        app = self.app
+        command = app.commands[index]
+        output = app.artifacts.writer()
+        header = f"\n[{datetime.now()}] > {command}  @{target.name}\n"
+        started = time.monotonic()
+        result = {"status": "failed", "exit_code": None}
+        try:
+            shell_result = self.sessions[target.name].run_command(
+                command, on_output=lambda stream, text: output.write(text),
+                setup=True if app.is_declared_setup(index) else None)
+            result["exit_code"] = shell_result.exit_code
+            result["status"] = "success" if shell_result.succeeded else "failed"
+            footer = "✔ SUCCESS\n" if shell_result.succeeded else f"✖ FAILED: exit code {shell_result.exit_code}\n"
+        except Exception as e:
+            from .happl3_shell import Happl3ShellError
+            prefix = "" if isinstance(e, Happl3ShellError) else "EXCEPTION: "
+            footer = f"✖ ERROR: {prefix}{e}\n"
+        result["duration"] = round(time.monotonic() - started, 6)
+        result["update_timestamp"] = datetime.now().isoformat()
+        with app.record_lock:
+            app.rotate_log()
+            with open(app.log_file, 'a') as log:
+                log.write(header)
+                output.copy_to(log)
+                log.write(footer)
+        try:
+            result["output"] = output.close()
+        except OSError:
+            pass
+        if on_output:
+            on_output("stdout", "")
+        return result
+
+    def close(self):
+        """Stop the worker threads; the sessions are closed with the app's other sessions."""
+        self.pool.shutdown(wait=False)
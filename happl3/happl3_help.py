@@ -0,0 +1,70 @@
+# Kept apart from happl3_app so that printing the help does not import the user interface and shell modules
+HELP_MESSAGE = """
+        Usage:
+            happl3 <PlanFile> [LogFile]
+            happl3 <PlanFile> [LogFile] --batch [--pending] [--failed] [--range FIRST[-LAST]] [--block ROW]
+                                        [--selected] [--continue] [--summary FILE] [--quiet]
+            happl3 <PlanFile> [LogFile] --daemon [...]
+            happl3 <PlanFile> [LogFile] --attach
+            happl3 <PlanFile> [LogFile] --send run|pause|cancel|status|follow|stop [selection flags]
+            happl3 <PlanFile> [LogFile] [--timeout SECONDS] [--pipeline N] [--jobs N] [--log-max-bytes BYTES]
+                                        [--log-keep N] [--search-index] [--cache-max-bytes BYTES]
+                                        [--targets FILE [--fanout N]] [--profile FILE] [...]
+
+        Parameters:
+            PlanFile: The file containing the migration plan (required)
+            LogFile: The file containing the log output (default to <PlanFile>.log)
+
+        Description:
+            Happl3 is a tool to apply a series of powershell or bash/zsh shell commands from a plan file.
+            The plan is a text file containing a list of commands to be executed in sequence. The tool will
+            execute the commands in the plan in a user-controlled manner and log the output to a file. The
+            tool will also track the status of each command in the plan and allow the user to re-run failed commands.
+
+            With --batch the selected commands run without the user interface. Pending commands are selected
+            unless selection flags are given. The run stops at the first failure unless --continue is given,
+            a JSON summary is written to stdout (or --summary FILE) and the exit code is 1 if any command failed.
+
+            --daemon runs the plan in a background process that keeps going when the terminal is closed and
+            listens on <PlanFile>.sock. --attach opens the user interface on it (q detaches) and --send sends it
+            a command: run (with the batch selection flags), pause, cancel, status, follow or stop.
+
+            Commands run in one shell session that is restarted if it exits, stops responding or a command runs
+            longer than --timeout SECONDS. Variable assignments, cd and other setup commands (or commands below a
+            #@setup comment) are replayed into every new session. --pipeline N sends up to N commands to the
+            shell at once; the rest of the window is skipped after a failure.
+
+            --jobs N runs the blocks of the plan in parallel on N shell sessions. A block waits for the block
+            before it unless the comment rows above it say otherwise: "#@name: db" names a block and
+            "#@after: db, net" makes it wait for those blocks only. A failure stops the blocks that wait for it.
+
+            --targets FILE applies the plan to every target in FILE, one "name = command" line each, where the
+            command starts a shell on the target (ssh -T host bash, docker exec -i ctr bash, bash). Each step runs
+            on up to --fanout N targets at once (default 8) and only where it did not succeed yet; the command
+            pane counts the targets by status and t lists them for the highlighted command.
+
+            A command below a "#@inputs: src/ Makefile $CC cwd" comment is memoized: while its command, the
+            session setup and the listed files, environment variables and working directory are unchanged, a
+            successful earlier run is reused instead of running it again. The outputs of reused runs are kept
+            up to --cache-max-bytes BYTES (default 256 MiB, 0 disables) in <PlanFile>.cache.
+
+            The log is rotated into gzip segments at --log-max-bytes BYTES (default 64 MiB, 0 disables) and the
+            newest --log-keep N segments are kept. The output pane scrolls back into the segments.
+
+            / searches the focused pane for a regular expression, n and N move to the next and previous match.
+            F filters the log to the error lines or the output of failed steps. --search-index keeps a trigram
+            index of the log in <LogFile>.tidx that lets plain text searches skip most of a large log.
+
+            Edits of the plan file are picked up while Happl3 runs; only the changed rows lose their status.
+
+            The output of every command is also kept in <PlanFile>.artifacts and o shows the output of the
+            highlighted command.
+
+            The parsed plan and index are cached in <PlanFile>.snap, so a large unchanged plan opens without
+            being parsed again.
+
+            On Linux the CPU time, peak memory and disk I/O of every command are recorded in the index, shown
+            next to the command and in the stats view (s) and included in the batch summary.
+
+            --profile FILE runs under cProfile and writes the stats to FILE and a text report to FILE.txt.
+        """
@@ -0,0 +1,74 @@
+import os
+import json
+
+
+class Happl3Journal:
+    """Append-only journal of index entry changes.
+
+    Each record is one JSON line holding the full state of a single index
+    entry, so replaying records in order over the last snapshot rebuilds the
+    current index. Records are flushed as they are written, so they survive
+    Happl3 being killed, and fsynced unless the caller batches that with
+    sync(); a crash can at most leave the final line torn, which replay()
+    ignores. A read_only journal, of a process that writes it meanwhile,
+    only reads it and leaves an incomplete last line alone.
+    """
+
+    def __init__(self, journal_file, read_only=False):
+        self.journal_file = journal_file
+        self.read_only = read_only
+        self.records = 0  # Records written since the last truncate()
+        self.file = None
+
+    def append(self, key, entry, sync=True):
+        """Write a record. With sync=False it is flushed but only survives a system crash after the next sync()."""
+        if self.file is None:
+            self.file = open(self.journal_file, 'a', encoding='utf-8')
+        record = dict(entry, key=key)
+        self.file.write(json.dumps(record, separators=(',', ':')) + "\n")
+        self.records += 1
+        if sync:
+            self.sync()
+        else:
+            self.file.flush()
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def replay(self, index_data):
+        """Apply journal records to index_data. Returns the number of records applied."""
+        if not os.path.exists(self.journal_file):
+            return 0
+        applied = 0
+        valid_size = 0
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Torn write from a crash
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                key = record.pop("key")
+                index_data.setdefault(key, {}).update(record)
+                applied += 1
+                valid_size += len(line)
+        # Cut off a torn tail so new records are not appended onto it; read only, it may be a record being written
+        if not self.read_only and valid_size < os.path.getsize(self.journal_file):
+            os.truncate(self.journal_file, valid_size)
+        self.records = applied
+        return applied
+
+    def truncate(self):
+        """Drop all records. Call only after a snapshot containing them has been written."""
+        self.close()
+        with open(self.journal_file, 'w', encoding='utf-8'):
+            pass
+        self.records = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
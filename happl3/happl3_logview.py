@@ -0,0 +1,203 @@
+import os
+import mmap
+import itertools
+from array import array
+from collections import deque
+from .happl3_segments import Happl3LogSegments
+
+INDEX_MAGIC = 0x3244495833485048  # "HPH3XID2"
+# Newest streamed lines a view attached to a daemon keeps in memory; older ones are read from the log
+STREAM_TAIL_LINES = 10000
+
+
+class Happl3LogView:
+    """Line-offset index over an append-only log file and its rotated segments.
+
+    The end offset of every complete line is kept in an array that is
+    persisted next to the log, so a large log is only scanned once. New bytes
+    are indexed incrementally on refresh() and only the lines that are asked
+    for are read from disk. Lines rotated out into compressed segments come
+    first, so scrolling back continues seamlessly into older segments.
+    A read_only view uses the persisted offsets but keeps the ones it adds in
+    memory, for viewers of a log whose index another process maintains.
+    """
+
+    def __init__(self, log_file, index_file=None, read_only=False):
+        self.log_file = log_file
+        self.index_file = index_file if index_file else f"{log_file}.lidx"
+        self.read_only = read_only
+        self.segments = Happl3LogSegments(log_file)
+        self.segments.finish_rotation()
+        self.inode = None
+        self.base = 0  # Bytes at the start of the log that a segment already holds
+        self.line_ends = array('Q')
+        self.scanned_size = 0  # Bytes covered by complete, indexed lines
+        self.file_size = 0
+        self.load_index()
+
+    def load_index(self):
+        """Load the persisted offsets and discard them if they no longer match the log."""
+        self.inode = None
+        self.base = 0
+        self.line_ends = array('Q')
+        self.scanned_size = 0
+        if not os.path.exists(self.index_file) or not os.path.exists(self.log_file):
+            return
+        data = array('Q')
+        try:
+            with open(self.index_file, 'rb') as f:
+                raw = f.read()
+            data.frombytes(raw[:len(raw) - len(raw) % data.itemsize])
+        except OSError:
+            return
+        if len(data) < 3 or data[0] != INDEX_MAGIC:
+            return
+        st = os.stat(self.log_file)
+        if data[1] != st.st_ino or data[2] != self.segments.covered(st.st_ino):
+            return
+        line_ends = data[3:]
+        if line_ends and (line_ends[-1] > st.st_size or not self._is_line_end(line_ends[-1])):
+            return
+        self.inode = st.st_ino
+        self.base = data[2]
+        self.line_ends = line_ends
+        self.scanned_size = line_ends[-1] if line_ends else self.base
+
+    def _is_line_end(self, offset):
+        with open(self.log_file, 'rb') as f:
+            f.seek(offset - 1)
+            return f.read(1) == b'\n'
+
+    def reset(self, inode, base=0):
+        self.inode = inode
+        self.base = base
+        self.line_ends = array('Q')
+        self.scanned_size = base
+        self.file_size = base
+        if self.read_only:
+            return
+        with open(self.index_file, 'wb') as f:
+            array('Q', [INDEX_MAGIC, inode, base]).tofile(f)
+
+    def refresh(self):
+        """Index any lines appended since the last call. Cost is proportional to the new bytes only."""
+        self.segments.refresh()
+        try:
+            st = os.stat(self.log_file)
+        except FileNotFoundError:
+            self.inode = None
+            self.base = 0
+            self.line_ends = array('Q')
+            self.scanned_size = 0
+            self.file_size = 0
+            return
+        base = self.segments.covered(st.st_ino)
+        if st.st_ino != self.inode or base != self.base or st.st_size < self.scanned_size:
+            self.reset(st.st_ino, base)
+        if st.st_size > self.scanned_size:
+            self.scan(st.st_size)
+        self.file_size = st.st_size
+
+    def scan(self, size):
+        new_ends = array('Q')
+        with open(self.log_file, 'rb') as f:
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                pos = self.scanned_size
+                while True:
+                    nl = mm.find(b'\n', pos, size)
+                    if nl < 0:
+                        break
+                    pos = nl + 1
+                    new_ends.append(pos)
+        if new_ends:
+            self.line_ends.extend(new_ends)
+            self.scanned_size = new_ends[-1]
+            if self.read_only:
+                return
+            with open(self.index_file, 'ab') as f:
+                new_ends.tofile(f)
+
+    def live_line_count(self):
+        return len(self.line_ends) + (1 if self.file_size > self.scanned_size else 0)
+
+    def line_count(self):
+        """Number of lines in the segments and the log, counting a trailing line without a newline."""
+        return self.segments.line_count() + self.live_line_count()
+
+    def _line_start(self, i):
+        return self.line_ends[i - 1] if i > 0 else self.base
+
+    def _line_end(self, i):
+        return self.line_ends[i] if i < len(self.line_ends) else self.file_size
+
+    def get_lines(self, start, count):
+        """Return up to count lines starting at line start, without line terminators."""
+        end = min(start + count, self.line_count())
+        if start < 0 or start >= end:
+            return []
+        rotated = self.segments.line_count()
+        lines = self.segments.get_lines(start, end - start) if start < rotated else []
+        start, end = max(0, start - rotated), end - rotated
+        if start < end:
+            with open(self.log_file, 'rb') as f:
+                f.seek(self._line_start(start))
+                data = f.read(self._line_end(end - 1) - self._line_start(start))
+            lines += data.split(b'\n')[:end - start]
+        return [line.decode('utf-8', errors='replace').rstrip('\r') for line in lines]
+
+    def tail_lines(self, offset, count):
+        """Return up to count lines in reverse order, skipping the newest offset lines."""
+        total = self.line_count()
+        end = total - offset
+        start = max(0, end - count)
+        return self.get_lines(start, end - start)[::-1]
+
+
+class Happl3StreamedLogView(Happl3LogView):
+    """Log view of an attached user interface, extended by the daemon's "output" events.
+
+    The streamed lines extend the line index without reading the log, and
+    the newest STREAM_TAIL_LINES of them are kept in memory, so following a
+    run reads nothing from the file; only scrolling back further and
+    searching do. The log is indexed again from the file when the stream
+    does not continue where the index ends: after a rotation, or when lines
+    were written before the client started following.
+    """
+
+    def __init__(self, log_file):
+        super().__init__(log_file, read_only=True)
+        self.tail = deque(maxlen=STREAM_TAIL_LINES)
+        self.sync()
+
+    def sync(self):
+        """Index the log file up to its last complete line."""
+        super().refresh()
+        self.file_size = self.scanned_size  # An incomplete last line arrives with the stream once it ends
+        self.tail.clear()
+
+    def refresh(self):
+        pass  # New lines arrive with receive()
+
+    def receive(self, event):
+        """Add the lines of an "output" event."""
+        if event["inode"] != self.inode or event["offset"] > self.scanned_size:
+            self.sync()
+            if event["inode"] != self.inode:
+                return
+        for line, end in zip(event["text"].split("\n"), event["ends"]):
+            if end > self.scanned_size:  # Lines the file was indexed with already are skipped
+                self.line_ends.append(end)
+                self.tail.append(line.rstrip("\r"))
+                self.scanned_size = self.file_size = end
+
+    def get_lines(self, start, count):
+        """Return up to count lines starting at line start, from memory if they were streamed recently."""
+        total = self.line_count()
+        first_streamed = total - len(self.tail)
+        end = min(start + count, total)
+        if start >= first_streamed:
+            return list(itertools.islice(self.tail, start - first_streamed, end - first_streamed))
+        lines = super().get_lines(start, min(end, first_streamed) - start)
+        if end > first_streamed:
+            lines += self.get_lines(first_streamed, end - first_streamed)
+        return lines
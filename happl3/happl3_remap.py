@@ -0,0 +1,96 @@
+from bisect import bisect_left, bisect_right
+from difflib import SequenceMatcher
+
+
+def occurrence_keys(hashes):
+    """Key each command hash by its occurrence, e.g. the second "echo hi" becomes "<hash>:1"."""
+    seen = {}
+    keys = []
+    for h in hashes:
+        n = seen.get(h, 0)
+        seen[h] = n + 1
+        keys.append(f"{h}:{n}")
+    return keys
+
+
+def remap_positions(old_hashes, new_hashes):
+    """Map each new plan position to the old position holding the same command, or None.
+
+    Unchanged runs of commands are aligned with a diff of the two hash
+    sequences, after trimming the common prefix and suffix so a small edit
+    to a large plan only diffs the edited region. Commands that were moved
+    rather than edited are then matched by their hash and occurrence key.
+    """
+    mapping = [None] * len(new_hashes)
+    prefix = 0
+    limit = min(len(old_hashes), len(new_hashes))
+    while prefix < limit and old_hashes[prefix] == new_hashes[prefix]:
+        mapping[prefix] = prefix
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix
+           and old_hashes[len(old_hashes) - 1 - suffix] == new_hashes[len(new_hashes) - 1 - suffix]):
+        mapping[len(new_hashes) - 1 - suffix] = len(old_hashes) - 1 - suffix
+        suffix += 1
+
+    old_mid = old_hashes[prefix:len(old_hashes) - suffix]
+    new_mid = new_hashes[prefix:len(new_hashes) - suffix]
+    if not old_mid or not new_mid:
+        return mapping
+
+    matcher = SequenceMatcher(None, old_mid, new_mid, autojunk=False)
+    matched_old = set()
+    for i, j, size in matcher.get_matching_blocks():
+        for k in range(size):
+            mapping[prefix + j + k] = prefix + i + k
+            matched_old.add(prefix + i + k)
+
+    # Fall back to hash plus occurrence for moved commands
+    unmatched_old = {}
+    for i, key in enumerate(occurrence_keys(old_hashes)):
+        if i not in matched_old and prefix <= i < len(old_hashes) - suffix:
+            unmatched_old[key] = i
+    for j, key in enumerate(occurrence_keys(new_hashes)):
+        if mapping[j] is None and key in unmatched_old:
+            mapping[j] = unmatched_old.pop(key)
+    return mapping
+
+
+def _common_prefix_length(a, b, block=4096):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i:i + block] == b[i:i + block]:
+        i += block
+    end = min(i + block, n)
+    while i < end and a[i] == b[i]:
+        i += 1
+    return min(i, n)
+
+
+def _common_suffix_length(a, b, block=4096):
+    n = min(len(a), len(b))
+    i = 0
+    while i + block <= n and a[len(a) - i - block:len(a) - i] == b[len(b) - i - block:len(b) - i]:
+        i += block
+    while i < n and a[len(a) - i - 1] == b[len(b) - i - 1]:
+        i += 1
+    return i
+
+
+def changed_rows(old_buffer, old_offsets, new_buffer, new_count):
+    """Find the rows an edit replaced, comparing the newline-joined plan texts byte-wise.
+
+    old_offsets holds the start of every old row plus one past the end, as
+    in Happl3Store. Returns (start, old_end, new_end): old rows
+    [start, old_end) became new rows [start, new_end), the rows before and
+    after are unchanged.
+    """
+    old_count = len(old_offsets) - 1
+    # Rows whose text and newline lie in the common prefix
+    start = bisect_right(old_offsets, _common_prefix_length(old_buffer, new_buffer)) - 1
+    start = max(0, min(start, old_count, new_count))
+    # Rows whose preceding newline lies in the common suffix
+    suffix_start = len(old_buffer) + 1 - _common_suffix_length(old_buffer, new_buffer)
+    tail = old_count - bisect_left(old_offsets, suffix_start, 1, max(1, old_count))
+    tail = max(0, min(tail, old_count - start, new_count - start))
+    return start, old_count - tail, new_count - tail
@@ -0,0 +1,107 @@
+import os
+
+# Seconds between samples of the resident size of the shell's process tree while a command runs
+RSS_SAMPLE_INTERVAL = 0.1
+
+
+class Happl3ResourceSampler:
+    """Reads the resource counters of a shell process from /proc.
+
+    CPU time and I/O bytes of a process include those of the children it
+    has waited for, and the shell waits for every command it runs, so the
+    difference of counters() before and after a command is what the
+    command used. Peak memory is not accumulated like that, so it is
+    sampled over the whole process tree with tree_rss_kb() while the command
+    runs. Where /proc is missing, available is False and nothing is read.
+    The shell's own files are kept open and re-read with pread(), as they
+    are read several times for every command.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.stat_fd = self._open("stat")
+        self.io_fd = self._open("io") if self.stat_fd is not None else None  # Missing without task I/O accounting
+        self.statm_fd = self._open("statm") if self.stat_fd is not None else None
+        self.children_fd = self._open(f"task/{pid}/children") if self.stat_fd is not None else None
+        self.available = self.stat_fd is not None
+        self.tick = os.sysconf("SC_CLK_TCK") if self.available else 100
+        self.page_kb = os.sysconf("SC_PAGE_SIZE") // 1024 if self.available else 4
+
+    def _open(self, name):
+        try:
+            return os.open(f"/proc/{self.pid}/{name}", os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+        except (OSError, AttributeError):
+            return None
+
+    def close(self):
+        for fd in (self.stat_fd, self.io_fd, self.statm_fd, self.children_fd):
+            if fd is not None:
+                os.close(fd)
+        self.stat_fd = self.io_fd = self.statm_fd = self.children_fd = None
+        self.available = False
+
+    def counters(self):
+        """(cpu user seconds, cpu sys seconds, bytes read, bytes written) so far, or None if they cannot be read."""
+        if not self.available:
+            return None
+        try:
+            # Fields after the command name, which may contain spaces: utime, stime, cutime, cstime are 11 to 14
+            fields = os.pread(self.stat_fd, 4096, 0).rsplit(b")", 1)[1].split()
+            user = (int(fields[11]) + int(fields[13])) / self.tick
+            system = (int(fields[12]) + int(fields[14])) / self.tick
+            read_bytes = write_bytes = None
+            if self.io_fd is not None:
+                for line in os.pread(self.io_fd, 4096, 0).split(b"\n"):
+                    name, _, value = line.partition(b":")
+                    if name == b"read_bytes":
+                        read_bytes = int(value)
+                    elif name == b"write_bytes":
+                        write_bytes = int(value)
+            return user, system, read_bytes, write_bytes
+        except (OSError, IndexError, ValueError):
+            return None  # The shell exited
+
+    def tree_rss_kb(self):
+        """Resident size in KiB of the shell and all its descendants, or None if it cannot be read."""
+        if not self.available:
+            return None
+        try:
+            total = int(os.pread(self.statm_fd, 4096, 0).split()[1]) * self.page_kb
+            pids = [int(child) for child in os.pread(self.children_fd, 4096, 0).split()]
+        except (OSError, IndexError, ValueError, TypeError):
+            return None  # The shell exited, or its children are not listed
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/statm", 'rb') as f:
+                    total += int(f.read().split()[1]) * self.page_kb
+                with open(f"/proc/{pid}/task/{pid}/children", 'rb') as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except (OSError, IndexError, ValueError):
+                pass  # Exited meanwhile
+        return total
+
+    def activity(self):
+        """(CPU ticks used by the shell and its waited-for children, pids of its children), or None if not readable.
+
+        Both stay the same while the shell waits for input without running anything.
+        """
+        if not self.available:
+            return None
+        try:
+            fields = os.pread(self.stat_fd, 4096, 0).rsplit(b")", 1)[1].split()
+            return sum(int(field) for field in fields[11:15]), os.pread(self.children_fd, 4096, 0).split()
+        except (OSError, IndexError, ValueError, TypeError):
+            return None
+
+
+def usage_between(before, after, max_rss_kb):
+    """Metrics of one command from the counters() before and after it and its sampled peak resident size."""
+    usage = {"cpu_user": None, "cpu_sys": None, "max_rss_kb": max_rss_kb, "read_bytes": None, "write_bytes": None}
+    if before is None or after is None:
+        return usage
+    usage["cpu_user"] = max(0.0, after[0] - before[0])
+    usage["cpu_sys"] = max(0.0, after[1] - before[1])
+    if before[2] is not None and after[2] is not None:
+        usage["read_bytes"] = max(0, after[2] - before[2])
+        usage["write_bytes"] = max(0, after[3] - before[3])
+    return usage
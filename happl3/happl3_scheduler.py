@@ -0,0 +1,239 @@
+import heapq
+import re
+import threading
+import time
+from .happl3_stats import profiled
+
+# Comment rows in the header of a block that name it (#@name: db) and list the blocks it waits for (#@after: db, net)
+ANNOTATION_PATTERN = re.compile(r'^#@(name|after):(.*)$')
+
+
+class Happl3Node:
+    """A block of the plan: the command rows between two comment rows."""
+
+    def __init__(self, number, first, last, name, title):
+        self.number = number
+        self.first = first  # First and last command row, inclusive
+        self.last = last
+        self.name = name  # From #@name:, None if the block has no name
+        self.title = title  # The name, or the row range for unnamed blocks
+        self.after = []  # Numbers of the nodes this one waits for
+        self.dependents = []
+        self.rows = []  # Selected rows to run
+        # "pending", "running", "success", "failed", "blocked" (a block it waits for failed),
+        # "skipped" (the run stopped first) or "done" (no selected rows)
+        self.status = "done"
+        self.duration = 0.0
+
+
+def plan_nodes(store):
+    """Split the plan into blocks and resolve their #@after: annotations.
+
+    A block without #@after: waits for the block before it, so a plan
+    without annotations runs in order. An empty "#@after:" makes the block
+    independent. Raises ValueError for unknown names and cycles.
+    """
+    nodes = []
+    header = []
+    i = 0
+    while i < len(store):
+        if store.is_comment(i):
+            header.append(i)
+            i += 1
+            continue
+        first = i
+        while i < len(store) and not store.is_comment(i):
+            i += 1
+        annotations = {}
+        for row in header:
+            match = ANNOTATION_PATTERN.match(store[row].strip())
+            if match:
+                annotations[match.group(1)] = match.group(2).strip()
+        name = annotations.get("name") or None
+        node = Happl3Node(len(nodes), first, i - 1, name, name or f"rows {first + 1}-{i}")
+        node.after = annotations.get("after")  # Resolved below
+        nodes.append(node)
+        header = []
+
+    names = {}
+    for node in nodes:
+        if node.name is not None:
+            if node.name in names:
+                raise ValueError(f"Block name {node.name} is used twice (rows {names[node.name].first + 1} "
+                                 f"and {node.first + 1})")
+            names[node.name] = node
+    for node in nodes:
+        if node.after is None:
+            node.after = [node.number - 1] if node.number else []
+            continue
+        after = []
+        for name in re.split(r'[\s,]+', node.after):
+            if not name:
+                continue
+            if name not in names:
+                raise ValueError(f"Block at row {node.first + 1} waits for unknown block {name}")
+            after.append(names[name].number)
+        node.after = after
+    for node in nodes:
+        for number in node.after:
+            nodes[number].dependents.append(node.number)
+    _check_cycles(nodes)
+    return nodes
+
+
+def _check_cycles(nodes):
+    waiting = [len(node.after) for node in nodes]
+    ready = [node.number for node in nodes if not node.after]
+    seen = 0
+    while ready:
+        number = ready.pop()
+        seen += 1
+        for dependent in nodes[number].dependents:
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                ready.append(dependent)
+    if seen < len(nodes):
+        cycle = [nodes[i].title for i in range(len(nodes)) if waiting[i]]
+        raise ValueError(f"The #@after: annotations form a cycle between blocks: {', '.join(cycle)}")
+
+
+class Happl3Scheduler:
+    """Runs the selected rows block by block on a pool of shell sessions.
+
+    A block is ready once every block it waits for has finished; a block
+    without selected rows passes the wait on to the blocks it waits for. Ready
+    blocks run concurrently, one per session, in plan order; the rows of a
+    block run in order in the same session. When a row fails its block
+    stops, and with stop_on_failure every block that waits for it,
+    directly or not, is blocked while independent blocks keep running.
+    """
+
+    def __init__(self, app, sessions, stop_on_failure=True, on_output=None, on_status=None, should_stop=None):
+        self.app = app
+        self.sessions = sessions
+        self.stop_on_failure = stop_on_failure
+        self.on_output = on_output
+        self.on_status = on_status if on_status else lambda row, status: None
+        self.should_stop = should_stop if should_stop else lambda: False
+        self.nodes = plan_nodes(app.store)
+        self.condition = threading.Condition()
+        self.ready = []  # Heap of node numbers
+        self.running = 0
+        self.waiting = {}  # Node number -> blocks it still waits for
+        self.dependents = {}  # Node number -> blocks with selected rows that wait for it, directly or through others
+
+    def run(self):
+        """Run the selected rows and return the nodes that had selected rows."""
+        store = self.app.store
+        for node in self.nodes:
+            node.rows = [i for i in range(node.first, node.last + 1) if store.is_selected(i)]
+            node.status = "pending" if node.rows else "done"
+        for node in self.nodes:
+            self.dependents[node.number] = []
+        for node in self.nodes:
+            if node.status == "pending":
+                after = self._selected_after(node)
+                for number in after:
+                    self.dependents[number].append(node.number)
+                self.waiting[node.number] = len(after)
+                if not after:
+                    heapq.heappush(self.ready, node.number)
+        workers = [threading.Thread(target=profiled(self._work), args=(session,), daemon=True) for session in self.sessions]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        nodes = [node for node in self.nodes if node.rows]
+        for node in nodes:
+            if node.status == "pending":
+                node.status = "skipped"
+        return nodes
+
+    def _selected_after(self, node):
+        """Numbers of the blocks with selected rows that node waits for, looking through those without."""
+        found = set()
+        seen = set()
+        stack = list(node.after)
+        while stack:
+            number = stack.pop()
+            if number in seen:
+                continue
+            seen.add(number)
+            if self.nodes[number].rows:
+                found.add(number)
+            else:
+                stack.extend(self.nodes[number].after)
+        return found
+
+    def _work(self, session):
+        while True:
+            with self.condition:
+                while not self.ready and self.running and not self.should_stop():
+                    self.condition.wait(0.1)  # should_stop() is not signalled
+                if not self.ready or self.should_stop():
+                    self.condition.notify_all()
+                    return
+                node = self.nodes[heapq.heappop(self.ready)]
+                node.status = "running"
+                self.running += 1
+            try:
+                self._run_node(node, session)
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self._finished(node)
+                    self.condition.notify_all()
+
+    def _run_node(self, node, session):
+        started = time.monotonic()
+        node.status = "success"
+        for row in node.rows:
+            if self.should_stop():
+                node.status = "skipped"
+                break
+            self.on_status(row, None)
+            status = self.app.run_step(row, self.on_output, session=session)
+            self.on_status(row, status)
+            if status == "failed":
+                node.status = "failed"
+                if self.stop_on_failure:
+                    break
+        node.duration = time.monotonic() - started
+
+    def _finished(self, node):
+        if node.status == "failed" and self.stop_on_failure:
+            blocked = self._block(node)
+            if blocked:
+                self.app.log_message(f"Block {node.title} failed, not running the blocks that wait for it: "
+                                     + ", ".join(self.nodes[n].title for n in blocked))
+            return
+        if node.status not in ("success", "failed"):
+            return
+        for number in self.dependents[node.number]:
+            if number in self.waiting and self.nodes[number].status == "pending":
+                self.waiting[number] -= 1
+                if not self.waiting[number]:
+                    heapq.heappush(self.ready, number)
+
+    def _block(self, node):
+        """Mark every pending block that waits for node, directly or not, as blocked."""
+        blocked = []
+        stack = list(self.dependents[node.number])
+        while stack:
+            dependent = self.nodes[stack.pop()]
+            if dependent.status == "pending":
+                dependent.status = "blocked"
+                blocked.append(dependent.number)
+                stack.extend(self.dependents[dependent.number])
+        return sorted(blocked)
+
+    def summary(self):
+        """Status of each block that had selected rows, for the batch summary."""
+        return [{
+            "block": node.title,
+            "rows": [node.first + 1, node.last + 1],
+            "after": [self.nodes[n].title for n in node.after],
+            "status": node.status,
+            "selected": len(node.rows),
+            "duration": round(node.duration, 6),
+        } for node in self.nodes if node.rows]
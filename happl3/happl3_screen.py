@@ -0,0 +1,131 @@
+import curses
+
+MIN_ROWS = 10
+MIN_COLS = 40
+
+
+class Happl3Screen:
+    """Damage-tracked layout for the Happl3 TUI.
+
+    The title, border and separator are drawn once per layout on stdscr.
+    Each pane is a pad the width of the inner screen; put() only touches a
+    pad row when its text or attribute changed since the last frame, and
+    refresh() only copies pads that were touched. Nothing is cleared between
+    frames, so curses sends just the changed cells to the terminal.
+    """
+
+    def __init__(self, stdscr, title):
+        self.stdscr = stdscr
+        self.title = title
+        self.layout()
+
+    def layout(self):
+        """Read the terminal size and rebuild pads and chrome. Call again after KEY_RESIZE."""
+        self.max_y, self.max_x = self.stdscr.getmaxyx()
+        self.width = self.max_x - 2
+        self.regions = {}
+        self.pads = {}
+        self.rows = {}
+        self.dirty = set()
+        self.chrome_dirty = True
+        if self.too_small():
+            return
+
+        cmd_height = (self.max_y - 3) // 2 - 1  # Adjust for title and borders
+        self.separator_row = cmd_height + 2
+        # name -> (first screen row, number of rows)
+        self.regions = {
+            "commands": (2, cmd_height - 1),
+            "command_status": (cmd_height + 1, 1),
+            "log": (self.separator_row + 1, self.max_y - self.separator_row - 3),
+            "log_status": (self.max_y - 2, 1),
+        }
+        for name, (top, height) in self.regions.items():
+            self.pads[name] = curses.newpad(height, self.width + 1)
+            self.pads[name].bkgd(' ', curses.color_pair(1))
+
+    def too_small(self):
+        return self.max_y < MIN_ROWS or self.max_x < MIN_COLS
+
+    def height(self, region):
+        return self.regions[region][1] if region in self.regions else 0
+
+    def invalidate(self):
+        """Forget what is on the terminal, e.g. after something else drew over it."""
+        self.stdscr.clear()
+        self.rows = {}
+        self.dirty = set(self.pads)
+        self.chrome_dirty = True
+
+    def put(self, region, row, text, attr):
+        """Set one row of a pane, padding it to the pane width. Unchanged rows are skipped."""
+        if row >= self.height(region) or self.rows.get((region, row)) == (text, attr):
+            return
+        self.rows[(region, row)] = (text, attr)
+        pad = self.pads[region]
+        try:
+            pad.move(row, 0)
+            pad.clrtoeol()
+            pad.addstr(row, 0, text[:self.width].encode('utf-8'), attr)
+        except curses.error:
+            pass  # Wide characters can run past the last column
+        self.dirty.add(region)
+
+    def put_right(self, region, row, left, right, left_attr, right_attr):
+        """Set a status row with left-aligned and right-aligned parts."""
+        text = left[:max(0, self.width - len(right) - 1)].ljust(max(0, self.width - len(right))) + right
+        if row >= self.height(region) or self.rows.get((region, row)) == (text, left_attr, right_attr):
+            return
+        self.rows[(region, row)] = (text, left_attr, right_attr)
+        pad = self.pads[region]
+        try:
+            pad.move(row, 0)
+            pad.clrtoeol()
+            pad.addstr(row, 0, text[:self.width - len(right)], left_attr)
+            pad.addstr(row, max(0, self.width - len(right)), right[:self.width], right_attr)
+        except curses.error:
+            pass
+        self.dirty.add(region)
+
+    def draw_chrome(self):
+        self.stdscr.erase()
+        if self.too_small():
+            try:
+                self.stdscr.addstr(0, 0, "Terminal window is too small. Please resize.", curses.color_pair(8))
+            except curses.error:
+                pass
+            return
+
+        # Draw application title
+        self.stdscr.addstr(0, 0, self.title, curses.color_pair(7) | curses.A_BOLD)
+
+        # Draw thick separator
+        self.stdscr.addstr(self.separator_row, 1, "═" * self.width, curses.color_pair(4))
+
+        # Draw single line blue border around the perimeter of each pane
+        border = curses.color_pair(6)
+        self.stdscr.vline(1, 0, curses.ACS_VLINE, self.max_y - 2, border)
+        self.stdscr.vline(1, self.max_x - 1, curses.ACS_VLINE, self.max_y - 2, border)
+        self.stdscr.hline(1, 0, curses.ACS_HLINE, self.max_x, border)
+        self.stdscr.hline(self.max_y - 1, 0, curses.ACS_HLINE, self.max_x, border)
+        self.stdscr.addch(1, 0, curses.ACS_ULCORNER, border)
+        self.stdscr.addch(1, self.max_x - 1, curses.ACS_URCORNER, border)
+        self.stdscr.addch(self.max_y - 1, 0, curses.ACS_LLCORNER, border)
+        try:
+            self.stdscr.insch(self.max_y - 1, self.max_x - 1, curses.ACS_LRCORNER, border)
+        except curses.error:
+            pass
+
+    def refresh(self):
+        """Send the damaged parts of the screen to the terminal."""
+        if self.chrome_dirty:
+            self.draw_chrome()
+            self.stdscr.noutrefresh()
+            self.chrome_dirty = False
+            self.dirty = set(self.pads)
+        for name in self.dirty:
+            top, height = self.regions[name]
+            if height > 0:
+                self.pads[name].noutrefresh(0, 0, top, 1, top + height - 1, self.width)
+        self.dirty = set()
+        curses.doupdate()
@@ -0,0 +1,468 @@
+import os
+import re
+import glob
+import mmap
+import zlib
+import struct
+import threading
+from bisect import bisect_left, bisect_right
+
+# Lines shown in red in the output pane, and the lines the "errors" filter keeps
+ERROR_LINE_PATTERN = re.compile(rb"ERROR:|EXCEPTION:|^\xe2\x9c\x96", re.MULTILINE)
+# Header and result lines of the section of a step in the log, for the "failed" filter
+SECTION_PATTERN = re.compile(rb"^(?:\[[^\]\n]*\] > |\xe2\x9c[\x94\x96] )", re.MULTILINE)
+FAILED_MARK = "✖".encode()
+# Filters of the log pane, in the order F cycles through them
+LOG_FILTERS = (None, "errors", "failed")
+
+SEARCH_INDEX_SUFFIX = ".tidx"
+SEARCH_INDEX_HEADER = struct.Struct("<8sQQ")  # Magic, inode and first indexed offset of the live log
+SEARCH_INDEX_MAGIC = b"HPL3TRI1"
+SEGMENT_INDEX_HEADER = struct.Struct("<8sIQ")  # Magic, number of members and uncompressed bytes of the segment
+SEGMENT_INDEX_MAGIC = b"HPL3TRS1"
+BLOCK_END = struct.Struct("<Q")
+# Bytes of the live log per indexed block, and the size of the trigram bitmap of a block
+SEARCH_BLOCK_BYTES = 64 * 1024
+BLOCK_BITMAP_BYTES = 4 * 1024
+# Size of the trigram bitmap of a gzip member of a segment, which holds about a megabyte of lines
+MEMBER_BITMAP_BYTES = 32 * 1024
+
+
+def compile_query(text):
+    """Return (pattern, literal) for a search query.
+
+    The query is a regular expression, or plain text if it is not a valid
+    one, and ignores case unless it contains upper case letters. literal is
+    the query as bytes if it is plain text, which the search index can use.
+    """
+    flags = re.MULTILINE | (0 if any(ch.isupper() for ch in text) else re.IGNORECASE)
+    data = text.encode('utf-8')
+    try:
+        pattern = re.compile(data, flags)
+    except re.error:
+        return re.compile(re.escape(data), flags), data
+    return pattern, data if re.escape(data) == data else None
+
+
+def trigram_bits(data, bitmap_bytes):
+    """Bit numbers in a bitmap of bitmap_bytes for the trigrams of data, ignoring ASCII case."""
+    data = data.lower()
+    mask = bitmap_bytes * 8 - 1
+    return {((((a << 16) | (b << 8) | c) * 0x9E3779B1) >> 11) & mask for a, b, c in set(zip(data, data[1:], data[2:]))}
+
+
+def trigram_bitmap(data, bitmap_bytes):
+    bitmap = bytearray(bitmap_bytes)
+    for bit in trigram_bits(data, bitmap_bytes):
+        bitmap[bit >> 3] |= 1 << (bit & 7)
+    return bytes(bitmap)
+
+
+def may_contain(bitmap, bits):
+    return all(bitmap[bit >> 3] & (1 << (bit & 7)) for bit in bits)
+
+
+class Happl3SearchIndex:
+    """Trigram bitmaps of a log that let a search skip the parts that cannot match, in <log>.tidx.
+
+    The live log is indexed in blocks of about SEARCH_BLOCK_BYTES that end
+    at a line end, each with a bitmap that has a bit set for every (hashed)
+    trigram of its text. A search for plain text reads only the blocks whose
+    bitmap has the bits of all the trigrams of the text. Each rotated
+    segment gets a <segment>.tidx with a bitmap per gzip member, written once.
+    catch_up() indexes what was appended to the log since on a background
+    thread, appending to the file; a read_only index loads what the process
+    writing the log indexed.
+    """
+
+    def __init__(self, log_file, read_only=False):
+        self.log_file = log_file
+        self.index_file = f"{log_file}{SEARCH_INDEX_SUFFIX}"
+        self.read_only = read_only
+        self.inode = None
+        self.base = 0
+        self.blocks = []  # (start, end, bitmap) of the indexed blocks of the live log, oldest first
+        self.loaded = 0  # Bytes of the index file read into blocks
+        self.valid = False  # The index file belongs to the live log with inode and base
+        self.segment_files = set()  # Segments known to have their index
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def refresh(self, inode, base):
+        """Load the blocks that were added to the index file of the live log with inode and base since."""
+        with self.lock:
+            if (inode, base) != (self.inode, self.base):
+                self.inode, self.base = inode, base
+                self.blocks = []
+                self.loaded = 0
+                self.valid = False
+            try:
+                with open(self.index_file, 'rb') as f:
+                    magic, file_inode, file_base = SEARCH_INDEX_HEADER.unpack(f.read(SEARCH_INDEX_HEADER.size))
+                    if (magic, file_inode, file_base) != (SEARCH_INDEX_MAGIC, inode, base):
+                        return
+                    self.valid = True
+                    f.seek(max(self.loaded, SEARCH_INDEX_HEADER.size))
+                    data = f.read()
+            except (OSError, struct.error):
+                return
+            record = BLOCK_END.size + BLOCK_BITMAP_BYTES
+            complete = len(data) - len(data) % record
+            for offset in range(0, complete, record):
+                start = self.blocks[-1][1] if self.blocks else base
+                end = BLOCK_END.unpack_from(data, offset)[0]
+                self.blocks.append((start, end, data[offset + BLOCK_END.size:offset + record]))
+            self.loaded = max(self.loaded, SEARCH_INDEX_HEADER.size) + complete
+
+    def catch_up(self, view):
+        """Index the complete blocks and the segments the view has and the index does not, in the background."""
+        if self.read_only or (self.thread is not None and self.thread.is_alive()) or view.inode is None:
+            return
+        if (view.inode, view.base) != (self.inode, self.base):
+            self.refresh(view.inode, view.base)
+        indexed = self.blocks[-1][1] if self.blocks else self.base
+        segments = [dict(segment, path=view.segments.path(segment)) for segment in view.segments.segments
+                    if segment["file"] not in self.segment_files]
+        if view.scanned_size - indexed < SEARCH_BLOCK_BYTES and not segments:
+            return
+        self.thread = threading.Thread(target=self._index, args=(view.inode, view.base, view.scanned_size, segments),
+                                       daemon=True)
+        self.thread.start()
+
+    def _index(self, inode, base, size, segments):
+        try:
+            if segments:
+                for segment in segments:
+                    self._index_segment(segment)
+                # Indexes of segments that were removed or archived
+                present = {os.path.basename(path) for path in glob.glob(f"{glob.escape(self.log_file)}.*.gz")}
+                for path in glob.glob(f"{glob.escape(self.log_file)}.*.gz{SEARCH_INDEX_SUFFIX}"):
+                    if os.path.basename(path)[:-len(SEARCH_INDEX_SUFFIX)] not in present:
+                        os.remove(path)
+            self._index_live(inode, base, size)
+        except (OSError, ValueError, zlib.error):
+            pass  # The log was rotated or reset meanwhile; the next call starts over
+
+    def _index_segment(self, segment):
+        index_file = f"{segment['path']}{SEARCH_INDEX_SUFFIX}"
+        index = open_segment_index(segment["path"], segment)
+        if index is not None:
+            index.close()
+        else:
+            bitmaps = []
+            with open(segment["path"], 'rb') as f:
+                for offset, length, _ in segment["chunks"]:
+                    f.seek(offset)
+                    bitmaps.append(trigram_bitmap(zlib.decompress(f.read(length), wbits=31), MEMBER_BITMAP_BYTES))
+            with open(f"{index_file}.tmp", 'wb') as f:
+                f.write(SEGMENT_INDEX_HEADER.pack(SEGMENT_INDEX_MAGIC, len(bitmaps), segment["bytes"]))
+                f.write(b"".join(bitmaps))
+            os.replace(f"{index_file}.tmp", index_file)
+        self.segment_files.add(segment["file"])
+
+    def _index_live(self, inode, base, size):
+        with open(self.log_file, 'rb') as log:
+            if os.fstat(log.fileno()).st_ino != inode or (inode, base) != (self.inode, self.base):
+                return
+            if not self.valid:
+                with open(self.index_file, 'wb') as f:
+                    f.write(SEARCH_INDEX_HEADER.pack(SEARCH_INDEX_MAGIC, inode, base))
+                with self.lock:
+                    self.blocks = []
+                    self.loaded = SEARCH_INDEX_HEADER.size
+                    self.valid = True
+            start = self.blocks[-1][1] if self.blocks else base
+            if size - start < SEARCH_BLOCK_BYTES:
+                return
+            with mmap.mmap(log.fileno(), size, access=mmap.ACCESS_READ) as mm, open(self.index_file, 'ab') as f:
+                while size - start >= SEARCH_BLOCK_BYTES:
+                    newline = mm.find(b"\n", start + SEARCH_BLOCK_BYTES - 1, size)
+                    if newline < 0:
+                        break
+                    end = newline + 1
+                    bitmap = trigram_bitmap(mm[start:end], BLOCK_BITMAP_BYTES)
+                    f.write(BLOCK_END.pack(end) + bitmap)
+                    with self.lock:
+                        self.blocks.append((start, end, bitmap))
+                        self.loaded += BLOCK_END.size + BLOCK_BITMAP_BYTES
+                    start = end
+
+    def live_blocks(self, inode, base, size):
+        """The indexed blocks of the live log with inode and base up to size, oldest first."""
+        if self.read_only:
+            self.refresh(inode, base)
+        with self.lock:
+            if (inode, base) != (self.inode, self.base):
+                return []
+            return [block for block in self.blocks if block[1] <= size]
+
+
+def open_segment_index(segment_path, segment):
+    """Open the index of a segment, or return None if it has none."""
+    try:
+        f = open(f"{segment_path}{SEARCH_INDEX_SUFFIX}", 'rb')
+    except OSError:
+        return None
+    try:
+        header = SEGMENT_INDEX_HEADER.unpack(f.read(SEGMENT_INDEX_HEADER.size))
+        if header == (SEGMENT_INDEX_MAGIC, len(segment["chunks"]), segment["bytes"]):
+            return f
+    except struct.error:
+        pass
+    f.close()
+    return None
+
+
+def read_bitmap(index, member):
+    """The bitmap of a member from a segment index opened by open_segment_index()."""
+    index.seek(SEGMENT_INDEX_HEADER.size + member * MEMBER_BITMAP_BYTES)
+    return index.read(MEMBER_BITMAP_BYTES)
+
+
+class Happl3LogSearch:
+    """Finds the lines of a log view that match a pattern on a background thread, newest first.
+
+    The live log is searched through mmap from its end in blocks, then the
+    rotated segments member by member, so the latest matches come first and
+    can be shown while the search goes on. With an index, blocks and members
+    that cannot contain the literal text of the query are skipped. With
+    sections, the pattern is SECTION_PATTERN and the result is the lines of
+    the sections of failed steps. Only the complete lines the view held
+    when the search started are searched; once done, follow() adds the lines
+    appended since. Results are [first, last] line ranges.
+    """
+
+    def __init__(self, view, pattern, literal=None, index=None, sections=False):
+        view.refresh()
+        self.view = view
+        self.pattern = pattern
+        self.literal = literal
+        self.index = index
+        self.sections = sections
+        self.found = []  # Ranges found by the backward search, newest first
+        self.found_keys = []  # -last of each of them, ascending
+        self.found_totals = []  # Lines in found[:i + 1]
+        self.added = []  # Ranges found by follow(), oldest first
+        self.added_firsts = []
+        self.added_totals = []
+        self.open_header = None  # Header line of the newest section if it has no result line yet
+        self.marker_seen = False
+        self.pending_end = None  # Result line of a failed section whose header was not found yet
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.inode = view.inode
+        self.base = view.base
+        self.rotated = view.segments.line_count()
+        self.segments = list(view.segments.segments)
+        self.line_starts = list(view.segments.line_starts)
+        self.line_ends = view.line_ends  # Only ever appended to, or replaced by the view
+        self.line_count = len(view.line_ends)
+        self.size = view.scanned_size
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _run(self):
+        try:
+            self._search_live()
+            self._search_segments()
+        except (OSError, ValueError, zlib.error) as e:
+            self.error = str(e)
+        finally:
+            self.done = True
+
+    def _query_bits(self, bitmap_bytes):
+        return trigram_bits(self.literal, bitmap_bytes) if self.literal is not None and self.index else None
+
+    def _live_ranges(self):
+        """(start, end) byte ranges of the live log to search, newest first, without those the index rules out."""
+        blocks = self.index.live_blocks(self.inode, self.base, self.size) if self.index is not None else []
+        bits = self._query_bits(BLOCK_BITMAP_BYTES)
+        end = self.size
+        indexed = blocks[-1][1] if blocks else self.base
+        while end > indexed:
+            start = max(indexed, end - SEARCH_BLOCK_BYTES)
+            line = bisect_right(self.line_ends, start, 0, self.line_count)
+            start = max(indexed, self.line_ends[line - 1] if line else self.base)
+            yield start, end
+            end = start
+        for start, end, bitmap in reversed(blocks):
+            if bits is None or may_contain(bitmap, bits):
+                yield start, end
+
+    def _search_live(self):
+        if self.size <= self.base:
+            return
+        with open(self.view.log_file, 'rb') as log:
+            if os.fstat(log.fileno()).st_ino != self.inode:
+                return  # Rotated meanwhile, the lines are in a segment the view does not know about yet
+            with mmap.mmap(log.fileno(), self.size, access=mmap.ACCESS_READ) as mm:
+                for start, end in self._live_ranges():
+                    if self.cancelled:
+                        return
+                    found = []
+                    pos = start
+                    while True:
+                        match = self.pattern.search(mm, pos, end)
+                        if match is None:
+                            break
+                        line = bisect_right(self.line_ends, match.start(), 0, self.line_count)
+                        found.append((self.rotated + line, match.group()))
+                        pos = self.line_ends[line]
+                    self._take(reversed(found))
+
+    def _search_segments(self):
+        bits = self._query_bits(MEMBER_BITMAP_BYTES)
+        for s in reversed(range(len(self.segments))):
+            segment = self.segments[s]
+            path = self.view.segments.path(segment)
+            index = open_segment_index(path, segment) if bits is not None else None
+            try:
+                first = self.line_starts[s + 1]
+                with open(path, 'rb') as f:
+                    for member in reversed(range(len(segment["chunks"]))):
+                        offset, length, lines = segment["chunks"][member]
+                        first -= lines
+                        if self.cancelled:
+                            return
+                        if index is not None and not may_contain(read_bitmap(index, member), bits):
+                            continue
+                        f.seek(offset)
+                        self._search_data(zlib.decompress(f.read(length), wbits=31), first)
+            finally:
+                if index is not None:
+                    index.close()
+
+    def _search_data(self, data, first):
+        found = []
+        line = first
+        counted = pos = 0
+        while True:
+            match = self.pattern.search(data, pos)
+            if match is None:
+                break
+            line += data.count(b"\n", counted, match.start())
+            found.append((line, match.group()))
+            end = data.find(b"\n", match.start())
+            if end < 0:
+                break
+            pos = counted = end + 1
+            line += 1
+        self._take(reversed(found))
+
+    def _take(self, matches):
+        """Record matches, newest first."""
+        for line, text in matches:
+            if not self.sections:
+                self._add(line, line)
+                continue
+            header = text.startswith(b"[")
+            if not self.marker_seen:
+                self.marker_seen = True
+                self.open_header = line if header else None
+            if header:
+                if self.pending_end is not None:
+                    self._add(line, self.pending_end)
+                self.pending_end = None
+            else:
+                self.pending_end = line if text.startswith(FAILED_MARK) else None
+
+    def _add(self, first, last):
+        # The totals are appended last, readers go by their length
+        self.found.append((first, last))
+        self.found_keys.append(-last)
+        self.found_totals.append((self.found_totals[-1] if self.found_totals else 0) + last - first + 1)
+
+    def follow(self):
+        """Search the lines appended to the view since, once done. Returns a new search if the log was rotated."""
+        view = self.view
+        if not self.done:
+            return self
+        view.refresh()
+        if (view.inode, view.base, view.segments.line_count()) != (self.inode, self.base, self.rotated):
+            return Happl3LogSearch(view, self.pattern, self.literal, self.index, self.sections)
+        if view.scanned_size <= self.size or view.line_ends is not self.line_ends:
+            return self
+        start, self.size = self.size, view.scanned_size
+        first_line, self.line_count = self.line_count, len(view.line_ends)
+        with open(view.log_file, 'rb') as log:
+            log.seek(start)
+            data = log.read(self.size - start)
+        header = self.open_header
+        line = self.rotated + first_line
+        counted = pos = 0
+        while True:
+            match = self.pattern.search(data, pos)
+            if match is None:
+                break
+            line += data.count(b"\n", counted, match.start())
+            if not self.sections:
+                self._append(line, line)
+            elif match.group().startswith(b"["):
+                header = line
+            else:
+                if header is not None and match.group().startswith(FAILED_MARK):
+                    self._append(header, line)
+                header = None
+            end = data.find(b"\n", match.start())
+            if end < 0:
+                break
+            pos = counted = end + 1
+            line += 1
+        self.open_header = header
+        return self
+
+    def _append(self, first, last):
+        self.added.append((first, last))
+        self.added_firsts.append(first)
+        self.added_totals.append((self.added_totals[-1] if self.added_totals else 0) + last - first + 1)
+
+    def count(self):
+        """Number of matching lines found so far."""
+        found, added = len(self.found_totals), len(self.added_totals)
+        return (self.found_totals[found - 1] if found else 0) + (self.added_totals[added - 1] if added else 0)
+
+    def line(self, i):
+        """Line number of the i-th matching line, newest first."""
+        added = len(self.added_totals)
+        total_added = self.added_totals[added - 1] if added else 0
+        if i < total_added:
+            j = total_added - 1 - i  # Position counted from the oldest line follow() found
+            r = bisect_right(self.added_totals, j, 0, added)
+            first, _ = self.added[r]
+            return first + j - (self.added_totals[r - 1] if r else 0)
+        i -= total_added
+        r = bisect_right(self.found_totals, i, 0, len(self.found_totals))
+        _, last = self.found[r]
+        return last - (i - (self.found_totals[r - 1] if r else 0))
+
+    def contains(self, line):
+        found, added = len(self.found_totals), len(self.added_totals)
+        r = bisect_right(self.found_keys, -line, 0, found) - 1
+        if r >= 0 and self.found[r][0] <= line:
+            return True
+        r = bisect_right(self.added_firsts, line, 0, added) - 1
+        return r >= 0 and self.added[r][1] >= line
+
+    def older(self, line):
+        """The newest matching line before line, or None if none was found (yet)."""
+        added = len(self.added_totals)
+        r = bisect_left(self.added_firsts, line, 0, added) - 1
+        if r >= 0:
+            return self.added[r][1]
+        found = len(self.found_totals)
+        r = bisect_right(self.found_keys, -line, 0, found)
+        return self.found[r][1] if r < found else None
+
+    def newer(self, line):
+        """The oldest matching line after line, or None if none was found (yet)."""
+        found = len(self.found_totals)
+        r = bisect_left(self.found_keys, -line, 0, found) - 1
+        if r >= 0:
+            return self.found[r][1]
+        added = len(self.added_totals)
+        r = bisect_right(self.added_firsts, line, 0, added)
+        return self.added[r][0] if r < added else None
@@ -0,0 +1,225 @@
+import os
+import json
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from .happl3_defaults import LOG_MAX_BYTES, LOG_KEEP_SEGMENTS
+
+# Uncompressed bytes per gzip member. A member is the unit that is decompressed to show a line.
+CHUNK_SIZE = 1 << 20
+CHUNK_CACHE_SIZE = 8
+
+
+class Happl3LogSegments:
+    """Compressed, rotated-out parts of a log file and their manifest.
+
+    Each segment is a gzip file made of independent members of about
+    CHUNK_SIZE uncompressed bytes, each holding whole lines, so it still
+    works with zcat. The manifest <log>.segments records every segment's
+    line count and the offset, length and line count of each member, which
+    lets get_lines() decompress only the members that hold the wanted lines.
+
+    The writer and each reader use their own instance; readers pick up the
+    writer's changes in refresh().
+    """
+
+    def __init__(self, log_file, manifest_file=None):
+        self.log_file = log_file
+        self.manifest_file = manifest_file if manifest_file else f"{log_file}.segments"
+        self.cache = OrderedDict()  # (segment file, member) -> list of lines
+        self.manifest_stat = None
+        self.load()
+
+    def load(self):
+        """(Re)read the manifest."""
+        self.segments = []
+        self.next_number = 1
+        self.pending = None  # {"inode", "size"} of a live log whose rotation did not finish yet
+        try:
+            st = os.stat(self.manifest_file)
+            with open(self.manifest_file, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest_stat = None
+            self._index()
+            return
+        self.manifest_stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self.cache.clear()  # Segment files may have been archived and their names reused
+        self.segments = manifest.get("segments", [])
+        self.next_number = manifest.get("next", len(self.segments) + 1)
+        self.pending = manifest.get("pending")
+        self._index()
+
+    def _index(self):
+        self.line_starts = [0]
+        for segment in self.segments:
+            self.line_starts.append(self.line_starts[-1] + segment["lines"])
+
+    def refresh(self):
+        """Reload the manifest if another writer changed it."""
+        try:
+            st = os.stat(self.manifest_file)
+            current = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            current = None
+        if current != self.manifest_stat:
+            self.load()
+
+    def save(self):
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({"next": self.next_number, "pending": self.pending, "segments": self.segments}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.manifest_file)
+        st = os.stat(self.manifest_file)
+        self.manifest_stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self._index()
+
+    def line_count(self):
+        return self.line_starts[-1]
+
+    def covered(self, inode):
+        """Bytes at the start of the live log with this inode that are already in a segment."""
+        if self.pending and self.pending["inode"] == inode:
+            return self.pending["size"]
+        return 0
+
+    def rotate(self, keep, min_size=0):
+        """Move the complete lines of the live log into a new segment, keeping the newest keep segments.
+
+        Nothing happens unless the log has grown to min_size bytes.
+        """
+        self.finish_rotation()
+        try:
+            st = os.stat(self.log_file)
+        except FileNotFoundError:
+            return False
+        if st.st_size < min_size or not st.st_size:
+            return False
+        segment_file = f"{self.log_file}.{self.next_number}.gz"
+        chunks = []
+        lines = 0
+        size = 0
+        with open(self.log_file, 'rb') as log, open(f"{segment_file}.tmp", 'wb') as out:
+            offset = 0
+            while True:
+                data = log.read(CHUNK_SIZE)
+                end = data.rfind(b'\n') + 1
+                while end == 0 and len(data) % CHUNK_SIZE == 0:  # A line longer than a chunk
+                    more = log.read(CHUNK_SIZE)
+                    if not more:
+                        break
+                    data += more
+                    end = data.rfind(b'\n') + 1
+                if end == 0:
+                    break
+                log.seek(size + end)
+                data = data[:end]
+                member = _compress_member(data)
+                out.write(member)
+                count = data.count(b'\n')
+                chunks.append([offset, len(member), count])
+                offset += len(member)
+                lines += count
+                size += end
+            out.flush()
+            os.fsync(out.fileno())
+        if not lines:
+            os.remove(f"{segment_file}.tmp")
+            return False
+        os.replace(f"{segment_file}.tmp", segment_file)
+
+        # Record the segment together with the part of the live log it covers before
+        # truncating the log, so a crash in between never loses or duplicates lines.
+        self.segments.append({"file": os.path.basename(segment_file), "lines": lines, "bytes": size,
+                              "chunks": chunks})
+        self.next_number += 1
+        self.pending = {"inode": st.st_ino, "size": size}
+        for segment in self.segments[:max(0, len(self.segments) - keep)]:
+            try:
+                os.remove(self.path(segment))
+            except FileNotFoundError:
+                pass
+        self.segments = self.segments[max(0, len(self.segments) - keep):]
+        self.save()
+        self.finish_rotation()
+        return True
+
+    def finish_rotation(self):
+        """Drop the part of the live log that a segment already covers."""
+        if not self.pending:
+            return
+        try:
+            st = os.stat(self.log_file)
+        except FileNotFoundError:
+            st = None
+        if st is not None and st.st_ino == self.pending["inode"] and st.st_size >= self.pending["size"]:
+            tmp_file = f"{self.log_file}.tmp"
+            with open(self.log_file, 'rb') as log, open(tmp_file, 'wb') as out:
+                log.seek(self.pending["size"])
+                out.write(log.read())
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_file, self.log_file)
+        self.pending = None
+        self.save()
+
+    def archive(self, suffix):
+        """Rename the manifest and all segments with suffix and start with no segments."""
+        for segment in self.segments:
+            if os.path.exists(self.path(segment)):
+                os.rename(self.path(segment), f"{self.path(segment)}{suffix}")
+        if os.path.exists(self.manifest_file):
+            os.rename(self.manifest_file, f"{self.manifest_file}{suffix}")
+        self.cache.clear()
+        self.load()
+
+    def path(self, segment):
+        return os.path.join(os.path.dirname(self.log_file), segment["file"])
+
+    def _member_lines(self, segment, member):
+        key = (segment["file"], member)
+        lines = self.cache.get(key)
+        if lines is not None:
+            self.cache.move_to_end(key)
+            return lines
+        offset, length, _ = segment["chunks"][member]
+        with open(self.path(segment), 'rb') as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(length), wbits=31)
+        lines = data.split(b'\n')[:-1]
+        self.cache[key] = lines
+        if len(self.cache) > CHUNK_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return lines
+
+    def get_lines(self, start, count):
+        """Return up to count lines starting at line start across all segments, as bytes."""
+        lines = []
+        end = min(start + count, self.line_count())
+        i = start
+        while i < end:
+            s = bisect_right(self.line_starts, i) - 1
+            segment = self.segments[s]
+            local = i - self.line_starts[s]
+            member_start = 0
+            for member, (_, _, member_lines) in enumerate(segment["chunks"]):
+                if local < member_start + member_lines:
+                    break
+                member_start += member_lines
+            try:
+                data = self._member_lines(segment, member)
+            except (OSError, zlib.error):
+                data = [b"[segment " + segment["file"].encode() + b" is unreadable]"] * member_lines
+            taken = data[local - member_start:local - member_start + end - i]
+            if not taken:
+                break
+            lines.extend(taken)
+            i += len(taken)
+        return lines
+
+
+def _compress_member(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
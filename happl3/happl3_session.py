@@ -0,0 +1,252 @@
+import re
+import threading
+import time
+from .happl3_shell import Happl3Shell, Happl3ShellError, Happl3ShellCancelled
+
+# A session idle for longer than this is checked with a heartbeat command before it runs the next step
+HEARTBEAT_INTERVAL = 30.0
+HEARTBEAT_TIMEOUT = 10.0
+HEARTBEAT_COMMANDS = {"bash": ":", "pwsh": "$null"}
+# Seconds a cancelled command gets to exit after SIGTERM before its process group is killed
+CANCEL_GRACE = 3.0
+
+# A comment row with this text marks the command below it as session setup
+SETUP_ANNOTATION = "#@setup"
+SETUP_ANNOTATION_PATTERN = re.compile(rb'^[ \t]*' + re.escape(SETUP_ANNOTATION.encode()) + rb'[ \t]*$', re.MULTILINE)
+
+# Commands that change the state of the shell session rather than the system: variable
+# assignments, directory changes, sourced files, aliases, functions and shell options.
+SETUP_PATTERNS = {
+    "bash": re.compile(
+        rb'^[ \t]*(?:(?:export|declare|typeset|readonly)[ \t]+(?:-\w+[ \t]+)*)?[A-Za-z_][A-Za-z0-9_]*\+?='
+        rb'(?:"[^"\n]*"|\'[^\'\n]*\'|[^\s;&|"\'])*[ \t]*(?:#.*)?$'
+        rb'|^[ \t]*(?:cd|pushd|popd|source|\.|alias|unalias|unset|set|shopt|umask|ulimit|export)(?:[ \t].*)?$'
+        rb'|^[ \t]*(?:function[ \t]+[\w-]+|[\w-]+[ \t]*\(\)).*$', re.MULTILINE),
+    "pwsh": re.compile(
+        rb'^[ \t]*\$(?:env:|global:|script:)?[\w]+[ \t]*(?:[-+*/]?=)(?!=).*$'
+        rb'|^[ \t]*(?:cd|sl|Set-Location|Push-Location|Pop-Location|Import-Module|Set-Variable|sv|'
+        rb'Set-Alias|New-Alias|Set-PSDebug|Set-StrictMode|\.)(?:[ \t].*)?$'
+        rb'|^[ \t]*function[ \t].*$', re.MULTILINE | re.IGNORECASE),
+}
+
+
+def is_setup_command(command, shell_type):
+    return SETUP_PATTERNS[shell_type].fullmatch(command.strip().encode()) is not None
+
+
+class Happl3SessionManager:
+    """Keeps a shell session ready to run plan steps.
+
+    The shell is started on a background thread so it warms up while the
+    plan loads. Before a step runs, a session that exited, or that stopped
+    answering heartbeats after being idle, is replaced by a new one, and the
+    setup commands that ran so far (variable assignments, cd, ...) are
+    replayed into it. A step that exceeds the timeout or is cancelled is
+    killed together with its process group and the next step gets a fresh
+    session.
+
+    Managers created with sibling() share their setup commands, so a
+    variable set in one session is replayed into the others before their
+    next step. With launcher, the shell is started by that command line
+    instead, e.g. on another host with ssh.
+    """
+
+    def __init__(self, shell_type, timeout=None, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 setup_commands=None, setup_lock=None, launcher=None):
+        self.shell_type = shell_type
+        self.timeout = timeout
+        self.launcher = launcher
+        self.heartbeat_interval = heartbeat_interval
+        self.shell = None
+        self.setup_commands = setup_commands if setup_commands is not None else []
+        self.setup_lock = setup_lock if setup_lock is not None else threading.Lock()
+        self.replayed = 0  # Number of leading setup_commands that ran in the current shell
+        self.ahead = set()  # Positions after those that also ran in the current shell
+        self.starts = 0
+        self.last_used = 0.0
+        self.closed = False
+        self.running = None  # Shell running a plan step, if any
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.warm_up()
+
+    def sibling(self):
+        """Return a new session manager for the same shell that shares this one's setup commands."""
+        return Happl3SessionManager(self.shell_type, self.timeout, self.heartbeat_interval,
+                                    self.setup_commands, self.setup_lock, self.launcher)
+
+    def warm_up(self):
+        """Start the shell and replay the setup commands on a background thread."""
+        threading.Thread(target=self._warm_up, daemon=True).start()
+
+    def _warm_up(self):
+        with self.lock:
+            try:
+                self._ensure()
+            except (Happl3ShellError, OSError):
+                self._discard()  # run_command() retries and reports the error
+
+    def add_setup(self, commands):
+        """Declare commands that already ran in earlier sessions and must be replayed into this one."""
+        with self.setup_lock:  # Not self.lock, a warm-up may hold it for a while
+            self.setup_commands.extend(commands)
+        self.warm_up()
+
+    def _remember(self, command):
+        """Record a setup command that just ran in the current shell."""
+        with self.setup_lock:
+            self.setup_commands.append(command)
+            position = len(self.setup_commands) - 1
+        if position == self.replayed:
+            self.replayed += 1
+        else:
+            self.ahead.add(position)  # A sibling added setup commands this shell has not run yet
+
+    def _notice(self, on_output, text):
+        if on_output:
+            on_output("stderr", f"[happl3] {text}\n")
+
+    def _healthy(self):
+        if not self.shell.alive():
+            return False
+        if time.monotonic() - self.last_used < self.heartbeat_interval:
+            return True
+        try:
+            self.shell.run_command(HEARTBEAT_COMMANDS[self.shell_type], timeout=HEARTBEAT_TIMEOUT)
+        except Happl3ShellError:
+            return False
+        self.last_used = time.monotonic()
+        return True
+
+    def _discard(self):
+        if self.shell is not None:
+            self.shell.kill()
+            self.shell = None
+
+    def _ensure(self, on_output=None):
+        """Return a responsive shell with all setup commands applied. Call with the lock held."""
+        if self.closed:
+            raise Happl3ShellError("Shell session is closed")
+        if self.shell is not None and not self._healthy():
+            self._notice(on_output, "Shell session stopped responding, restarting it")
+            self._discard()
+        if self.shell is None:
+            self.shell = Happl3Shell(self.shell_type, self.launcher)
+            self.replayed = 0
+            self.ahead.clear()
+            if self.starts and self.setup_commands:
+                self._notice(on_output, f"Replaying {len(self.setup_commands)} setup commands into the new session")
+            self.starts += 1
+        while self.replayed < len(self.setup_commands):
+            if self.replayed in self.ahead:
+                self.ahead.discard(self.replayed)
+                self.replayed += 1
+                continue
+            result = self.shell.run_command(self.setup_commands[self.replayed], timeout=self.timeout)
+            if not result.succeeded:
+                self._notice(on_output, f"Setup command failed with exit code {result.exit_code}: "
+                                        f"{self.setup_commands[self.replayed]}")
+            self.replayed += 1
+        self.last_used = time.monotonic()
+        return self.shell
+
+    def working_directory(self):
+        """The working directory of the shell, with the setup commands applied, or None if the shell is not usable."""
+        with self.lock:
+            try:
+                shell = self._ensure()
+                if shell.cwd is None:
+                    shell.run_command(HEARTBEAT_COMMANDS[self.shell_type], timeout=HEARTBEAT_TIMEOUT)
+            except (Happl3ShellError, OSError):
+                self._discard()  # run_command() retries and reports the error
+                return None
+            return shell.cwd
+
+    def run_command(self, command, on_output=None, setup=None):
+        """Run command like Happl3Shell.run_command(), restarting the session first if needed.
+
+        A successful command is remembered for replay if setup is true, or,
+        when setup is None, if it looks like a session setup command.
+        """
+        with self.lock:
+            self.cancelled = False
+            try:
+                shell = self._ensure(on_output)
+                self.running = shell
+                result = shell.run_command(command, on_output=on_output, timeout=self.timeout)
+            except (Happl3ShellError, OSError) as e:
+                # The next command gets a new session
+                self._discard()
+                if self.cancelled:
+                    raise Happl3ShellCancelled("Cancelled by user")
+                if isinstance(e, Happl3ShellError):
+                    raise
+                raise Happl3ShellError(f"Could not start the {self.shell_type} session: {e}")
+            finally:
+                self.running = None
+            self.last_used = time.monotonic()
+            if result.succeeded and (is_setup_command(command, self.shell_type) if setup is None else setup):
+                self._remember(command)
+            return result
+
+    def run_window(self, commands, on_output=None, on_result=None, setup=None, stop_on_failure=True):
+        """Run commands like Happl3Shell.run_window(), restarting the session first if needed.
+
+        setup is a list with a flag per command, as for run_command().
+        """
+        setup = setup if setup is not None else [None] * len(commands)
+
+        def finished(position, result):
+            command = commands[position]
+            flag = setup[position]
+            if result.succeeded and (is_setup_command(command, self.shell_type) if flag is None else flag):
+                self._remember(command)
+            if on_result:
+                on_result(position, result)
+
+        with self.lock:
+            self.cancelled = False
+            try:
+                shell = self._ensure((lambda stream, text: on_output(0, stream, text)) if on_output else None)
+                self.running = shell
+                results = shell.run_window(commands, on_output=on_output, on_result=finished,
+                                           timeout=self.timeout, stop_on_failure=stop_on_failure)
+            except (Happl3ShellError, OSError) as e:
+                self._discard()
+                if self.cancelled:
+                    raise Happl3ShellCancelled("Cancelled by user")
+                if isinstance(e, Happl3ShellError):
+                    raise
+                raise Happl3ShellError(f"Could not start the {self.shell_type} session: {e}")
+            finally:
+                self.running = None
+            self.last_used = time.monotonic()
+            return results
+
+    def cancel(self, grace=CANCEL_GRACE):
+        """Stop the running step from another thread: SIGTERM its process group, SIGKILL after grace seconds.
+
+        Returns False if no step is running.
+        """
+        shell = self.running
+        if shell is None:
+            return False
+        self.cancelled = True
+        shell.interrupt()
+        timer = threading.Timer(grace, lambda: self.running is shell and shell.interrupt(force=True))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def close_session(self):
+        self.closed = True
+        # A warm-up still replaying setup commands must not keep the application from exiting
+        if self.lock.acquire(timeout=1.0):
+            try:
+                if self.shell is not None:
+                    self.shell.close_session()
+                    self.shell = None
+            finally:
+                self.lock.release()
+        elif self.shell is not None:
+            self.shell.kill()
@@ -1,52 +1,428 @@
 import subprocess
 import platform
 import os
+import codecs
+import queue
+import selectors
+import shlex
+import signal
+import tempfile
+import threading
+import time
+from .happl3_resources import Happl3ResourceSampler, RSS_SAMPLE_INTERVAL, usage_between
+
+OUTPUT_COMPLETE_MARKER = "OUTPUT_COMPLETE_MARKER"
+READ_CHUNK_SIZE = 65536
+# Seconds without output after which the shell running a step is checked. A bash that neither used CPU nor
+# ran a process between two checks waits for input that never comes, and the step fails.
+STEP_HEARTBEAT_INTERVAL = 5.0
+# Seconds the output of an exited shell is still read for, to log it with the error
+EXIT_DRAIN_TIMEOUT = 1.0
+
+
+class Happl3ShellError(Exception):
+    """Raised when the shell session can no longer run commands."""
+
+
+class Happl3ShellTimeout(Happl3ShellError):
+    """Raised when a command did not finish within its timeout."""
+
+
+class Happl3ShellCancelled(Happl3ShellError):
+    """Raised when the running command was cancelled by the user."""
+
+
+def plan_shell_type(plan_file):
+    return "pwsh" if plan_file.endswith('.ps1') else "bash"
+
+
+class Happl3CommandResult:
+    def __init__(self, command, exit_code, output, started=None, ended=None, output_bytes=0,
+                 marker_latency=0.0, overhead=0.0, usage=None):
+        self.command = command
+        self.exit_code = exit_code
+        self.output = output
+        self.started = started  # time.monotonic() when the command was written to the shell
+        self.ended = ended  # time.monotonic() when the markers on both streams had been read
+        self.output_bytes = output_bytes
+        self.marker_latency = marker_latency  # Delay between the stdout and stderr markers
+        self.overhead = overhead  # Time spent in Python reading, decoding and dispatching output
+        self.usage = usage if usage else {}  # cpu_user, cpu_sys, max_rss_kb, read_bytes, write_bytes
+
+    @property
+    def duration(self):
+        return self.ended - self.started
+
+    @property
+    def succeeded(self):
+        return self.exit_code == 0
+
+    @property
+    def skipped(self):
+        """True for a command of a pipelined window that did not run because an earlier one failed."""
+        return self.exit_code is None
+
 
 class Happl3Shell:
-    def __init__(self, shell_type="pwsh"):
+    def __init__(self, shell_type="pwsh", launcher=None):
         self.process = None
         self.env = os.environ.copy()
         self.env["TERM"] = "dumb"
         self.shell_type = shell_type
+        self.launcher = launcher  # Command line that starts the shell elsewhere, e.g. ["ssh", "-T", "host", "bash"]
+        self.cwd = None  # Working directory of the shell after the last command, reported with its marker
+        # The processes of a launched shell run elsewhere, and pwsh waits inside its own process
+        self.step_heartbeat = STEP_HEARTBEAT_INTERVAL if shell_type == "bash" and not launcher else None
         if shell_type == "pwsh":
             self.shell_executable = "powershell.exe" if platform.system() == "Windows" else "pwsh"
         elif shell_type == "bash":
             self.shell_executable = "bash"
+        if launcher:
+            self.shell_executable = launcher[0]
         self.start_session()
 
     def start_session(self):
+        if self.launcher:
+            args = self.launcher
+        elif self.shell_type == "pwsh":
+            args = [self.shell_executable, "-NoExit", "-Command", "-"]
+        else:
+            args = [self.shell_executable]
         self.process = subprocess.Popen(
-            [self.shell_executable, "-NoExit", "-Command", "-"] if self.shell_type == "pwsh" else [self.shell_executable],
+            args,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True,
-            env=self.env
+            bufsize=0,
+            env=self.env,
+            # Own process group, so a timed out command can be killed with everything it started
+            start_new_session=platform.system() != "Windows",
+            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP if platform.system() == "Windows" else 0
         )
-
-    def run_command(self, command):
-        if self.shell_type == "pwsh":
-            marked_command = f'{command}; Write-Output "OUTPUT_COMPLETE_MARKER"\n'
+        self.streams = {"stdout": self.process.stdout, "stderr": self.process.stderr}
+        self.resources = Happl3ResourceSampler(self.process.pid)
+        if platform.system() == "Windows":
+            # select() only works on sockets on Windows, so pipes are drained by reader threads
+            self.selector = None
+            self.chunks = queue.Queue()
+            for name, stream in self.streams.items():
+                threading.Thread(target=self._pump, args=(name, stream), daemon=True).start()
         else:
-            marked_command = f'{command}\necho "OUTPUT_COMPLETE_MARKER"\n'
-        self.process.stdin.write(marked_command)
-        self.process.stdin.flush()
+            self.selector = selectors.DefaultSelector()
+            for name, stream in self.streams.items():
+                self.selector.register(stream, selectors.EVENT_READ, name)
 
-        output_lines = []
+    def _pump(self, name, stream):
         while True:
-            line = self.process.stdout.readline()
-            if "OUTPUT_COMPLETE_MARKER" in line:
+            try:
+                data = os.read(stream.fileno(), READ_CHUNK_SIZE)
+            except OSError:
+                data = b""  # Closed by kill()
+            self.chunks.put((name, data))
+            if not data:
                 break
-            if line:
-                output_lines.append(line.strip())
 
-        return "\n".join(output_lines)
+    def _read_chunks(self, timeout=None):
+        """Wait for output on either stream and return a list of (stream name, bytes)."""
+        if self.selector is None:
+            try:
+                chunks = [self.chunks.get(timeout=timeout)]
+            except queue.Empty:
+                return []
+            while not self.chunks.empty():
+                chunks.append(self.chunks.get_nowait())
+            return chunks
+        return [(key.data, os.read(key.fileobj.fileno(), READ_CHUNK_SIZE))
+                for key, _ in self.selector.select(timeout)]
 
-    def close_session(self):
+    def _remaining_output(self, chunks):
+        """Read the streams of an exited shell to their end and return the bytes left in chunks and them, by stream."""
+        remaining = {name: b"" for name in self.streams}
+        open_streams = set(self.streams)
+        deadline = time.monotonic() + EXIT_DRAIN_TIMEOUT
+        while True:
+            for name, data in chunks:
+                if data:
+                    remaining[name] += data
+                elif name in open_streams:
+                    open_streams.discard(name)
+                    if self.selector is not None:
+                        self.selector.unregister(self.streams[name])
+            # A process the shell started in the background may keep a stream open
+            wait = deadline - time.monotonic()
+            if not open_streams or wait <= 0:
+                return remaining
+            chunks = self._read_chunks(wait)
+
+    def marked_command(self, command):
+        """Append the completion marker to command, carrying its exit code and the working directory on stdout
+        and a bare marker on stderr."""
         if self.shell_type == "pwsh":
-            self.process.stdin.write("exit\n")
-        self.process.stdin.flush()
-        self.process.terminate()
+            return (f'{command}; $__happl3_rc = if ($?) {{ 0 }} elseif ($LASTEXITCODE) {{ $LASTEXITCODE }} else {{ 1 }}; '
+                    f'Write-Output "{OUTPUT_COMPLETE_MARKER} $__happl3_rc $($PWD.Path)"; [Console]::Error.WriteLine("{OUTPUT_COMPLETE_MARKER}")\n')
+        return (f'{command}\n__happl3_rc=$?; echo "{OUTPUT_COMPLETE_MARKER} $__happl3_rc $PWD"; '
+                f'echo "{OUTPUT_COMPLETE_MARKER}" >&2\n')
+
+    def guarded_command(self, command, sentinel, stop_on_failure=True):
+        """Wrap command for a pipelined window: it is skipped (exit code "-") once an earlier command in the window failed.
+
+        bash windows run with stderr redirected to stdout, so they only mark stdout.
+        """
+        if self.shell_type == "pwsh":
+            abort = "if ($__happl3_rc -ne 0) { $__happl3_abort = 1 }; " if stop_on_failure else ""
+            return (f'if (-not $__happl3_abort) {{ {command}; $__happl3_rc = if ($?) {{ 0 }} elseif ($LASTEXITCODE) '
+                    f'{{ $LASTEXITCODE }} else {{ 1 }}; {abort}}} else {{ $__happl3_rc = "-" }}; '
+                    f'Write-Output "{sentinel} $__happl3_rc $($PWD.Path)"; [Console]::Error.WriteLine("{sentinel}")\n')
+        abort = ' [ "$__happl3_rc" -eq 0 ] || __happl3_abort=1;' if stop_on_failure else ""
+        return f'if [ -z "$__happl3_abort" ]; then\n{command}\n__happl3_rc=$?;{abort} else __happl3_rc=-; fi; echo "{sentinel} $__happl3_rc $PWD"\n'
+
+    def _send(self, script):
+        try:
+            self.process.stdin.write(script.encode())
+            self.process.stdin.flush()
+        except OSError:
+            raise Happl3ShellError(f"{self.shell_executable} session is not running")
+
+    def run_command(self, command, on_output=None, timeout=None):
+        """Run command in the session and return a Happl3CommandResult.
+
+        stdout and stderr are drained concurrently until the marker has been
+        seen on both, so a chatty stderr can never fill its pipe and stall the
+        shell. Complete lines are passed to on_output(stream, text) as they
+        arrive; without a callback they are collected into result.output.
+        Raises Happl3ShellTimeout after timeout seconds, leaving the session
+        busy; kill() it before starting a new one. Raises Happl3ShellError if
+        the shell exits, after passing on its last output, or if it waits for
+        input instead of running the command (see STEP_HEARTBEAT_INTERVAL).
+        """
+        counters = self.resources.counters()
+        started = time.monotonic()
+        self._send(self.marked_command(command))
+        emit = (lambda position, stream, text: on_output(stream, text)) if on_output else None
+        return self._collect([command], [OUTPUT_COMPLETE_MARKER], started, emit, None, timeout, counters=counters)[0]
+
+    def run_window(self, commands, on_output=None, on_result=None, timeout=None, stop_on_failure=True):
+        """Send several commands at once and return their Happl3CommandResults in order.
+
+        Each command ends with its own sentinel, so the shell never waits for
+        a round trip between commands and output is assigned to the command
+        that printed it. bash windows merge stderr into stdout, which keeps
+        the two in order; their output is all reported as "stdout". If stop_on_failure, the commands after the first
+        failure are skipped by the shell and have exit_code None. Lines are
+        passed to on_output(position, stream, text) and each result to
+        on_result(position, result) as soon as that command finished. The
+        timeout applies to each command.
+        """
+        nonce = os.urandom(4).hex()
+        sentinels = [f"{OUTPUT_COMPLETE_MARKER}:{nonce}:{i}" for i in range(len(commands))]
+        script = "".join(self.guarded_command(command, sentinel, stop_on_failure)
+                         for command, sentinel in zip(commands, sentinels))
+        counters = self.resources.counters()
+        started = time.monotonic()
+        if self.shell_type == "pwsh":
+            self._send("$__happl3_abort = $null\n" + script)
+            return self._collect(commands, sentinels, started, on_output, on_result, timeout, counters=counters)
+
+        # bash reads a pipe one byte at a time, but a sourced file in large blocks
+        fd, script_file = tempfile.mkstemp(prefix="happl3-", suffix=".sh")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write("unset __happl3_abort\n" + script)
+            # A syntax error ends the sourced file early, so the trailer tells that no more sentinels will come
+            trailer = f"{OUTPUT_COMPLETE_MARKER}:{nonce}:END"
+            self._send(f'. {shlex.quote(script_file)} 2>&1; echo "{trailer} $?"\n')
+            return self._collect(commands, sentinels, started, on_output, on_result, timeout, ("stdout",),
+                                 counters=counters, trailer=trailer)
+        finally:
+            os.remove(script_file)
+
+    def _collect(self, commands, sentinels, started, on_output, on_result, timeout, marked=("stdout", "stderr"),
+                 counters=None, trailer=None):
+        """Read output until the sentinel of every command has been seen on each of the marked streams.
+
+        counters are the shell's resource counters from before the commands were sent. If trailer is
+        given, reading goes on until it is seen on stdout; when it comes before all the sentinels, the
+        shell stopped reading the commands there, so the current command failed and the rest are skipped.
+        """
+        count = len(commands)
+        output_lines = [[] for _ in commands]
+        emit = on_output if on_output else lambda position, stream, text: output_lines[position].append(text)
+        decoders = {name: codecs.getincrementaldecoder('utf-8')('replace') for name in self.streams}
+        partial = {name: "" for name in self.streams}
+        position = {name: 0 for name in marked}  # Command whose output each marked stream is carrying
+        markers_seen = [0] * count
+        exit_codes = [None] * count
+        output_bytes = [0] * count
+        first_marker = [None] * count
+        results = []
+        step_started = started
+        waited = 0.0
+        deadline = started + timeout if timeout else None
+        sampling = self.resources.available
+        peak_rss = None
+        next_sample = started  # Right after the commands were sent, then every RSS_SAMPLE_INTERVAL and at the end
+        check_at = started + self.step_heartbeat if self.step_heartbeat and sampling else None
+        activity = None  # Shell activity seen by the last check since the last output
+
+        def sample():
+            nonlocal peak_rss, next_sample
+            rss = self.resources.tree_rss_kb()
+            if rss is not None:
+                peak_rss = rss if peak_rss is None else max(peak_rss, rss)
+            next_sample = time.monotonic() + RSS_SAMPLE_INTERVAL
+
+        def finish(i):
+            nonlocal counters, step_started, waited, peak_rss, deadline, next_sample
+            if sampling:
+                sample()
+            ended = time.monotonic()
+            previous, counters = counters, self.resources.counters()
+            latency = ended - first_marker[i] if first_marker[i] is not None else 0.0
+            result = Happl3CommandResult(commands[i], exit_codes[i], "".join(output_lines[i]).rstrip("\n"),
+                                         started=step_started, ended=ended, output_bytes=output_bytes[i],
+                                         marker_latency=latency, overhead=max(0.0, ended - step_started - waited),
+                                         usage=usage_between(previous, counters, peak_rss))
+            results.append(result)
+            step_started, waited, peak_rss, next_sample = ended, 0.0, None, ended
+            if deadline is not None:
+                deadline = ended + timeout
+            if on_result:
+                on_result(i, result)
+
+        while len(results) < count or trailer is not None:
+            wait_started = time.monotonic()
+            if deadline is not None and wait_started >= deadline:
+                raise Happl3ShellTimeout(f"Command timed out after {timeout:g}s")
+            wait = None if deadline is None else deadline - wait_started
+            if sampling:
+                wait = max(0.0, min(next_sample - wait_started, RSS_SAMPLE_INTERVAL if wait is None else wait))
+            chunks = self._read_chunks(wait)
+            waited += time.monotonic() - wait_started
+            if sampling and time.monotonic() >= next_sample:
+                sample()
+            if check_at is not None:
+                if chunks:
+                    activity = None
+                    check_at = time.monotonic() + self.step_heartbeat
+                elif time.monotonic() >= check_at:
+                    state = self.resources.activity()
+                    if state is not None and state == activity and not state[1]:
+                        raise Happl3ShellError(f"{self.shell_executable} session waits for input instead of running "
+                                               f"(unterminated quote or redirected output?): "
+                                               f"{commands[min(len(results), count - 1)]}")
+                    activity = state
+                    check_at = time.monotonic() + self.step_heartbeat
+            for k, (name, data) in enumerate(chunks):
+                if not data:
+                    # Pass on what the shell printed before it exited, e.g. the syntax error that ended it
+                    i = min(len(results), count - 1)
+                    for stream, rest in self._remaining_output(chunks[k:]).items():
+                        lines = (partial[stream] + decoders[stream].decode(rest, final=True)).split("\n")
+                        for line in lines if lines[-1] else lines[:-1]:
+                            if OUTPUT_COMPLETE_MARKER not in line:
+                                emit(i, stream, line.rstrip("\r") + "\n")
+                    try:
+                        self.process.wait(EXIT_DRAIN_TIMEOUT)
+                    except subprocess.TimeoutExpired:  # Still running, e.g. after exec 2>/dev/null
+                        raise Happl3ShellError(f"{self.shell_executable} session closed its {name} while running: "
+                                               f"{commands[i]}")
+                    raise Happl3ShellError(f"{self.shell_executable} session exited while running: {commands[i]}")
+                if position.get(name, 0) >= count and (trailer is None or name != "stdout"):
+                    continue
+                lines = (partial[name] + decoders[name].decode(data)).split("\n")
+                partial[name] = lines.pop()
+                for line in lines:
+                    if trailer is not None and name == "stdout" and trailer in line:
+                        before, _, after = line.partition(trailer)
+                        trailer = None
+                        if len(results) < count:
+                            i = len(results)
+                            if before:
+                                output_bytes[i] += len(before.encode()) + 1
+                                emit(i, name, before + "\n")
+                            code = after.strip()
+                            exit_codes[i] = int(code) if code.isdigit() and code != "0" else 1
+                            finish(i)
+                            for j in range(i + 1, count):
+                                exit_codes[j] = None
+                                finish(j)
+                        break
+                    # Unmarked streams are attributed to the oldest unfinished command
+                    i = position[name] if name in marked else len(results)
+                    if i >= count:
+                        break
+                    line = line.rstrip("\r")
+                    if name not in marked or sentinels[i] not in line:
+                        output_bytes[i] += (len(line) if line.isascii() else len(line.encode())) + 1
+                        emit(i, name, line + "\n")
+                        continue
+                    before, _, after = line.partition(sentinels[i])
+                    if before:
+                        output_bytes[i] += len(before.encode()) + 1
+                        emit(i, name, before + "\n")
+                    if first_marker[i] is None:
+                        first_marker[i] = time.monotonic()
+                    if name == "stdout":
+                        code, _, cwd = after.strip().partition(" ")
+                        if cwd:
+                            self.cwd = cwd
+                        try:
+                            exit_codes[i] = None if code == "-" else int(code)
+                        except ValueError:
+                            exit_codes[i] = 1
+                    position[name] += 1
+                    markers_seen[i] += 1
+                    if markers_seen[i] < len(marked):
+                        continue
+                    # Streams are read in order, so commands complete in order
+                    finish(i)
+
+        return results
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def interrupt(self, force=False):
+        """Signal the shell's process group to stop: SIGTERM (CTRL_BREAK on Windows), or SIGKILL if force.
+
+        Unlike kill() this is safe to call while another thread is running a command.
+        """
+        try:
+            if platform.system() == "Windows":
+                if self.process.poll() is not None:
+                    return
+                if force:
+                    self.process.kill()
+                else:
+                    self.process.send_signal(signal.CTRL_BREAK_EVENT)
+            else:
+                os.killpg(self.process.pid, signal.SIGKILL if force else signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        """Kill the shell and every process it started."""
+        # The process group can outlive the shell, so it is signalled even if the shell already exited
+        self.interrupt(force=True)
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            stream.close()
+        if self.selector is not None:
+            self.selector.close()
+        self.resources.close()
+
+    def close_session(self):
+        if self.process.poll() is None:
+            try:
+                if self.shell_type == "pwsh":
+                    self.process.stdin.write(b"exit\n")
+                self.process.stdin.flush()
+            except OSError:
+                pass
+            self.process.terminate()
+        if self.selector is not None:
+            self.selector.close()
+        self.resources.close()
 
 def run_shell_commands(commands, shell_type="pwsh"):
     shell_session = Happl3Shell(shell_type)
@@ -55,7 +431,7 @@ def run_shell_commands(commands, shell_type="pwsh"):
     try:
         for command in commands:
             result = shell_session.run_command(command)
-            results.append(result)
+            results.append(result.output)
     finally:
         shell_session.close_session()
 
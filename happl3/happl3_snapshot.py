@@ -0,0 +1,137 @@
+import os
+import json
+import math
+import mmap
+import struct
+import hashlib
+from array import array
+from .happl3_store import Happl3Store, METRIC_NAMES
+
+SNAPSHOT_MAGIC = b"HPL3SNP1"
+SNAPSHOT_HEADER = struct.Struct("<8sI")  # Magic, length of the JSON header that follows
+# Columns start at multiples of this, so that the 'Q' and 'd' columns are aligned in the mapping
+SNAPSHOT_ALIGNMENT = 8
+# memoryview format of the columns kept as views into the mapping; the others are copied
+COLUMN_FORMATS = {"buffer": 'B', "offsets": 'Q', "digests": 'B', "outputs": 'B', "timestamps": 'd'}
+COLUMN_FORMATS.update((f"metric:{name}", 'd') for name in METRIC_NAMES)
+
+
+def file_signature(path):
+    """[inode, size, mtime_ns] of path, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def plan_key(st, data):
+    """Identify the plan text a store was built from by the file's stat result and a hash of its bytes."""
+    return {"signature": [st.st_ino, st.st_size, st.st_mtime_ns],
+            "hash": hashlib.blake2b(data, digest_size=16).hexdigest()}
+
+
+def _padding(offset):
+    return -offset % SNAPSHOT_ALIGNMENT
+
+
+def _columns(store):
+    """(name, column, blank column) for every column of the store."""
+    rows = len(store)
+    blank_metric = array('d', [math.nan]) * rows
+    columns = [
+        ("buffer", store.buffer, None),
+        ("offsets", store.offsets, None),
+        ("digests", store.digests, None),
+        ("status", store.status, None),
+        ("selected", store.selected, bytearray(rows)),
+        ("outputs", store.outputs, bytearray(len(store.outputs))),
+        ("timestamps", store.timestamps, blank_metric),
+    ]
+    columns += [(f"metric:{name}", store.metrics[name], blank_metric) for name in METRIC_NAMES]
+    return columns
+
+
+def save_snapshot(snapshot_file, store, key, index_signature):
+    """Write the store's columns to snapshot_file, keyed by the plan it was built from and the index it matches.
+
+    Columns without any value are left out. The snapshot is a cache, so it is not fsynced.
+    """
+    chunks = []
+    layout = []
+    offset = 0
+    for name, column, blank in _columns(store):
+        if blank is not None and column == blank:
+            continue
+        data = column.tobytes() if isinstance(column, array) else bytes(column)
+        layout.append([name, offset, len(data)])
+        chunks.append(data + bytes(_padding(len(data))))
+        offset += len(chunks[-1])
+    header = json.dumps({
+        "plan": key,
+        "index": index_signature,
+        "rows": len(store),
+        "columns": layout,
+        "extra": {str(i): fields for i, fields in store.extra.items()},
+    }).encode()
+    header += b" " * _padding(SNAPSHOT_HEADER.size + len(header))
+    tmp_file = f"{snapshot_file}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(header)))
+        f.write(header)
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_file, snapshot_file)
+
+
+def load_snapshot(snapshot_file, plan_file, index_file):
+    """Return (store, plan key) from snapshot_file, or None if it is missing, damaged or stale.
+
+    The snapshot is used if the index file is the one written together with
+    it and the plan file has the same inode, size and mtime as when it was
+    written. Only if the plan's stat differs is it read and hashed, and the
+    snapshot still used if the hash matches. The file is mapped copy-on-write
+    and the large columns are views into the mapping, so loading reads only
+    the pages that are used.
+    """
+    try:
+        with open(snapshot_file, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, header_length = SNAPSHOT_HEADER.unpack_from(mm, 0)
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        header = json.loads(mm[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + header_length])
+        key = header["plan"]
+        if header["index"] != file_signature(index_file):
+            return None
+        if key["signature"] != file_signature(plan_file):
+            with open(plan_file, 'rb') as plan:
+                current = plan_key(os.fstat(plan.fileno()), plan.read())
+            if current["hash"] != key["hash"]:
+                return None
+            key = current  # Touched or copied, but the same text
+
+        rows = header["rows"]
+        base = SNAPSHOT_HEADER.size + header_length
+        view = memoryview(mm)
+        data = {name: view[base + offset:base + offset + length].cast(COLUMN_FORMATS.get(name, 'B'))
+                for name, offset, length in header["columns"]}
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        return None
+
+    store = Happl3Store()
+    store.buffer = data["buffer"]
+    store.offsets = data["offsets"]
+    store.digests = data["digests"]
+    # The flag columns are copied, bytearray.find() and count() scan them
+    store.status = bytearray(data["status"])
+    store.selected = bytearray(data.get("selected", bytes(rows)))
+    store.outputs = data["outputs"] if "outputs" in data else bytearray(len(store.digests) * 2)
+    blank_metric = array('d', [math.nan]) * rows
+    store.timestamps = data["timestamps"] if "timestamps" in data else array('d', blank_metric)
+    store.metrics = {name: data[f"metric:{name}"] if f"metric:{name}" in data else array('d', blank_metric)
+                     for name in METRIC_NAMES}
+    store.extra = {int(i): fields for i, fields in header["extra"].items()}
+    if len(store.offsets) != rows + 1 or len(store.status) != rows or len(store.timestamps) != rows:
+        return None
+    return store, key
@@ -0,0 +1,160 @@
+import heapq
+import math
+
+# Profiles of the worker threads that finished, collected while --profile is given; None otherwise
+_thread_profiles = None
+
+
+def format_seconds(seconds):
+    if seconds < 60:
+        return f"{seconds:.3f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+def format_bytes(count):
+    for unit in ("B", "K", "M", "G"):
+        if count < 1024 or unit == "G":
+            return f"{count:.0f}{unit}" if unit == "B" or count >= 10 else f"{count:.1f}{unit}"
+        count /= 1024
+
+
+def usage_summary(store, i):
+    """Short text of the CPU time, peak memory and I/O of row i's last run, or "" if none was recorded."""
+    user, system = store.metrics["cpu_user"][i], store.metrics["cpu_sys"][i]
+    if math.isnan(user):
+        return ""
+    rss = store.metrics["max_rss_kb"][i]
+    read_bytes, write_bytes = store.metrics["read_bytes"][i], store.metrics["write_bytes"][i]
+    text = f"cpu {format_seconds(user + system):>8}"
+    text += f"  rss {format_bytes(rss * 1024):>5}" if not math.isnan(rss) else "  rss     -"
+    if not math.isnan(read_bytes):
+        text += f"  io {format_bytes(read_bytes):>5}/{format_bytes(write_bytes):<5}"
+    return text
+
+
+def timed_rows(store):
+    """Yield (row, duration) for every row that has a recorded duration."""
+    for i, duration in enumerate(store.metrics["duration"]):
+        if not math.isnan(duration):
+            yield i, duration
+
+
+def slowest_steps(store, count=10):
+    return heapq.nlargest(count, timed_rows(store), key=lambda row: row[1])
+
+
+def heaviest_steps(store, key, count=5):
+    """The count rows with the largest recorded key(store, row), as (row, value)."""
+    values = ((i, key(store, i)) for i in range(len(store)) if not math.isnan(store.metrics["cpu_user"][i]))
+    return heapq.nlargest(count, ((i, v) for i, v in values if not math.isnan(v) and v > 0), key=lambda row: row[1])
+
+
+def block_totals(store):
+    """Return (header row or None, steps timed, total seconds) for each block that has timings."""
+    durations = store.metrics["duration"]
+    blocks = []
+    header, steps, total = None, 0, 0.0
+    for i in range(len(store) + 1):
+        if i == len(store) or store.is_comment(i):
+            if steps:
+                blocks.append((header, steps, total))
+            # A run of comment rows is named after its last row, the one right above the commands
+            header, steps, total = i, 0, 0.0
+            continue
+        if not math.isnan(durations[i]):
+            steps += 1
+            total += durations[i]
+    return blocks
+
+
+def estimate_remaining(store):
+    """Estimate seconds left for the selected rows from their last recorded durations.
+
+    Rows without history are estimated at the mean duration of all timed rows.
+    Returns (seconds, selected rows, rows without history).
+    """
+    durations = store.metrics["duration"]
+    timed = [d for _, d in timed_rows(store)]
+    mean = sum(timed) / len(timed) if timed else 0.0
+    selected = store.selected_rows()
+    known = [durations[i] for i in selected if not math.isnan(durations[i])]
+    unknown = len(selected) - len(known)
+    return sum(known) + unknown * mean, len(selected), unknown
+
+
+def stats_lines(store, width=80):
+    """Render the stats view shown in the output pane."""
+    durations = [d for _, d in timed_rows(store)]
+    total = sum(durations)
+    overhead = sum(v for v in store.metrics["overhead"] if not math.isnan(v))
+    output_bytes = sum(v for v in store.metrics["output_bytes"] if not math.isnan(v))
+    eta, selected, unknown = estimate_remaining(store)
+
+    lines = [
+        f"Timed steps: {len(durations)}   Total: {format_seconds(total)}   "
+        f"Happl3 overhead: {format_seconds(overhead)} ({overhead / total * 100 if total else 0:.1f}%)   "
+        f"Output: {int(output_bytes)} bytes",
+        f"ETA for {selected} selected steps: {format_seconds(eta)}"
+        + (f" ({unknown} without history, estimated at the mean step time)" if unknown else ""),
+        "",
+        "Slowest steps:",
+    ]
+    for i, duration in slowest_steps(store):
+        lines.append(f"  {i + 1:>6}  {format_seconds(duration):>9}  {store[i][:max(0, width - 22)]}")
+    heaviest = [
+        ("CPU time", lambda s, i: s.metrics["cpu_user"][i] + s.metrics["cpu_sys"][i], format_seconds),
+        ("peak memory", lambda s, i: s.metrics["max_rss_kb"][i] * 1024, format_bytes),
+        ("disk I/O", lambda s, i: s.metrics["read_bytes"][i] + s.metrics["write_bytes"][i], format_bytes),
+    ]
+    for title, key, format_value in heaviest:
+        rows = heaviest_steps(store, key)
+        if rows:
+            lines += ["", f"Most {title}:"]
+            lines += [f"  {i + 1:>6}  {format_value(value):>9}  {store[i][:max(0, width - 22)]}" for i, value in rows]
+    lines += ["", "Per-block totals:"]
+    for header, steps, block_total in block_totals(store):
+        name = store[header] if header is not None and store.is_comment(header) else "(plan start)"
+        row = header + 1 if header is not None else 1
+        lines.append(f"  {row:>6}  {format_seconds(block_total):>9}  {steps:>5} steps  {name[:max(0, width - 35)]}")
+    return lines
+
+
+def profile_threads():
+    """Make profiled() functions run under a profiler of their own, as cProfile only sees the thread enabling it."""
+    global _thread_profiles
+    _thread_profiles = []
+
+
+def profiled(function):
+    """Wrap the target of a worker thread so that its profile is merged into --profile's report."""
+    if _thread_profiles is None:
+        return function
+
+    def run(*args, **kwargs):
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.disable()
+            _thread_profiles.append(profiler)
+    return run
+
+
+def write_profile(profiler, path, limit=40):
+    """Dump the stats of profiler and the profiled() threads to path and a report of the top functions to path.txt."""
+    import io
+    import pstats  # Slow to import and only needed for --profile
+    report = io.StringIO()
+    stats = pstats.Stats(profiler, stream=report)
+    for thread_profiler in _thread_profiles or []:
+        stats.add(thread_profiler)
+    stats.dump_stats(path)
+    stats.strip_dirs()
+    stats.sort_stats("cumulative").print_stats(limit)
+    stats.sort_stats("tottime").print_stats(limit)
+    with open(f"{path}.txt", 'w') as f:
+        f.write(report.getvalue())
@@ -0,0 +1,265 @@
+import math
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+from .happl3_utils import command_digest
+
+# Status codes kept in Happl3Store.status. Comment rows get their own code so
+# that status scans never have to look at the command text.
+STATUS_PENDING = 0
+STATUS_SUCCESS = 1
+STATUS_FAILED = 2
+STATUS_COMMENT = 3
+
+STATUS_NAMES = {STATUS_PENDING: "pending", STATUS_SUCCESS: "success", STATUS_FAILED: "failed"}
+STATUS_CODES = {name: code for code, name in STATUS_NAMES.items()}
+DIGEST_SIZE = 16
+# SHA-256 digest of the latest output of a row in the artifact store, all zero if there is none
+OUTPUT_DIGEST_SIZE = 32
+
+# Measurements of the latest run of each row, kept as float columns (NaN = never ran).
+# started/ended are time.monotonic() values and only comparable within one session.
+# Resources used by a command: CPU seconds, peak resident KiB of the shell's process tree and storage I/O bytes
+USAGE_METRICS = ("cpu_user", "cpu_sys", "max_rss_kb", "read_bytes", "write_bytes")
+METRIC_NAMES = ("started", "ended", "duration", "output_bytes", "marker_latency", "overhead") + USAGE_METRICS
+INTEGER_METRICS = {"output_bytes", "max_rss_kb", "read_bytes", "write_bytes"}
+
+
+def _translation(predicate):
+    """bytes.translate() table mapping each status code to 1 if predicate(code) else 0."""
+    return bytes(1 if predicate(code) else 0 for code in range(256))
+
+
+IS_PENDING = _translation(lambda code: code == STATUS_PENDING)
+IS_FAILED = _translation(lambda code: code == STATUS_FAILED)
+IS_COMMAND = _translation(lambda code: code != STATUS_COMMENT)
+
+
+def _owned(column):
+    """column as a bytearray or array, copied out of the snapshot mapping if it is a memoryview into it."""
+    if not isinstance(column, memoryview):
+        return column
+    return bytearray(column) if column.format == 'B' else array(column.format, column.tobytes())
+
+
+def _or_bytes(a, b):
+    """Element-wise OR of two equally long 0/1 byte strings, done in C through int arithmetic."""
+    return (int.from_bytes(a, 'little') | int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+class Happl3Store:
+    """Columnar storage for plan commands and their index state.
+
+    Commands live in one UTF-8 buffer addressed by an offset array, hashes in
+    one buffer of raw MD5 digests, output references in one buffer of raw
+    SHA-256 digests, and status/selected flags in byte arrays
+    with one byte per row. Bulk selection changes are done with
+    bytes.translate() and slice assignment instead of per-row Python loops.
+    The store behaves as a read-only sequence of command strings.
+
+    A store loaded from a snapshot keeps the text, offset, digest, output and
+    metric columns as memoryviews into the snapshot's copy-on-write mapping
+    until splice() changes the number of rows.
+    """
+
+    def __init__(self, lines=()):
+        """Build the store from encoded, stripped, non-empty plan lines."""
+        self.buffer = b"\n".join(lines)
+        self.offsets = array('Q', [0])
+        self.digests = bytearray()
+        self.status = bytearray()
+        for line in lines:
+            self.offsets.append(self.offsets[-1] + len(line) + 1)
+            self.digests += command_digest(line)
+            self.status.append(STATUS_COMMENT if line.startswith(b'#') else STATUS_PENDING)
+        self.selected = bytearray(len(self.status))
+        self.outputs = bytearray(OUTPUT_DIGEST_SIZE * len(self.status))
+        self.timestamps = array('d', [math.nan]) * len(self.status)
+        self.metrics = {name: array('d', [math.nan]) * len(self.status) for name in METRIC_NAMES}
+        self.extra = {}  # Row -> dict of index entry fields the store has no column for
+
+    def __len__(self):
+        return len(self.status)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return str(self.buffer[self.offsets[i]:self.offsets[i + 1] - 1], 'utf-8', 'replace')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def is_comment(self, i):
+        return self.status[i] == STATUS_COMMENT
+
+    def digest(self, i):
+        return bytes(self.digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+
+    def digest_list(self):
+        return [bytes(self.digests[i:i + DIGEST_SIZE]) for i in range(0, len(self.digests), DIGEST_SIZE)]
+
+    def status_name(self, i):
+        """Status of row i as stored in the index. Comment rows report "pending" like before."""
+        return STATUS_NAMES.get(self.status[i], "pending")
+
+    def set_status(self, i, name):
+        if self.status[i] != STATUS_COMMENT:
+            self.status[i] = STATUS_CODES[name]
+
+    def is_selected(self, i):
+        return self.selected[i] == 1
+
+    def set_selected(self, i, selected):
+        self.selected[i] = 1 if selected and self.status[i] != STATUS_COMMENT else 0
+
+    def set_timestamp(self, i, timestamp):
+        self.timestamps[i] = timestamp
+
+    def output(self, i):
+        """Hex digest of the latest output of row i in the artifact store, or None."""
+        raw = self.outputs[i * OUTPUT_DIGEST_SIZE:(i + 1) * OUTPUT_DIGEST_SIZE]
+        return raw.hex() if any(raw) else None
+
+    def set_output(self, i, digest):
+        raw = bytes.fromhex(digest) if digest else bytes(OUTPUT_DIGEST_SIZE)
+        self.outputs[i * OUTPUT_DIGEST_SIZE:(i + 1) * OUTPUT_DIGEST_SIZE] = raw
+
+    def entry(self, i):
+        """Return row i as an index entry dict."""
+        timestamp = self.timestamps[i]
+        entry = {
+            "hash": self.digest(i).hex(),
+            "selected": self.is_selected(i),
+            "status": self.status_name(i),
+            "update_timestamp": None if math.isnan(timestamp) else datetime.fromtimestamp(timestamp).isoformat(),
+        }
+        output = self.output(i)
+        if output:
+            entry["output"] = output
+        for name, column in self.metrics.items():
+            value = column[i]
+            if not math.isnan(value):
+                entry[name] = int(value) if name in INTEGER_METRICS else round(value, 6)
+        if i in self.extra:
+            entry.update(self.extra[i])
+        return entry
+
+    def load_entry(self, i, entry):
+        """Restore row i from an index entry dict, ignoring its hash."""
+        fields = dict(entry)
+        fields.pop("hash", None)
+        self.set_status(i, fields.pop("status", "pending"))
+        self.set_selected(i, fields.pop("selected", False))
+        timestamp = fields.pop("update_timestamp", None)
+        self.timestamps[i] = datetime.fromisoformat(timestamp).timestamp() if timestamp else math.nan
+        self.set_output(i, fields.pop("output", None))
+        for name, column in self.metrics.items():
+            value = fields.pop(name, None)
+            column[i] = math.nan if value is None else float(value)
+        if fields:
+            self.extra[i] = fields
+        else:
+            self.extra.pop(i, None)
+
+    def splice(self, start, end, lines):
+        """Replace rows [start, end) with new pending rows built from lines and shift the rows after them."""
+        replacement = Happl3Store(lines)
+        shift = len(lines) - (end - start)
+        self.buffer = bytes(self.buffer)
+        self.digests = _owned(self.digests)
+        self.outputs = _owned(self.outputs)
+        self.timestamps = _owned(self.timestamps)
+        self.metrics = {name: _owned(column) for name, column in self.metrics.items()}
+        head = self.buffer[:self.offsets[start]]
+        tail = self.buffer[self.offsets[end]:] if end < len(self) else b""
+        buffer = head + (replacement.buffer + b"\n" if lines else b"") + tail
+        self.buffer = buffer[:-1] if buffer.endswith(b"\n") and not tail else buffer
+        delta = replacement.offsets[-1] - (self.offsets[end] - self.offsets[start])
+        self.offsets = (_owned(self.offsets[:start + 1])
+                        + array('Q', (self.offsets[start] + o for o in replacement.offsets[1:]))
+                        + array('Q', (o + delta for o in self.offsets[end + 1:])))
+        self.digests[start * DIGEST_SIZE:end * DIGEST_SIZE] = replacement.digests
+        self.outputs[start * OUTPUT_DIGEST_SIZE:end * OUTPUT_DIGEST_SIZE] = replacement.outputs
+        self.status[start:end] = replacement.status
+        self.selected[start:end] = replacement.selected
+        self.timestamps[start:end] = replacement.timestamps
+        for name, column in self.metrics.items():
+            column[start:end] = replacement.metrics[name]
+        self.extra = {i if i < start else i + shift: fields for i, fields in self.extra.items()
+                      if not start <= i < end}
+
+    def metric(self, i, name):
+        return self.metrics[name][i]
+
+    def set_metrics(self, i, **values):
+        for name, value in values.items():
+            self.metrics[name][i] = math.nan if value is None else value
+
+    def _span(self, start, end):
+        return max(0, start), len(self) if end is None else min(end, len(self))
+
+    def select_where(self, table, start=0, end=None, union=False):
+        """Set selected[start:end] from status translated through table, optionally OR-ed with the current selection."""
+        start, end = self._span(start, end)
+        if start >= end:
+            return
+        flags = self.status[start:end].translate(table)
+        if union:
+            flags = _or_bytes(self.selected[start:end], flags)
+        self.selected[start:end] = flags
+
+    def clear_selection(self, start=0, end=None):
+        start, end = self._span(start, end)
+        if start < end:
+            self.selected[start:end] = bytes(end - start)
+
+    def count_selected(self):
+        return self.selected.count(1)
+
+    def count_status(self, name):
+        return self.status.count(STATUS_CODES[name])
+
+    def find_selected(self, start=0):
+        """Index of the first selected row at or after start, or -1."""
+        return self.selected.find(1, start)
+
+    def find_status(self, name, start=0):
+        """Index of the first command row with status name at or after start, or -1."""
+        return self.status.find(STATUS_CODES[name], start)
+
+    def find_comment(self, start=0):
+        return self.status.find(STATUS_COMMENT, start)
+
+    def match_rows(self, pattern):
+        """Rows whose text matches pattern, a compiled bytes regex using ^/$ with re.MULTILINE.
+
+        The whole buffer is searched at once; the pattern must not match across newlines.
+        """
+        rows = []
+        for match in pattern.finditer(self.buffer):
+            row = bisect_right(self.offsets, match.start()) - 1
+            if not rows or rows[-1] != row:
+                rows.append(row)
+        return rows
+
+    def selected_rows(self):
+        rows = []
+        i = self.selected.find(1)
+        while i >= 0:
+            rows.append(i)
+            i = self.selected.find(1, i + 1)
+        return rows
+
+    def selected_ranges(self):
+        """The selection as a list of [start, end) row ranges."""
+        ranges = []
+        i = self.selected.find(1)
+        while i >= 0:
+            end = self.selected.find(0, i)
+            end = end if end >= 0 else len(self.selected)
+            ranges.append([i, end])
+            i = self.selected.find(1, end)
+        return ranges
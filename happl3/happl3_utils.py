@@ -2,3 +2,7 @@ import hashlib
 
 def hash_command(command):
     return hashlib.md5(command.encode()).hexdigest()
+
+def command_digest(command_bytes):
+    """Raw MD5 digest of an encoded command, matching hash_command() for the same text."""
+    return hashlib.md5(command_bytes).digest()
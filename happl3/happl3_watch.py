@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import struct
+
+# Seconds between checks of the plan file when inotify is not available
+POLL_INTERVAL = 1.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _inotify_watch(directory):
+    """Return a non-blocking inotify descriptor watching directory, or None where inotify is not available."""
+    if not sys.platform.startswith("linux"):
+        return None
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        # Editors often save by writing a new file and renaming it over the old one, so watch the directory
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+class Happl3PlanWatcher:
+    """Tells whether the plan file was changed since the last check.
+
+    With inotify, a check costs one non-blocking read and the file is only
+    looked at after a write to it was closed or a file was renamed over it.
+    Elsewhere the file is polled with stat() every POLL_INTERVAL seconds,
+    and a change is only reported once the file stayed the same for one
+    interval, so a half-written file is not picked up.
+    """
+
+    def __init__(self, plan_file, poll_interval=POLL_INTERVAL):
+        self.plan_file = plan_file
+        self.name = os.fsencode(os.path.basename(plan_file))
+        self.poll_interval = poll_interval
+        self.signature = self._signature()
+        self.candidate = None  # Changed signature seen by the last poll
+        self.last_poll = time.monotonic()
+        self.fd = _inotify_watch(os.path.dirname(os.path.abspath(plan_file)))
+
+    def _signature(self):
+        try:
+            st = os.stat(self.plan_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _plan_events(self):
+        """Read the pending inotify events and return True if one was about the plan file."""
+        found = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return found
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                found = found or name == self.name
+                offset += EVENT_HEADER.size + length
+
+    def changed(self):
+        if self.fd is not None:
+            if not self._plan_events():
+                return False
+            signature = self._signature()
+        else:
+            now = time.monotonic()
+            if now - self.last_poll < self.poll_interval:
+                return False
+            self.last_poll = now
+            signature = self._signature()
+            if signature != self.candidate:
+                self.candidate = signature if signature != self.signature else None
+                return False
+        if signature is None or signature == self.signature:
+            return False
+        self.signature = signature
+        self.candidate = None
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None